@@ -0,0 +1,192 @@
+"""
+Read BGZF (bgzip) compressed files with block decompression run ahead of the reader in a thread pool
+"""
+import io
+import struct
+import zlib
+from collections import deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+
+GZIP_MAGIC = b'\x1f\x8b'
+# Number of blocks to keep queued for decompression per thread
+BLOCKS_PER_THREAD = 4
+
+
+def get_compression(file_name):
+    """
+    Returns the compression of a file from its first bytes.
+
+    Parameters:
+        file_name (string): the path to the file
+
+    Returns:
+        compression (string): one of 'bgzf', 'gzip', or 'none'
+    """
+    with open(file_name, 'rb') as fh:
+        header = fh.read(18)
+    if header[:2] != GZIP_MAGIC:
+        return 'none'
+    # BGZF is gzip with the FEXTRA flag and a 'BC' subfield holding the block size
+    if (len(header) == 18) and (header[3] & 4) and (header[12:14] == b'BC'):
+        return 'bgzf'
+    return 'gzip'
+
+
+def make_virtual_offset(block_offset, within_offset):
+    """
+    Returns the BGZF virtual offset of a position within the uncompressed data of the block starting at block_offset.
+    """
+    return (block_offset << 16) | within_offset
+
+
+def parse_block_size(extra):
+    """
+    Returns the compressed size of a BGZF block from the BC subfield of the extra field of its gzip header.
+    """
+    i = 0
+    while i + 4 <= len(extra):
+        slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+        if extra[i:i + 2] == b'BC' and slen == 2:
+            return struct.unpack('<H', extra[i + 4:i + 6])[0] + 1
+        i = i + 4 + slen
+    raise ValueError('BGZF block is missing the BC subfield!')
+
+
+def read_raw_block(fh):
+    """
+    Returns the next compressed BGZF block from an open binary file handle, or None at the end of the file.
+    """
+    header = fh.read(12)
+    if len(header) == 0:
+        return None
+    if (len(header) < 12) or (header[:2] != GZIP_MAGIC) or not (header[3] & 4):
+        raise ValueError('Truncated or invalid BGZF block header!')
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = fh.read(xlen)
+    block_size = parse_block_size(extra)
+    body = fh.read(block_size - 12 - xlen)
+    if len(body) < block_size - 12 - xlen:
+        raise ValueError('Truncated BGZF block!')
+    return header + extra + body
+
+
+def read_block_size(fh):
+    """
+    Returns the compressed size of the BGZF block starting at the current position of fh from its header, or 0 at the end of the file.
+    """
+    start = fh.tell()
+    header = fh.read(12)
+    if len(header) == 0:
+        return 0
+    xlen = struct.unpack('<H', header[10:12])[0]
+    block_size = parse_block_size(fh.read(xlen))
+    fh.seek(start)
+    return block_size
+
+
+def inflate_block(raw_block):
+    """
+    Returns the uncompressed contents of a single BGZF block and checks them against the block's CRC32 and size.
+    """
+    xlen = struct.unpack('<H', raw_block[10:12])[0]
+    data = zlib.decompress(raw_block[12 + xlen:-8], -15)
+    crc, isize = struct.unpack('<II', raw_block[-8:])
+    if (len(data) != isize) or (zlib.crc32(data) != crc):
+        raise ValueError('BGZF block failed CRC check!')
+    return data
+
+
+class BgzfReader(io.RawIOBase):
+    """
+    A raw binary stream over the uncompressed contents of a BGZF file.
+    Compressed blocks are read in order and handed to a thread pool so decompression runs ahead of the consumer;
+    zlib releases the GIL, so the threads decompress in parallel.
+
+    Parameters:
+        file_name (string): the path to the BGZF file
+        threads (int): the number of decompression threads. 1 decompresses in the calling thread
+        start (int): the compressed offset of the first block to read
+    """
+    def __init__(self, file_name, threads=1, start=0):
+        super().__init__()
+        self.fh = open(file_name, 'rb')
+        self.threads = threads
+        self.pool = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.block_iter = self.blocks(start)
+        self.data = b''
+        self.data_pos = 0
+
+    def readable(self):
+        return True
+
+    def blocks(self, start=0):
+        """
+        Yields (compressed offset, uncompressed data) for each block in file order starting at the compressed offset start.
+        """
+        self.fh.seek(start)
+        offset = start
+        if self.pool is None:
+            while True:
+                raw_block = read_raw_block(self.fh)
+                if raw_block is None:
+                    return
+                yield offset, inflate_block(raw_block)
+                offset = offset + len(raw_block)
+        pending = deque()
+        end_of_file = False
+        while True:
+            while (not end_of_file) and (len(pending) < self.threads * BLOCKS_PER_THREAD):
+                raw_block = read_raw_block(self.fh)
+                if raw_block is None:
+                    end_of_file = True
+                else:
+                    pending.append((offset, self.pool.submit(inflate_block, raw_block)))
+                    offset = offset + len(raw_block)
+            if len(pending) == 0:
+                return
+            block_offset, future = pending.popleft()
+            yield block_offset, future.result()
+
+    def iter_lines(self, start, end=None):
+        """
+        Yields the lines stored between two virtual offsets as bytes, or from start to the end of the file when end is None.
+        """
+        block_beg, within_beg = start >> 16, start & 0xffff
+        block_end, within_end = (None, None) if end is None else (end >> 16, end & 0xffff)
+        remainder = b''
+        with closing(self.blocks(block_beg)) as blocks:
+            for block_offset, data in blocks:
+                if (block_end is not None) and (block_offset > block_end):
+                    break
+                if block_offset == block_end:
+                    data = data[:within_end]
+                if block_offset == block_beg:
+                    data = data[within_beg:]
+                lines = (remainder + data).split(b'\n')
+                remainder = lines.pop()
+                yield from lines
+                if block_offset == block_end:
+                    break
+        if remainder != b'':
+            yield remainder
+
+    def readinto(self, b):
+        while self.data_pos >= len(self.data):
+            next_block = next(self.block_iter, None)
+            if next_block is None:
+                return 0
+            self.data = next_block[1]
+            self.data_pos = 0
+        n = min(len(b), len(self.data) - self.data_pos)
+        b[:n] = self.data[self.data_pos:self.data_pos + n]
+        self.data_pos = self.data_pos + n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.block_iter.close()
+            if self.pool is not None:
+                self.pool.shutdown(wait=True)
+            self.fh.close()
+        super().close()
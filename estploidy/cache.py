@@ -0,0 +1,102 @@
+"""
+Persistent cache of the typed arrays parsed from a VCF, so later runs with the same input and filters skip parsing
+"""
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import numpy as np
+
+# Bump when the layout or meaning of cached arrays changes so old entries are not reused
+CACHE_VERSION = 3
+# Bytes hashed from each end of the vcf to detect files rewritten in place
+FINGERPRINT_SIZE = 1024 * 1024
+CACHE_ARRAYS = ['ref_counts', 'alt_counts', 'genotype_quality']
+
+
+def fingerprint_file(file_name, sample_size=FINGERPRINT_SIZE):
+    """
+    Returns a hash of the first and last sample_size bytes of a file.
+    """
+    file_hash = hashlib.sha256()
+    file_size = os.path.getsize(file_name)
+    with open(file_name, 'rb') as fh:
+        file_hash.update(fh.read(sample_size))
+        if file_size > sample_size:
+            fh.seek(max(sample_size, file_size - sample_size))
+            file_hash.update(fh.read(sample_size))
+    return file_hash.hexdigest()
+
+
+def cache_key(vcf_file, ind_map, pate_flag, settings=None):
+    """
+    Returns a key identifying the parsed arrays of a vcf.
+
+    Parameters:
+        vcf_file (string): a multisample vcf file
+        ind_map (dict): a dictionary mapping individuals in the VCF to a population or other identifier
+        pate_flag (bool): is the VCF a direct product of the PATE pipeline
+        settings (dict): any other options that change the parsed arrays, such as regions
+
+    Returns:
+        key (string): a hex digest of the vcf path, size, modification time, and content fingerprint, the individuals, and the settings
+    """
+    stat = os.stat(vcf_file)
+    description = {
+        'version': CACHE_VERSION,
+        'vcf_file': os.path.abspath(vcf_file),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'fingerprint': fingerprint_file(vcf_file),
+        'individuals': sorted(str(i) for i in ind_map.keys()),
+        'pate_flag': bool(pate_flag),
+        'settings': settings if settings is not None else {}
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def load_cached_arrays(cache_dir, key):
+    """
+    Returns the individuals, arrays, and site coordinates stored under a key, or None if there is no complete entry.
+    Arrays are memory-mapped read-only, so they are only read from disk as they are used.
+    Coordinates are returned as the chromosome names, the chromosome code of each site, and the position of each site.
+    """
+    entry_dir = os.path.join(cache_dir, key)
+    if not os.path.isdir(entry_dir):
+        return None
+    try:
+        with open(os.path.join(entry_dir, 'entry.json')) as fh:
+            entry = json.load(fh)
+        arrays = [np.load(os.path.join(entry_dir, f'{name}.npy'), mmap_mode='r') for name in CACHE_ARRAYS]
+        chrom = np.load(os.path.join(entry_dir, 'chrom.npy'))
+        pos = np.load(os.path.join(entry_dir, 'pos.npy'))
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f'Ignoring unreadable cache entry {entry_dir}: {e}')
+        return None
+    return entry['tax_list'], arrays, (entry['chrom_names'], chrom, pos)
+
+
+def save_cached_arrays(cache_dir, key, tax_list, arrays, coordinates):
+    """
+    Stores the individuals, arrays, and SiteCoordinates under a key. The entry is written to a temporary directory and renamed into place,
+    so an interrupted run never leaves a partial entry behind.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_dir = os.path.join(cache_dir, key)
+    temp_dir = tempfile.mkdtemp(prefix=f'.{key}.', dir=cache_dir)
+    try:
+        for name, array in zip(CACHE_ARRAYS, arrays):
+            np.save(os.path.join(temp_dir, f'{name}.npy'), np.ascontiguousarray(array))
+        np.save(os.path.join(temp_dir, 'chrom.npy'), coordinates.chrom)
+        np.save(os.path.join(temp_dir, 'pos.npy'), coordinates.pos)
+        with open(os.path.join(temp_dir, 'entry.json'), 'w') as fh:
+            json.dump({'tax_list': tax_list, 'chrom_names': coordinates.chrom_names}, fh)
+        os.rename(temp_dir, entry_dir)
+    except OSError:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        # Another run may have stored the same entry first
+        if not os.path.isdir(entry_dir):
+            raise
+    logging.info(f'Stored parsed arrays in {entry_dir}')
@@ -1,4 +1,8 @@
 from estploidy.calculate_frequencies.calculate_frequencies import get_ind_freqs
+from estploidy.calculate_frequencies.calculate_frequencies import iter_site_batches
+from estploidy.calculate_frequencies.calculate_frequencies import load_allele_counts
+from estploidy.calculate_frequencies.allele_counts import AlleleCounts
+from estploidy.calculate_frequencies.site_data import SiteData
 from estploidy.calculate_frequencies.calculate_frequencies import get_pop_freqs
 from estploidy.calculate_frequencies.impute import average_missing
 from estploidy.calculate_frequencies.impute import remove_missing
@@ -0,0 +1,67 @@
+"""
+Raw read counts parsed from a VCF, with allele balance and the quality filters computed on demand
+"""
+import numpy as np
+
+
+class AlleleCounts:
+    """
+    Reference and alternate read counts and genotype qualities of each individual at each site.
+    Allele balance, depth, and the filter mask are recomputed from the counts, so changing a threshold does not require parsing the VCF again.
+
+    Parameters:
+        tax_list (list): A list of individual labels, one per column
+        ref_counts (np.array): (n_sites, n_tax) uint16 reads supporting the reference allele
+        alt_counts (np.array): (n_sites, n_tax) uint16 reads supporting the alternate allele
+        genotype_quality (np.array): (n_sites, n_tax) uint8 phred-scaled genotype qualities
+        coordinates (SiteCoordinates): optional chromosome and position of each site
+    """
+    def __init__(self, tax_list, ref_counts, alt_counts, genotype_quality, coordinates=None):
+        self.tax_list = tax_list
+        self.ref_counts = ref_counts
+        self.alt_counts = alt_counts
+        self.genotype_quality = genotype_quality
+        self.coordinates = coordinates
+
+    @property
+    def n_sites(self):
+        return self.ref_counts.shape[0]
+
+    @property
+    def n_tax(self):
+        return self.ref_counts.shape[1]
+
+    def total_counts(self):
+        """
+        Returns the summed read counts without clipping.
+        """
+        return self.ref_counts.astype(np.uint32) + self.alt_counts
+
+    def depth(self):
+        """
+        Returns the read depth of each individual at each site, clipped to uint16.
+        """
+        return np.minimum(self.total_counts(), np.iinfo(np.uint16).max).astype(np.uint16)
+
+    def allele_balance(self):
+        """
+        Returns the fraction of reads supporting the alternate allele as float32, or 0 where there are no reads.
+        """
+        total_counts = self.total_counts()
+        allele_balance = np.zeros(total_counts.shape, dtype=np.float64)
+        np.divide(self.alt_counts, total_counts, out=allele_balance, where=total_counts > 0)
+        return allele_balance.astype(np.float32)
+
+    def filter(self, min_depth, min_count, min_qual):
+        """
+        Returns a boolean mask of the high-quality genotypes.
+
+        Parameters:
+            min_depth (int): the minimum depth of a site to be considered high-quality
+            min_count (int): the minimum number of reads supporting the minor allele to be considered high-quality
+            min_qual (int): the minimum phred-scaled genotype likelihood to be considered high-quality
+
+        Returns:
+            passing_filter (np.array): (n_sites, n_tax) True where a genotype passes every threshold
+        """
+        return (self.total_counts() >= min_depth) & (self.ref_counts >= 1) & (self.alt_counts >= min_count) & (self.genotype_quality >= min_qual)
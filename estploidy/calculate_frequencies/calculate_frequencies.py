@@ -1,129 +1,460 @@
-import re
 import numpy as np
 import pandas as pd
 import logging
+from estploidy.utils import check_individuals, resolve_individual
+from estploidy.utils import open_vcf, is_stream
+from estploidy.tabix import iter_region_records
+from estploidy.shards import plan_shards, iter_shard_lines
+from estploidy.bgzf import get_compression
+from estploidy.cache import cache_key, load_cached_arrays, save_cached_arrays
+from estploidy.calculate_frequencies.parse_chunks import COUNT_DTYPES, get_format_fields, iter_record_chunks, parse_record_chunk
+from estploidy.calculate_frequencies.allele_counts import AlleleCounts
+from estploidy.calculate_frequencies.coordinates import CoordinateBuilder, SiteCoordinates
+from estploidy.calculate_frequencies.out_of_core import WORKING_SET_SIZE, SpillSiteBlocks, join_spill_files, map_spill_files, spill_paths
+from estploidy.calculate_frequencies.site_data import build_site_data
+from estploidy.calculate_frequencies.write_output import write_individual_files
+from estploidy.calculate_frequencies.export import export_long_table
+from concurrent.futures import ProcessPoolExecutor
 
+# Number of sites held by each block of the growable site buffers
+SITE_BLOCK_SIZE = 65536
 
-def get_ind_freqs(n_sites, n_tax, ind_map, vcf_file, min_depth, min_count, min_qual, pate_flag, output_dir):
+
+class SiteBlocks:
+    """
+    Growable storage for typed per-site arrays that are filled while parsing a VCF.
+    Rows are written into fixed-size blocks, or whole batches of rows are appended, and the blocks are concatenated once at the end,
+    so the number of sites does not need to be known before parsing starts.
+
+    Parameters:
+        n_tax (int): the number of individuals (columns) in each array
+        dtypes (list): the numpy dtype of each array
+        block_size (int): the number of sites held by each block
+    """
+    def __init__(self, n_tax, dtypes, block_size=SITE_BLOCK_SIZE):
+        self.n_tax = n_tax
+        self.dtypes = dtypes
+        self.block_size = block_size
+        self.full_blocks = [[] for _ in dtypes]
+        self.current = None
+        self.row = 0
+        self.n_sites = 0
+
+    def _allocate(self):
+        return [np.empty((self.block_size, self.n_tax), dtype=dtype) for dtype in self.dtypes]
+
+    def _flush(self):
+        if self.current is not None:
+            for blocks, block in zip(self.full_blocks, self.current):
+                blocks.append(block[:self.row])
+        self.current = None
+        self.row = 0
+
+    def next_row(self):
+        """
+        Returns the row of the current block to fill for the next site, starting a new block when the current one is full.
+        """
+        if (self.current is None) or (self.row == self.block_size):
+            self._flush()
+            self.current = self._allocate()
+        row = self.row
+        self.row = self.row + 1
+        self.n_sites = self.n_sites + 1
+        return row
+
+    def extend(self, arrays):
+        """
+        Appends a batch of rows given as one (n_rows, n_tax) array per dtype.
+        """
+        self._flush()
+        for blocks, block, dtype in zip(self.full_blocks, arrays, self.dtypes):
+            blocks.append(block.astype(dtype, copy=False))
+        self.n_sites = self.n_sites + len(arrays[0])
+
+    def finalize(self):
+        """
+        Returns one contiguous (n_sites, n_tax) array per dtype. The blocks are released, so the buffer should not be reused.
+        """
+        self._flush()
+        arrays = []
+        for blocks, dtype in zip(self.full_blocks, self.dtypes):
+            if len(blocks) == 0:
+                arrays.append(np.empty((0, self.n_tax), dtype=dtype))
+            elif (len(blocks) == 1) and (blocks[0].base is None):
+                # A single batch that owns its memory is returned without a copy
+                arrays.append(blocks[0])
+            else:
+                arrays.append(np.concatenate(blocks, axis=0))
+            blocks.clear()
+        return arrays
+
+
+def parse_header(line, ind_map, pate_flag):
     '''
-    Returns an np.array object of allele balance across sites for each individual from a multisample vcf.
+    Returns the individuals to process from the #CHROM header line of a multisample vcf.
 
     Parameters:
-        n_sites (int): the number of sites to process from the VCF
-        n_tax (int): the number of individuals to process from the VCF
-        ind_map (dict): a dictionary mapping individuals in the VCF to a population or other identifier 
-        vcf_file (string): a multisample vcf file uncompressed
-        min_depth (int): the minimum depth of a site to be considered high-quality
-        min_count (int): the minimum number of reads supporting the minor allele to be considered high-quality
-        min_qual (int): the minimum phred-scaled genotype likelihood to be considered high-quality
+        line (string): the #CHROM header line
+        ind_map (dict): a dictionary mapping individuals in the VCF to a population or other identifier
         pate_flag (bool): is the VCF a direct product of the PATE pipeline
-        output_dir (string): the directory where all results will be written
 
     Returns:
-        tax_list (list): A list of individual labels
-        ab_dat: a numpy array of allele balance data as well as depth, genotype quality, and filtering information
+        tax_list (list): A list of individual labels in VCF order
+        vcf_map (dict): maps VCF columns to individual labels
+        vcf_index (dict): maps individual labels to their column in the returned arrays
     '''
-    
-    # Goal - these all need to be typed as arrays to keep the memory from exploding
-    # The individual files can be written out using pandas from array
-    allele_balance_data = np.empty((n_sites, n_tax), dtype=np.float32)
-    site_depth_data = np.empty((n_sites, n_tax), dtype=np.uint16)
-    genotype_quality_data = np.empty((n_sites, n_tax), dtype=np.uint8)
-    passing_filter_data = np.empty((n_sites, n_tax), dtype=np.bool_)
-    # chromosome_data = {}
-    # site_position_data = {}
     vcf_map = {}
     vcf_index = {}
     tax_list = []
     n_tax = 0
+    temp = line.strip().split()
+    #print(line)
+    for i in range(9, len(temp)):
+        this_tax = resolve_individual(temp[i], pate_flag)
+        if this_tax in ind_map.keys():
+            tax_list.append(this_tax)
+            vcf_index[this_tax] = n_tax
+            n_tax = n_tax + 1
+            vcf_map[i] = this_tax
+    return tax_list, vcf_map, vcf_index
+
+
+def read_header(fh, vcf_file, ind_map, pate_flag):
+    '''
+    Reads a binary vcf file handle up to and including the #CHROM header line and returns the output of parse_header.
+    '''
+    for line in fh:
+        if b'#CHROM' in line:
+            tax_list, vcf_map, vcf_index = parse_header(line.decode(), ind_map, pate_flag)
+            check_individuals(ind_map, tax_list)
+            return tax_list, vcf_map, vcf_index
+    logging.error(f'No #CHROM header line found in {vcf_file}!')
+    raise ValueError(f'{vcf_file} is missing the #CHROM header line.')
+
+
+def parse_record_lines(records, vcf_map, vcf_index, pate_flag, site_offset=0, coordinates=None, site_filters=None):
+    '''
+    Returns typed arrays of reference and alternate read counts and genotype quality for the passing records of a vcf,
+    parsing one line at a time. Used for records that are not uniformly tab-delimited.
+
+    Parameters:
+        records (iterable): lines of the vcf after the header
+        vcf_map (dict): maps VCF columns to individual labels
+        vcf_index (dict): maps individual labels to their column in the returned arrays
+        pate_flag (bool): is the VCF a direct product of the PATE pipeline
+        site_offset (int): the number of sites parsed before these records, used in warnings
+        coordinates (list): if given, the chromosomes and positions of the passing records are appended as a (chrom, pos) tuple of arrays
+        site_filters (SiteFilters): optional thresholds on QUAL, ALT, and INFO/DP
+
+    Returns:
+        arrays (list): (n_sites, n_tax) arrays of reference counts, alternate counts, and genotype quality, clipped to their dtypes
+    '''
+    site_blocks = SiteBlocks(len(vcf_index), COUNT_DTYPES)
+    chrom = []
+    pos = []
+    format_cache = {}
+    n_sites = site_offset
+    # Only the columns of individuals being processed are visited, and lines are not split past the last of them
+    columns = sorted(vcf_map.keys())
+    out_columns = [vcf_index[vcf_map[i]] for i in columns]
+    max_split = columns[-1] if len(columns) > 0 else 8
+    for line in records:
+        line = line.strip()
+        if line == '':
+            continue
+        # The fixed columns are split off first, so the genotypes of rejected sites are not split
+        temp = line.split(None, 8)
+        if len(temp) < 8:
+            continue
+        if (temp[6] == 'PASS' or ((pate_flag == True) and temp[6] == '.')) and ((site_filters is None) or site_filters.passes(temp[4].encode(), temp[5].encode(), temp[7].encode())):
+            if len(temp) <= 8:
+                raise ValueError(f'Passing record at {temp[0]}:{temp[1]} has no FORMAT or genotype columns. Is the VCF missing its sample columns?')
+            temp = temp[:8] + temp[8].split(None, max_split - 7)
+            row = site_blocks.next_row()
+            chrom.append(temp[0])
+            pos.append(int(temp[1]))
+            ref_counts_data, alt_counts_data, genotype_quality_data = site_blocks.current
+            # Resolve the positions of AD and GQ once per distinct FORMAT string
+            format_fields = format_cache.get(temp[8])
+            if format_fields is None:
+                format_fields = get_format_fields(temp[8])
+                format_cache[temp[8]] = format_fields
+            ad_index, gq_index = format_fields
+            for i, k in zip(columns, out_columns):
+                if i < len(temp):
+                    ref_counts = 0
+                    alt_counts = 0
+                    genotype_quality = 0
+                    genotype_fields = temp[i].split(':')
+                    # Missing genotypes may drop trailing fields, so cells without AD are treated as missing data
+                    if (ad_index is not None) and (len(genotype_fields) > ad_index):
+                        allele_counts = genotype_fields[ad_index].split(',')
+                        try:
+                            ref_counts = int(allele_counts[0])
+                            alt_counts = int(allele_counts[1])
+                        except (ValueError, IndexError):
+                            ref_counts = 0
+                            alt_counts = 0
+                            if genotype_fields[ad_index] != '.':
+                                print(f'WARNING: Incorrectly formatted VCF fields!\n--> {vcf_map[i]} at variant {n_sites}\n-->{temp[0]}: {temp[1]}\n')
+                        if (gq_index is not None) and (len(genotype_fields) > gq_index):
+                            try:
+                                genotype_quality = int(genotype_fields[gq_index])
+                            except ValueError:
+                                genotype_quality = 0
+
+                    ref_counts_data[row, k] = min(ref_counts, 65535)
+                    alt_counts_data[row, k] = min(alt_counts, 65535)
+                    genotype_quality_data[row, k] = min(genotype_quality, 255)
+            n_sites = n_sites + 1
+    if coordinates is not None:
+        coordinates.append((np.array(chrom, dtype=str), np.array(pos, dtype=np.int64)))
+    return site_blocks.finalize()
+
+
+def iter_record_blocks(records, vcf_map, vcf_index, pate_flag, site_filters=None):
+    '''
+    Yields (chrom, pos, arrays) for each block of passing records of a vcf.
+    Records are read in blocks of bytes that are parsed with vectorized numpy operations,
+    falling back to parsing line by line for blocks that are not uniformly tab-delimited.
+    '''
+    columns = sorted(vcf_map.keys())
+    out_columns = [vcf_index[vcf_map[i]] for i in columns]
+    format_cache = {}
     n_sites = 0
-    n_variants = {}
-    skip_header = 1
-
-    with open(vcf_file,'r') as fh:
-        for line in fh:
-            line = line.strip()
-            if '#CHROM' in line:
-                temp = line.split()
-                #print(line)
-                for i in range(9, len(temp)):
-                    this_tax = ''
-                    if '/' in temp[i]:
-                        if pate_flag == False:
-                            tax_path = temp[i].split('/')
-                            this_tax = tax_path[-1]
-                        elif pate_flag == True:
-                            tax_path = temp[i].split('/')
-                            this_tax = tax_path[-2]
-                    else:
-                        this_tax = temp[i]
-                    #print(this_tax)
-                    if this_tax in ind_map.keys():
-                        tax_list.append(this_tax)
-                        n_variants[this_tax] = 0
-                        vcf_index[this_tax] = n_tax
-                        n_tax = n_tax + 1
-                        vcf_map[i] = this_tax
-                        #allele_balance_data[this_tax] = []
-                        #site_depth_data[this_tax] = []
-                        #genotype_quality_data[this_tax] = []
-                        #passing_filter_data[this_tax] = []
-                        # chromosome_data[this_tax] = []
-                        # site_position_data[this_tax] = []
-                        #print(f'{this_tax}')
-                skip_header = 0
+    for chunk in iter_record_chunks(records):
+        coordinates = []
+        arrays = parse_record_chunk(chunk, columns, out_columns, len(vcf_index), pate_flag, format_cache, n_sites, vcf_map, coordinates, site_filters)
+        if arrays is None:
+            arrays = parse_record_lines(chunk.decode().split('\n'), vcf_map, vcf_index, pate_flag, n_sites, coordinates, site_filters)
+        chrom, pos = coordinates[0]
+        n_sites = n_sites + len(pos)
+        yield chrom, pos, arrays
+
+
+def parse_records(records, vcf_map, vcf_index, pate_flag, scratch_prefix=None, site_filters=None):
+    '''
+    Returns typed arrays of reference and alternate read counts and genotype quality for the passing records of a vcf.
+    Records are read in blocks of bytes that are parsed with vectorized numpy operations.
+
+    Parameters:
+        records: a binary file handle positioned after the header, or an iterable of lines of the vcf after the header
+        vcf_map (dict): maps VCF columns to individual labels
+        vcf_index (dict): maps individual labels to their column in the returned arrays
+        pate_flag (bool): is the VCF a direct product of the PATE pipeline
+        scratch_prefix (string): optional path prefix of files on disk that hold the arrays instead of memory
+        site_filters (SiteFilters): optional thresholds on QUAL, ALT, and INFO/DP checked before genotypes are parsed
+
+    Returns:
+        arrays (list): (n_sites, n_tax) arrays of reference counts, alternate counts, and genotype quality,
+            as read-only memory maps of the files when scratch_prefix is given
+        coordinates (SiteCoordinates): the chromosome and position of each site
+    '''
+    # Goal - these all need to be typed as arrays to keep the memory from exploding
+    # Arrays are appended block by block, so the number of sites does not need to be known in advance
+    if scratch_prefix is None:
+        site_blocks = SiteBlocks(len(vcf_index), COUNT_DTYPES)
+    else:
+        site_blocks = SpillSiteBlocks(len(vcf_index), COUNT_DTYPES, scratch_prefix)
+    # Chromosomes are kept as codes and positions as uint32 rather than lists of strings and ints
+    coordinate_builder = CoordinateBuilder()
+    for chrom, pos, arrays in iter_record_blocks(records, vcf_map, vcf_index, pate_flag, site_filters):
+        site_blocks.extend(arrays)
+        coordinate_builder.extend(chrom, pos)
+    return site_blocks.finalize(), coordinate_builder.finalize()
+
+
+def parse_shard(vcf_file, shard, vcf_map, vcf_index, pate_flag, scratch_prefix=None, site_filters=None):
+    '''
+    Returns the typed arrays and coordinates of parse_records for one shard of a vcf returned by estploidy.shards.plan_shards.
+    Runs in a worker process. When scratch_prefix is given the arrays are written to files and only the coordinates are returned.
+    '''
+    records = iter_shard_lines(vcf_file, shard)
+    try:
+        arrays, coordinates = parse_records(records, vcf_map, vcf_index, pate_flag, scratch_prefix, site_filters)
+    finally:
+        records.close()
+    return (arrays if scratch_prefix is None else None), coordinates
+
+
+def parse_shards(vcf_file, vcf_map, vcf_index, pate_flag, threads, scratch_dir=None, site_filters=None):
+    '''
+    Returns the typed arrays and coordinates of parse_records for a whole vcf by parsing byte-range shards in a pool of worker processes.
+    Shards are concatenated in file order, so the result matches parsing the vcf in a single process.
+    When scratch_dir is given, each shard is written to files there and the joined files are returned as memory maps.
+    '''
+    shards = plan_shards(vcf_file, threads)
+    logging.info(f'Parsing {vcf_file} in {len(shards)} shards with {threads} processes')
+    prefixes = [None] * len(shards)
+    if scratch_dir is not None:
+        prefixes = [f'{scratch_dir}/counts.shard{i}' for i in range(len(shards))]
+    with ProcessPoolExecutor(max_workers=threads) as pool:
+        futures = [pool.submit(parse_shard, vcf_file, shard, vcf_map, vcf_index, pate_flag, prefix, site_filters) for shard, prefix in zip(shards, prefixes)]
+        results = [future.result() for future in futures]
+    shard_arrays = [result[0] for result in results]
+    coordinates = SiteCoordinates.concatenate([result[1] for result in results])
+    if scratch_dir is not None:
+        join_spill_files(prefixes, f'{scratch_dir}/counts', len(COUNT_DTYPES))
+        return map_spill_files(spill_paths(f'{scratch_dir}/counts', len(COUNT_DTYPES)), len(vcf_index), COUNT_DTYPES, coordinates.n_sites), coordinates
+    arrays = []
+    for k in range(len(shard_arrays[0])):
+        arrays.append(np.concatenate([this_shard[k] for this_shard in shard_arrays], axis=0))
+        for this_shard in shard_arrays:
+            this_shard[k] = None
+    return arrays, coordinates
+
+
+def iter_site_batches(vcf_file, ind_map, batch_size=SITE_BLOCK_SIZE, min_depth=10, min_count=3, min_qual=20, pate_flag=False, threads=1, region_map=None, site_filters=None):
+    '''
+    Yields the passing sites of a multisample vcf in batches of typed arrays, so only one batch is held in memory at a time.
+
+    Parameters:
+        vcf_file (string): a multisample vcf file uncompressed, gzip, or bgzip compressed, or '-' for standard input
+        ind_map (dict): a dictionary mapping individuals in the VCF to a population or other identifier
+        batch_size (int): the number of sites in each batch. The last batch may be smaller
+        min_depth (int): the minimum depth of a site to be considered high-quality
+        min_count (int): the minimum number of reads supporting the minor allele to be considered high-quality
+        min_qual (int): the minimum phred-scaled genotype likelihood to be considered high-quality
+        pate_flag (bool): is the VCF a direct product of the PATE pipeline
+        threads (int): the number of threads used to decompress a bgzip compressed VCF
+        region_map (dict): optional regions from estploidy.tabix.parse_regions. Only sites overlapping the regions are processed
+        site_filters (SiteFilters): optional thresholds on QUAL, ALT, and INFO/DP checked before genotypes are parsed
+
+    Returns:
+        batches: a generator of dicts holding the individual labels (tax_list), the chromosome (chrom) and position (pos) of each site,
+            and (n_sites, n_tax) arrays of ref_counts, alt_counts, allele_balance, depth, genotype_quality, and pass_filters
+    '''
+    if batch_size < 1:
+        raise ValueError(f'batch_size must be at least 1, not {batch_size}!')
+    keys = ['chrom', 'pos', 'ref_counts', 'alt_counts', 'genotype_quality']
+    with open_vcf(vcf_file, threads, binary=True) as fh:
+        tax_list, vcf_map, vcf_index = read_header(fh, vcf_file, ind_map, pate_flag)
+        records = fh if region_map is None else iter_region_records(fh, vcf_file, region_map, threads)
+        # Sites left over from parsed blocks that did not fill a whole batch
+        pending = None
+        for chrom, pos, arrays in iter_record_blocks(records, vcf_map, vcf_index, pate_flag, site_filters):
+            values = [chrom, pos] + arrays
+            if pending is not None:
+                values = [np.concatenate([held, value], axis=0) for held, value in zip(pending, values)]
+            start = 0
+            while len(values[1]) - start >= batch_size:
+                yield _make_batch(tax_list, keys, [value[start:start + batch_size] for value in values], min_depth, min_count, min_qual)
+                start = start + batch_size
+            pending = [value[start:] for value in values]
+        if (pending is not None) and (len(pending[1]) > 0):
+            yield _make_batch(tax_list, keys, pending, min_depth, min_count, min_qual)
+
+
+def _make_batch(tax_list, keys, values, min_depth, min_count, min_qual):
+    batch = {'tax_list': tax_list}
+    for key, value in zip(keys, values):
+        batch[key] = value.copy()
+    counts = AlleleCounts(tax_list, batch['ref_counts'], batch['alt_counts'], batch['genotype_quality'])
+    batch['allele_balance'] = counts.allele_balance()
+    batch['depth'] = counts.depth()
+    batch['pass_filters'] = counts.filter(min_depth, min_count, min_qual)
+    return batch
+
+
+def load_allele_counts(ind_map, vcf_file, pate_flag, threads=1, region_map=None, cache_dir=None, scratch_dir=None, site_filters=None):
+    '''
+    Returns the raw read counts and genotype qualities of the individuals in a multisample vcf, before any quality filters.
+
+    Parameters:
+        ind_map (dict): a dictionary mapping individuals in the VCF to a population or other identifier
+        vcf_file (string): a multisample vcf file uncompressed, gzip, or bgzip compressed, or '-' for standard input.
+            Standard input and named pipes are parsed in a single streaming pass
+        pate_flag (bool): is the VCF a direct product of the PATE pipeline
+        threads (int): the number of processes used to parse shards of an uncompressed or bgzip compressed VCF,
+            or of threads used to decompress a bgzip compressed VCF that is read serially
+        region_map (dict): optional regions from estploidy.tabix.parse_regions. Only sites overlapping the regions are processed
+        cache_dir (string): optional directory of parsed arrays from earlier runs. Arrays are reused when the VCF, individuals,
+            and regions are unchanged, and stored there otherwise. Streams are not cached
+        scratch_dir (string): optional directory where parsed arrays are written and memory-mapped instead of held in memory
+        site_filters (SiteFilters): optional thresholds on QUAL, ALT, and INFO/DP. Sites failing them or FILTER
+            are dropped from their first eight columns, before any genotype is read
+
+    Returns:
+        counts (AlleleCounts): reference and alternate counts and genotype qualities of each individual at each passing site,
+            with the chromosome and position of each site
+    '''
+    cached = None
+    stream = is_stream(vcf_file)
+    if (cache_dir is not None) and stream:
+        logging.warning(f'{vcf_file} is a stream and cannot be identified for the cache. Parsing without {cache_dir}.')
+        cache_dir = None
+    if cache_dir is not None:
+        settings = {'region_map': region_map}
+        if site_filters is not None:
+            settings['site_filters'] = site_filters.settings()
+        key = cache_key(vcf_file, ind_map, pate_flag, settings)
+        cached = load_cached_arrays(cache_dir, key)
+    if cached is not None:
+        logging.info(f'Reusing parsed arrays of {vcf_file} from {cache_dir}')
+        tax_list, arrays, coordinate_arrays = cached
+        coordinates = SiteCoordinates(*coordinate_arrays)
+    else:
+        with open_vcf(vcf_file, threads, binary=True) as fh:
+            tax_list, vcf_map, vcf_index = read_header(fh, vcf_file, ind_map, pate_flag)
+            scratch_prefix = None if scratch_dir is None else f'{scratch_dir}/counts'
+            if region_map is not None:
+                records = iter_region_records(fh, vcf_file, region_map, threads)
+                arrays, coordinates = parse_records(records, vcf_map, vcf_index, pate_flag, scratch_prefix, site_filters)
+            elif (threads > 1) and (not stream) and (get_compression(vcf_file) != 'gzip'):
+                arrays, coordinates = parse_shards(vcf_file, vcf_map, vcf_index, pate_flag, threads, scratch_dir, site_filters)
             else:
-                if skip_header == 0:
-                    temp = line.split()
-                    if (temp[6] == 'PASS' or ((pate_flag == True) and temp[6] == '.')):
-                        for i in range(9, len(temp)): ####Continue fixing here
-                            if i in vcf_map.keys():
-                                ref_counts = 0
-                                alt_counts = 0
-                                total_count = 0
-                                total_count = 0
-                                allele_balance = 0
-                                genotype_quality = 0
-                                indicator = 0
-                                genotype_string = temp[i]
-                                genotype_fields = genotype_string.split(':')
-                                # Anticipating that lines with fewer than 5 fields are not biallelic snps
-                                if (len(genotype_fields) >= 5):
-                                    if re.match(r'\d+,\d+', genotype_fields[1]):
-                                        allele_counts = genotype_fields[1].split(',')
-                                        #print(allele_counts)
-                                        ref_counts = int(allele_counts[0])
-                                        alt_counts = int(allele_counts[1])
-                                        total_count = ref_counts + alt_counts
-                                        if re.match(r'\d+', genotype_fields[3]):
-                                            genotype_quality = int(genotype_fields[3])
-                                        if (total_count > 0):
-                                            allele_balance = alt_counts / total_count
-                                        if ((total_count >= min_depth) and (ref_counts >= 1) and (alt_counts >= min_count) and (genotype_quality >= min_qual)):
-                                            indicator = 1
-                                    else:
-                                        print(f'WARNING: Incorrectly formatted VCF fields!\n--> {vcf_map[i]} at variant {n_variants[vcf_map[i]]}\n-->{temp[0]}: {temp[1]}\n')
-                                
-                                allele_balance_data[n_sites, vcf_index[vcf_map[i]]] = allele_balance
-                                site_depth_data[n_sites, vcf_index[vcf_map[i]]] = total_count
-                                genotype_quality_data[n_sites, vcf_index[vcf_map[i]]] = genotype_quality
-                                passing_filter_data[n_sites, vcf_index[vcf_map[i]]] = indicator
-                                # chromosome_data[vcf_map[i]].append(temp[0])
-                                # site_position_data[vcf_map[i]].append(temp[1])
-                                n_variants[vcf_map[i]] = n_variants[vcf_map[i]] + 1
-                        n_sites = n_sites + 1
+                arrays, coordinates = parse_records(fh, vcf_map, vcf_index, pate_flag, scratch_prefix, site_filters)
+        if cache_dir is not None:
+            save_cached_arrays(cache_dir, key, tax_list, arrays, coordinates)
+    return AlleleCounts(tax_list, *arrays, coordinates=coordinates)
+
+
+def get_ind_freqs(ind_map, vcf_file, min_depth, min_count, min_qual, pate_flag, output_dir, threads=1, region_map=None, cache_dir=None, scratch_dir=None, working_set=WORKING_SET_SIZE, export_dir=None, export_partition='individual', site_filters=None, max_sites=None, seed=0):
+    '''
+    Returns the allele balance, depth, genotype quality, and filters across sites for each individual from a multisample vcf.
+    The VCF is read once; the number of sites is discovered while parsing.
+
+    Parameters:
+        ind_map (dict): a dictionary mapping individuals in the VCF to a population or other identifier 
+        vcf_file (string): a multisample vcf file uncompressed, gzip, or bgzip compressed, or '-' for standard input
+        min_depth (int): the minimum depth of a site to be considered high-quality
+        min_count (int): the minimum number of reads supporting the minor allele to be considered high-quality
+        min_qual (int): the minimum phred-scaled genotype likelihood to be considered high-quality
+        pate_flag (bool): is the VCF a direct product of the PATE pipeline
+        output_dir (string): the directory where all results will be written
+        threads (int): the number of processes used to parse shards of an uncompressed or bgzip compressed VCF,
+            or of threads used to decompress a bgzip compressed VCF that is read serially,
+            and of processes used to write the individual frequency files
+        region_map (dict): optional regions from estploidy.tabix.parse_regions. Only sites overlapping the regions are processed
+        cache_dir (string): optional directory of parsed read counts from earlier runs. Counts are reused when the VCF, individuals,
+            and regions are unchanged, so only the filters are recomputed, and stored there otherwise
+        scratch_dir (string): optional directory for out-of-core processing. Parsed arrays are written there and memory-mapped,
+            and the fields of the returned ab_dat are read-only memory maps, so memory use does not grow with the size of the cohort
+        working_set (int): the approximate bytes of memory used at a time to compute ab_dat from the read counts and to write the export table
+        export_dir (string): optional directory for a long-format table of the read counts, genotype qualities, and filters
+            of each individual at each site with its chromosome and position
+        export_partition (string): partition the exported table by 'individual' or 'chrom'
+        site_filters (SiteFilters): optional thresholds on QUAL, ALT, and INFO/DP applied to sites along with FILTER
+        max_sites (int): optional maximum number of passing sites per individual sampled into ab_dat.sampled_allele_balance
+            while ab_dat is computed, for fitting mixtures. The fields, filters, and files of ab_dat still hold every site
+        seed (int): the seed of the sample of passing sites
+
+    Returns:
+        tax_list (list): A list of individual labels
+        ab_dat (SiteData): (n_sites, n_tax) arrays of allele balance, depth, genotype quality, and filtering information, each in its own dtype
+    '''
+    counts = load_allele_counts(ind_map, vcf_file, pate_flag, threads, region_map, cache_dir, scratch_dir, site_filters)
+    tax_list = counts.tax_list
+    n_sites, n_tax = counts.n_sites, counts.n_tax
+    # Allele balance, depth, and the filters are computed from the raw counts, so thresholds can change without reparsing
+    ab_dat = build_site_data(counts, min_depth, min_count, min_qual, scratch_dir, working_set, max_sites, seed)
+    if export_dir is not None:
+        export_long_table(counts, min_depth, min_count, min_qual, export_dir, export_partition, working_set=working_set)
+    del counts
 
     if (output_dir != 'dummy'):
-        for i in range(0, len(tax_list)):
-            output_file = f'{output_dir}/{tax_list[i]}.txt'
-            outfile = open(output_file, 'w')
-            #outfile.write('chr\tpos\tallele_balance\tdepth\tgenotype_quality\tpass_filters\n')
-            outfile.write('allele_balance\tdepth\tgenotype_quality\tpass_filters\n')
-            for j in range(0, n_variants[tax_list[i]]):
-                # outstring = f'{chromosome_data[tax_list[i]][j]}\t{site_position_data[tax_list[i]][j]}\t{allele_balance_data[tax_list[i]][j]}\t{site_depth_data[tax_list[i]][j]}\t{genotype_quality_data[tax_list[i]][j]}\t{passing_filter_data[tax_list[i]][j]}\n'
-                outstring = f'{allele_balance_data[j,vcf_index[tax_list[i]]]}\t{site_depth_data[j,vcf_index[tax_list[i]]]}\t{genotype_quality_data[j,vcf_index[tax_list[i]]]}\t{passing_filter_data[j,vcf_index[tax_list[i]]]}\n'
-                outfile.write(outstring)
-            outfile.close()
+        # Whole columns are formatted at once, and the files of different individuals are written concurrently
+        write_individual_files(output_dir, ab_dat, threads)
         # Free up memory from the lists of positional information    
         #chromosome_data.clear()
         #site_position_data.clear()
@@ -138,17 +469,13 @@ def get_ind_freqs(n_sites, n_tax, ind_map, vcf_file, min_depth, min_count, min_q
     #genotype_quality_array = np.array(list(genotype_quality_data.values()), dtype=np.uint8).transpose()
     #passing_filter_array = np.array(list(passing_filter_data.values()), dtype=np.bool_).transpose()
     
-    ab_dat = np.array([
-        allele_balance_data,
-        site_depth_data,
-        genotype_quality_data,
-        passing_filter_data
-    ])
-    
     #ab_df = pd.DataFrame(allele_balance_data)
     #print(ab_df)
-    logging.info(f'Array shape: {ab_dat.shape}')
-    logging.info(f'Memory usage: {ab_dat.nbytes / 1024 / 1024:.2f} MB')
+    logging.info(f'Array shape: {(ab_dat.n_sites, ab_dat.n_tax)}')
+    if scratch_dir is None:
+        logging.info(f'Memory usage: {ab_dat.nbytes / 1024 / 1024:.2f} MB')
+    else:
+        logging.info(f'Memory-mapped {ab_dat.nbytes / 1024 / 1024:.2f} MB in {scratch_dir}')
     logging.info(f'Processed VCF of {n_sites} for {n_tax}\n')
     return(tax_list, ab_dat)
 
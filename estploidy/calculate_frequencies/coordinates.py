@@ -0,0 +1,176 @@
+"""
+Compact chromosome and position tracking for parsed VCF sites
+"""
+import numpy as np
+
+CHROM_DTYPE = np.int32
+POS_DTYPE = np.uint32
+
+
+class SiteCoordinates:
+    """
+    The chromosome and position of each site. Chromosomes are stored as integer codes into a list of names,
+    so each site takes eight bytes no matter how long the chromosome names are.
+
+    Parameters:
+        chrom_names (list): the chromosome names in order of first appearance
+        chrom (np.array): int32 code of the chromosome of each site
+        pos (np.array): uint32 1-based position of each site
+    """
+    __slots__ = ['chrom_names', 'chrom', 'pos', '_index']
+
+    def __init__(self, chrom_names, chrom, pos):
+        self.chrom_names = chrom_names
+        self.chrom = chrom
+        self.pos = pos
+        self._index = None
+
+    @property
+    def n_sites(self):
+        return len(self.pos)
+
+    @property
+    def index(self):
+        """
+        The CoordinateIndex of the sites, built on first use.
+        """
+        if self._index is None:
+            self._index = CoordinateIndex(self)
+        return self._index
+
+    def select(self, sites):
+        """
+        Returns the coordinates of the selected sites, given as a slice or an array of rows.
+        """
+        return SiteCoordinates(self.chrom_names, self.chrom[sites], self.pos[sites])
+
+    def site_range(self, chrom, beg=0, end=None):
+        """
+        Returns the slice of site rows overlapping a 0-based half-open interval of a chromosome. See CoordinateIndex.site_range.
+        """
+        return self.index.site_range(chrom, beg, end)
+
+    def region_sites(self, region_map):
+        """
+        Returns the site rows overlapping any region of a region_map from estploidy.tabix.parse_regions, in order.
+        """
+        return self.index.region_sites(region_map)
+
+    def chromosomes(self, sites=slice(None)):
+        """
+        Returns the chromosome names of the selected sites as an array of strings.
+        """
+        return np.asarray(self.chrom_names, dtype=str)[self.chrom[sites]]
+
+    @classmethod
+    def concatenate(cls, parts):
+        """
+        Returns the coordinates of several parts in order, merging their chromosome names.
+        """
+        builder = CoordinateBuilder()
+        for part in parts:
+            codes = np.array([builder.code(name) for name in part.chrom_names], dtype=CHROM_DTYPE)
+            builder.chrom.append(codes[part.chrom] if len(codes) > 0 else part.chrom)
+            builder.pos.append(part.pos)
+        return builder.finalize()
+
+
+class CoordinateBuilder:
+    """
+    Collects the chromosomes and positions of blocks of sites, encoding chromosome names as they are seen.
+    """
+    def __init__(self):
+        self.chrom_names = []
+        self.chrom_codes = {}
+        self.chrom = []
+        self.pos = []
+
+    def code(self, name):
+        code = self.chrom_codes.get(name)
+        if code is None:
+            code = len(self.chrom_names)
+            self.chrom_codes[name] = code
+            self.chrom_names.append(name)
+        return code
+
+    def extend(self, chrom, pos):
+        """
+        Appends a block of sites given as an array of chromosome names and an array of positions.
+        """
+        if len(chrom) > 0:
+            unique_names, inverse = np.unique(chrom, return_inverse=True)
+            # Codes follow the order chromosomes first appear in the VCF rather than sorted order
+            first = np.full(len(unique_names), len(chrom))
+            np.minimum.at(first, inverse.reshape(-1), np.arange(len(chrom)))
+            codes = np.zeros(len(unique_names), dtype=CHROM_DTYPE)
+            for k in np.argsort(first, kind='stable'):
+                codes[k] = self.code(str(unique_names[k]))
+            self.chrom.append(codes[inverse.reshape(-1)])
+        self.pos.append(np.asarray(pos).astype(POS_DTYPE))
+
+    def finalize(self):
+        chrom = np.concatenate(self.chrom) if len(self.chrom) > 0 else np.empty(0, dtype=CHROM_DTYPE)
+        pos = np.concatenate(self.pos) if len(self.pos) > 0 else np.empty(0, dtype=POS_DTYPE)
+        return SiteCoordinates(self.chrom_names, chrom.astype(CHROM_DTYPE, copy=False), pos.astype(POS_DTYPE, copy=False))
+
+
+class CoordinateIndex:
+    """
+    A sorted index of site coordinates: a dictionary from chromosome name to code, the first row of each chromosome,
+    and the uint32 positions. Sites of a chromosome are contiguous and sorted by position in a sorted VCF,
+    so the rows overlapping any interval are found with two binary searches, without reading the VCF again.
+
+    Parameters:
+        coordinates (SiteCoordinates): the coordinates to index
+    """
+    __slots__ = ['chrom_codes', 'offsets', 'pos']
+
+    def __init__(self, coordinates):
+        chrom = np.asarray(coordinates.chrom)
+        self.pos = np.asarray(coordinates.pos)
+        self.chrom_codes = {name: code for code, name in enumerate(coordinates.chrom_names)}
+        # Codes follow the order of first appearance, so they increase by one at each change of chromosome in a sorted VCF
+        changes = np.flatnonzero(chrom[1:] != chrom[:-1]) + 1
+        starts = np.concatenate([[0], changes]) if len(chrom) > 0 else np.empty(0, dtype=np.intp)
+        if not np.array_equal(chrom[starts], np.arange(len(starts))):
+            raise ValueError('The sites of each chromosome must be contiguous to index coordinates. Is the VCF sorted?')
+        if np.any((self.pos[1:] < self.pos[:-1]) & (chrom[1:] == chrom[:-1])):
+            raise ValueError('The sites of each chromosome must be sorted by position to index coordinates. Is the VCF sorted?')
+        self.offsets = np.append(starts, len(chrom)).astype(np.intp)
+
+    def chromosome_range(self, chrom):
+        """
+        Returns the slice of site rows of a chromosome, which is empty for a chromosome without sites.
+        """
+        code = self.chrom_codes.get(chrom)
+        if code is None:
+            return slice(0, 0)
+        return slice(int(self.offsets[code]), int(self.offsets[code + 1]))
+
+    def site_range(self, chrom, beg=0, end=None):
+        """
+        Returns the slice of site rows overlapping a genomic interval.
+
+        Parameters:
+            chrom (string): the chromosome name
+            beg (int): the 0-based start of the interval
+            end (int): the 0-based exclusive end of the interval, or None for the end of the chromosome
+
+        Returns:
+            sites (slice): the rows of the sites with beg < pos <= end
+        """
+        rows = self.chromosome_range(chrom)
+        pos = self.pos[rows]
+        start = np.searchsorted(pos, beg, side='right')
+        stop = len(pos) if end is None else np.searchsorted(pos, end, side='right')
+        return slice(rows.start + int(start), rows.start + int(max(start, stop)))
+
+    def region_sites(self, region_map):
+        """
+        Returns the site rows overlapping any region of a region_map from estploidy.tabix.parse_regions, in order.
+        """
+        ranges = [self.site_range(chrom, beg, end) for chrom, intervals in region_map.items() for beg, end in intervals]
+        ranges = [r for r in ranges if r.stop > r.start]
+        if len(ranges) == 0:
+            return np.empty(0, dtype=np.intp)
+        return np.unique(np.concatenate([np.arange(r.start, r.stop) for r in ranges]))
@@ -0,0 +1,160 @@
+"""
+Export parsed genotypes as a long-format, column-oriented table partitioned by individual or chromosome
+"""
+import os
+import logging
+import importlib.util
+import numpy as np
+import pandas as pd
+from estploidy.calculate_frequencies.out_of_core import WORKING_SET_SIZE, BYTES_PER_CELL
+
+EXPORT_COLUMNS = ['individual', 'chrom', 'pos', 'ref_count', 'alt_count', 'genotype_quality', 'pass_filters']
+EXPORT_PARTITIONS = ['individual', 'chrom']
+
+
+def get_export_format():
+    """
+    Returns 'parquet' if pandas can write parquet files, otherwise 'npz' for compressed NumPy archives of the same columns.
+    """
+    for engine in ['pyarrow', 'fastparquet']:
+        if importlib.util.find_spec(engine) is not None:
+            return 'parquet'
+    return 'npz'
+
+
+def write_table(path, columns, individual_names, chrom_names, export_format):
+    """
+    Writes one partition of the long table. Individuals and chromosomes are written as categoricals in parquet,
+    and as integer codes with a separate array of names in npz archives.
+    """
+    if export_format == 'parquet':
+        df = pd.DataFrame(columns)
+        df['individual'] = pd.Categorical.from_codes(columns['individual'], categories=individual_names)
+        df['chrom'] = pd.Categorical.from_codes(columns['chrom'], categories=chrom_names)
+        df.to_parquet(f'{path}.parquet', index=False, compression='zstd')
+    else:
+        np.savez_compressed(f'{path}.npz', individual_names=np.array(individual_names, dtype=str), chrom_names=np.array(chrom_names, dtype=str), **columns)
+
+
+def long_columns(counts, sites, individuals, min_depth, min_count, min_qual):
+    """
+    Returns the long-format columns of a block of sites and individuals, one row per genotype with at least one read.
+
+    Parameters:
+        counts (AlleleCounts): read counts with coordinates
+        sites (slice or np.array): the rows of counts to include
+        individuals (slice or np.array): the columns of counts to include
+        min_depth (int): the minimum depth of a site to be considered high-quality
+        min_count (int): the minimum number of reads supporting the minor allele to be considered high-quality
+        min_qual (int): the minimum phred-scaled genotype likelihood to be considered high-quality
+    """
+    block = type(counts)(counts.tax_list, counts.ref_counts[sites][:, individuals], counts.alt_counts[sites][:, individuals], counts.genotype_quality[sites][:, individuals])
+    has_reads = block.total_counts() > 0
+    site_rows, individual_columns = np.nonzero(has_reads)
+    return {
+        'individual': np.arange(counts.n_tax, dtype=np.int32)[individuals][individual_columns],
+        'chrom': counts.coordinates.chrom[sites][site_rows],
+        'pos': counts.coordinates.pos[sites][site_rows],
+        'ref_count': block.ref_counts[has_reads],
+        'alt_count': block.alt_counts[has_reads],
+        'genotype_quality': block.genotype_quality[has_reads],
+        'pass_filters': block.filter(min_depth, min_count, min_qual)[has_reads]
+    }
+
+
+class PartitionWriter:
+    """
+    Buffers the rows of one partition of the long table and writes them as a new part whenever block_size rows are buffered.
+
+    Parameters:
+        partition_dir (string): the directory of the partition
+        individual_names (list): the names of the individual codes
+        chrom_names (list): the names of the chromosome codes
+        export_format (string): 'parquet' or 'npz'
+        block_size (int): the number of rows written per part
+    """
+    __slots__ = ['partition_dir', 'individual_names', 'chrom_names', 'export_format', 'block_size', 'buffered', 'n_rows', 'n_parts']
+
+    def __init__(self, partition_dir, individual_names, chrom_names, export_format, block_size):
+        self.partition_dir = partition_dir
+        self.individual_names = individual_names
+        self.chrom_names = chrom_names
+        self.export_format = export_format
+        self.block_size = block_size
+        self.buffered = []
+        self.n_rows = 0
+        self.n_parts = 0
+        os.makedirs(partition_dir, exist_ok=True)
+
+    def append(self, columns):
+        # Blocks without rows are only kept while nothing else is buffered, as the columns of a partition without rows
+        if (len(columns['pos']) == 0) and (len(self.buffered) > 0):
+            return
+        self.buffered.append(columns)
+        self.n_rows += len(columns['pos'])
+        if self.n_rows >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered rows as the next part. A partition without rows is written as one empty part.
+        """
+        if (self.n_rows == 0) and (self.n_parts > 0):
+            return
+        columns = {name: np.concatenate([block[name] for block in self.buffered]) for name in self.buffered[0]}
+        write_table(os.path.join(self.partition_dir, f'part-{self.n_parts:05d}'), columns, self.individual_names, self.chrom_names, self.export_format)
+        self.buffered = []
+        self.n_rows = 0
+        self.n_parts += 1
+
+
+def export_long_table(counts, min_depth, min_count, min_qual, export_dir, partition='individual', export_format=None, working_set=WORKING_SET_SIZE):
+    """
+    Writes the genotypes of every individual at every site as a long table with the columns
+    individual, chrom, pos, ref_count, alt_count, genotype_quality, and pass_filters.
+    Genotypes without reads are left out. Each partition is written to its own directory named partition=value,
+    so downstream tools can read only the individuals or chromosomes and the columns they need.
+
+    Parameters:
+        counts (AlleleCounts): read counts with coordinates from load_allele_counts
+        min_depth (int): the minimum depth of a site to be considered high-quality
+        min_count (int): the minimum number of reads supporting the minor allele to be considered high-quality
+        min_qual (int): the minimum phred-scaled genotype likelihood to be considered high-quality
+        export_dir (string): the directory where the table will be written
+        partition (string): 'individual' or 'chrom'
+        export_format (string): 'parquet' or 'npz'. Parquet is used by default when pyarrow or fastparquet is installed
+        working_set (int): the approximate bytes of memory used at a time
+    """
+    if partition not in EXPORT_PARTITIONS:
+        raise ValueError(f'Unsupported export partition {partition}. Use one of {EXPORT_PARTITIONS}.')
+    if export_format is None:
+        export_format = get_export_format()
+        if export_format == 'npz':
+            logging.warning('Neither pyarrow nor fastparquet is installed. Exporting compressed npz archives instead of parquet.')
+    coordinates = counts.coordinates
+    individual_names = list(counts.tax_list)
+    chrom_names = list(coordinates.chrom_names)
+    block_size = max(1, working_set // (max(counts.n_tax, 1) * BYTES_PER_CELL))
+    if partition == 'individual':
+        # Each block of sites is read once for every individual, since the counts are stored site-major and may be memory-mapped.
+        # The rows of each individual are buffered in its own writer, so the buffers together hold about one block
+        writers = [PartitionWriter(os.path.join(export_dir, f'individual={name}'), individual_names, chrom_names, export_format, block_size) for name in individual_names]
+        for start in range(0, max(counts.n_sites, 1), block_size):
+            columns = long_columns(counts, slice(start, start + block_size), slice(None), min_depth, min_count, min_qual)
+            # Rows are ordered by site and then individual, so a stable sort groups them by individual in site order
+            order = np.argsort(columns['individual'], kind='stable')
+            bounds = np.searchsorted(columns['individual'][order], np.arange(counts.n_tax + 1))
+            for i, writer in enumerate(writers):
+                rows = order[bounds[i]:bounds[i + 1]]
+                writer.append({name: values[rows] for name, values in columns.items()})
+        for writer in writers:
+            writer.flush()
+    else:
+        for code, name in enumerate(chrom_names):
+            partition_dir = os.path.join(export_dir, f'chrom={name}')
+            os.makedirs(partition_dir, exist_ok=True)
+            chrom_sites = np.flatnonzero(coordinates.chrom == code)
+            for part, start in enumerate(range(0, len(chrom_sites), block_size)):
+                columns = long_columns(counts, chrom_sites[start:start + block_size], slice(None), min_depth, min_count, min_qual)
+                write_table(os.path.join(partition_dir, f'part-{part:05d}'), columns, individual_names, chrom_names, export_format)
+    logging.info(f'Exported long-format genotypes partitioned by {partition} to {export_dir}')
@@ -0,0 +1,74 @@
+"""
+Disk-backed storage of parsed VCF arrays for cohorts that do not fit in memory
+"""
+import os
+import shutil
+import numpy as np
+
+# Default bytes of memory used at a time when building arrays from the parsed counts
+WORKING_SET_SIZE = 1024 * 1024 * 1024
+# Approximate bytes of temporary arrays held per genotype while computing allele balance and filters
+BYTES_PER_CELL = 32
+
+
+def spill_paths(prefix, n_arrays):
+    return [f'{prefix}.{k}.bin' for k in range(n_arrays)]
+
+
+def map_spill_files(paths, n_tax, dtypes, n_sites):
+    """
+    Returns read-only (n_sites, n_tax) memory maps of raw spill files.
+    """
+    if n_sites == 0:
+        return [np.empty((0, n_tax), dtype=dtype) for dtype in dtypes]
+    return [np.memmap(path, dtype=dtype, mode='r', shape=(n_sites, n_tax)) for path, dtype in zip(paths, dtypes)]
+
+
+class SpillSiteBlocks:
+    """
+    Storage for typed per-site arrays that appends every batch of rows to raw files on disk instead of keeping it in memory.
+    Has the extend and finalize methods of SiteBlocks, and finalize returns read-only memory maps of the files.
+
+    Parameters:
+        n_tax (int): the number of individuals (columns) in each array
+        dtypes (list): the numpy dtype of each array
+        prefix (string): the path prefix of the files. One file is written per dtype
+    """
+    def __init__(self, n_tax, dtypes, prefix):
+        self.n_tax = n_tax
+        self.dtypes = dtypes
+        self.paths = spill_paths(prefix, len(dtypes))
+        self.files = [open(path, 'wb') for path in self.paths]
+        self.n_sites = 0
+
+    def extend(self, arrays):
+        """
+        Appends a batch of rows given as one (n_rows, n_tax) array per dtype.
+        """
+        for fh, block, dtype in zip(self.files, arrays, self.dtypes):
+            np.ascontiguousarray(block, dtype=dtype).tofile(fh)
+        self.n_sites = self.n_sites + len(arrays[0])
+
+    def close(self):
+        for fh in self.files:
+            fh.close()
+
+    def finalize(self):
+        """
+        Closes the files and returns one read-only (n_sites, n_tax) memory map per dtype.
+        """
+        self.close()
+        return map_spill_files(self.paths, self.n_tax, self.dtypes, self.n_sites)
+
+
+def join_spill_files(prefixes, prefix, n_arrays):
+    """
+    Concatenates the row-major spill files of several prefixes in order into the files of one prefix and removes the parts.
+    """
+    for path, parts in zip(spill_paths(prefix, n_arrays), zip(*[spill_paths(part, n_arrays) for part in prefixes])):
+        with open(path, 'wb') as out_fh:
+            for part in parts:
+                with open(part, 'rb') as in_fh:
+                    shutil.copyfileobj(in_fh, out_fh, 16 * 1024 * 1024)
+                os.remove(part)
+
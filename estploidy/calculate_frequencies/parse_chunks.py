@@ -0,0 +1,291 @@
+"""
+Vectorized parsing of VCF records held as blocks of raw bytes
+"""
+import numpy as np
+
+# Bytes of whole records that are parsed together
+RECORD_CHUNK_SIZE = 4 * 1024 * 1024
+# Integer fields with more digits than this are treated as malformed
+MAX_DIGITS = 9
+# Positions may exceed the 9 digits allowed for read counts on very long chromosomes
+MAX_POS_DIGITS = 12
+
+TAB = ord('\t')
+NEWLINE = ord('\n')
+CARRIAGE_RETURN = ord('\r')
+COLON = ord(':')
+COMMA = ord(',')
+ZERO = ord('0')
+MISSING = ord('.')
+
+# Tabs ending the eight fixed columns before FORMAT, which are all that is read to reject a site
+SITE_TABS = 8
+# Bytes at the start of each line first scanned for the fixed columns
+SITE_WINDOW = 256
+
+# Read counts and genotype quality are stored clipped to these dtypes
+COUNT_DTYPES = [np.uint16, np.uint16, np.uint8]
+
+
+def get_format_fields(format_string):
+    '''
+    Returns the positions of the AD and GQ fields in the colon-separated genotype cells described by a FORMAT string.
+    A position is None if the field is not present.
+    '''
+    keys = format_string.split(':')
+    ad_index = keys.index('AD') if 'AD' in keys else None
+    gq_index = keys.index('GQ') if 'GQ' in keys else None
+    return ad_index, gq_index
+
+
+def iter_record_chunks(records, chunk_size=RECORD_CHUNK_SIZE):
+    '''
+    Yields blocks of whole vcf records as bytes, each block ending with a newline.
+
+    Parameters:
+        records: a binary file handle positioned after the header, or an iterable of lines as bytes or strings
+        chunk_size (int): the approximate number of bytes in each block
+    '''
+    if hasattr(records, 'read'):
+        while True:
+            data = records.read(chunk_size)
+            if len(data) == 0:
+                return
+            if not data.endswith(b'\n'):
+                # Finish the last record so a block never splits a line
+                data = data + records.readline()
+                if not data.endswith(b'\n'):
+                    data = data + b'\n'
+            yield data
+    batch = []
+    batch_size = 0
+    for line in records:
+        if isinstance(line, str):
+            line = line.encode()
+        line = line.rstrip(b'\r\n')
+        batch.append(line)
+        batch_size = batch_size + len(line) + 1
+        if batch_size >= chunk_size:
+            yield b'\n'.join(batch) + b'\n'
+            batch = []
+            batch_size = 0
+    if len(batch) > 0:
+        yield b'\n'.join(batch) + b'\n'
+
+
+def parse_uint(buf, start, end, max_digits=MAX_DIGITS):
+    '''
+    Returns the unsigned integers stored as ASCII digits between start and end positions of a byte array,
+    along with a mask of which fields were valid integers. Invalid fields are returned as 0.
+    '''
+    width = end - start
+    valid = (width >= 1) & (width <= max_digits)
+    value = np.zeros(start.shape, dtype=np.int64)
+    last = len(buf) - 1
+    for k in range(max_digits):
+        active = k < width
+        if not active.any():
+            break
+        digit = buf[np.minimum(start + k, last)].astype(np.int64) - ZERO
+        valid &= ~active | ((digit >= 0) & (digit <= 9))
+        value = np.where(active, value * 10 + digit, value)
+    return np.where(valid, value, 0), valid
+
+
+def subfield_bounds(colons, first_colon, cell_start, cell_end, index):
+    '''
+    Returns the start, end, and presence of a colon-separated subfield of each genotype cell.
+
+    Parameters:
+        colons (np.array): the sorted positions of every colon in the block, padded with sentinels past the end
+        first_colon (np.array): the index in colons of the first colon at or after each cell start
+        cell_start (np.array): the start of each cell
+        cell_end (np.array): the end of each cell
+        index (np.array): the subfield to find for each row of cells, or -1 if the FORMAT does not have it
+    '''
+    index = index[:, None]
+    subfield = np.maximum(index, 0)
+    previous_colon = colons[np.maximum(first_colon + subfield - 1, 0)]
+    start = np.where(subfield == 0, cell_start, previous_colon + 1)
+    end = np.minimum(colons[first_colon + subfield], cell_end)
+    present = (index >= 0) & ((subfield == 0) | (previous_colon < cell_end))
+    return start, end, present
+
+
+def gather_cells(buf, cell_start, cell_end):
+    '''
+    Returns the bytes of the selected cells packed into one array, each cell followed by a tab,
+    along with the start and end of every cell in the packed array.
+    Later scans then only touch the bytes of the individuals being processed.
+    '''
+    lengths = (cell_end - cell_start + 1).ravel()
+    offsets = np.cumsum(lengths) - lengths
+    source = np.repeat(cell_start.ravel() - offsets, lengths) + np.arange(lengths.sum())
+    packed = buf[np.minimum(source, len(buf) - 1)]
+    packed[offsets + lengths - 1] = TAB
+    return packed, offsets.reshape(cell_start.shape), (offsets + lengths - 1).reshape(cell_start.shape)
+
+
+def find_site_tabs(buf, line_starts, line_ends, n_tabs=SITE_TABS, window=SITE_WINDOW):
+    '''
+    Returns the positions of the first n_tabs tabs of each line as an (n_lines, n_tabs) array, or None if a line has fewer.
+    Only a window at the start of each line is scanned, widened for lines with longer fixed fields,
+    so finding the site columns does not depend on the number of genotype columns.
+    '''
+    site_tabs = np.empty((len(line_starts), n_tabs), dtype=np.int64)
+    todo = np.arange(len(line_starts))
+    while len(todo) > 0:
+        starts = line_starts[todo]
+        lengths = line_ends[todo] - starts
+        padded = np.concatenate([buf, np.zeros(window, dtype=np.uint8)])
+        heads = np.lib.stride_tricks.sliding_window_view(padded, window)[starts]
+        is_tab = (heads == TAB) & (np.arange(window) < lengths[:, None])
+        found = np.count_nonzero(is_tab, axis=1) >= n_tabs
+        if np.any(~found & (lengths <= window)):
+            return None
+        rows, cols = np.nonzero(is_tab[found])
+        # Keep the first n_tabs tabs of each line
+        first = (np.arange(len(rows)) - np.searchsorted(rows, rows)) < n_tabs
+        site_tabs[todo[found]] = starts[found][:, None] + cols[first].reshape(-1, n_tabs)
+        todo = todo[~found]
+        window = window * 4
+    return site_tabs
+
+
+def passing_sites(data, buf, site_tabs, pate_flag, site_filters=None):
+    '''
+    Returns a boolean mask of the records passing FILTER and the optional site-level thresholds,
+    read from the first eight columns of each record.
+    '''
+    filter_start = site_tabs[:, 5] + 1
+    filter_length = site_tabs[:, 6] - filter_start
+    passing = filter_length == 4
+    for k, byte in enumerate(b'PASS'):
+        passing &= buf[np.minimum(filter_start + k, len(buf) - 1)] == byte
+    if pate_flag == True:
+        passing |= (filter_length == 1) & (buf[filter_start] == MISSING)
+    if (site_filters is not None) and site_filters.active:
+        rows = np.flatnonzero(passing)
+        # The ALT, QUAL, and INFO columns lie between tabs 3 and 4, 4 and 5, and 6 and 7
+        bounds = site_tabs[rows][:, [3, 4, 4, 5, 6, 7]] + [1, 0, 1, 0, 1, 0]
+        passing[rows] = [site_filters.passes(data[a:b], data[c:d], data[e:f]) for a, b, c, d, e, f in bounds.tolist()]
+    return passing
+
+
+def parse_record_chunk(data, columns, out_columns, n_tax, pate_flag, format_cache, site_offset=0, vcf_map=None, coordinates=None, site_filters=None):
+    '''
+    Returns typed arrays of reference and alternate read counts and genotype quality for the passing records in a block of bytes.
+    Records are checked against FILTER and the site-level thresholds from their first eight columns,
+    and only the records that pass are scanned further. Field boundaries and the AD and GQ integers
+    are then found for all cells of the block at once with numpy.
+
+    Parameters:
+        data (bytes): whole tab-delimited vcf records, each ending with a newline
+        columns (list): the sorted VCF columns of the individuals to process
+        out_columns (list): the column in the returned arrays for each of the VCF columns
+        n_tax (int): the number of columns in the returned arrays
+        pate_flag (bool): is the VCF a direct product of the PATE pipeline
+        format_cache (dict): maps FORMAT strings as bytes to the AD and GQ positions; filled as new FORMAT strings are seen
+        site_offset (int): the number of sites parsed before this block, used in warnings
+        vcf_map (dict): maps VCF columns to individual labels, used in warnings
+        coordinates (list): if given, the chromosomes and positions of the passing records are appended as a (chrom, pos) tuple of arrays
+        site_filters (SiteFilters): optional thresholds on QUAL, ALT, and INFO/DP
+
+    Returns:
+        arrays (list): (n_sites, n_tax) arrays of reference counts, alternate counts, and genotype quality, clipped to their dtypes,
+            or None if the records are not uniformly tab-delimited and must be parsed line by line
+    '''
+    buf = np.frombuffer(data, dtype=np.uint8)
+    line_ends = np.flatnonzero(buf == NEWLINE)
+    line_starts = np.concatenate([[0], line_ends[:-1] + 1]).astype(np.int64) if len(line_ends) > 0 else line_ends
+    site_tabs = find_site_tabs(buf, line_starts, line_ends)
+    if site_tabs is None:
+        return None
+    rows = np.flatnonzero(passing_sites(data, buf, site_tabs, pate_flag, site_filters))
+    if len(rows) < len(line_ends):
+        # Pack the passing records so the genotype columns of rejected records are never scanned
+        view = memoryview(data)
+        data = b''.join([view[start:end + 1] for start, end in zip(line_starts[rows].tolist(), line_ends[rows].tolist())])
+        buf = np.frombuffer(data, dtype=np.uint8)
+        line_ends = np.cumsum(line_ends[rows] - line_starts[rows] + 1) - 1
+        line_starts = np.concatenate([[0], line_ends[:-1] + 1]).astype(np.int64) if len(line_ends) > 0 else line_ends
+    n_lines = len(line_ends)
+    if n_lines == 0:
+        if coordinates is not None:
+            coordinates.append((np.empty(0, dtype=str), np.empty(0, dtype=np.int64)))
+        return [np.empty((0, n_tax), dtype=dtype) for dtype in COUNT_DTYPES]
+    tabs = np.flatnonzero(buf == TAB)
+    n_tabs = int(np.searchsorted(tabs, line_ends[0]))
+    columns = np.asarray(columns, dtype=np.int64)
+    if (n_tabs < 9) or (len(tabs) != n_tabs * n_lines) or ((len(columns) > 0) and (columns[-1] > n_tabs)):
+        return None
+    tabs = tabs.reshape(n_lines, n_tabs)
+    # Every line must hold exactly n_tabs tabs for the reshape to line up fields
+    if np.any(tabs[:, 0] < line_starts) or np.any(tabs[:, -1] >= line_ends):
+        return None
+    n_rows = n_lines
+    if coordinates is not None:
+        chrom = [data[start:end].decode() for start, end in zip(line_starts.tolist(), tabs[:, 0].tolist())]
+        pos, _ = parse_uint(buf, tabs[:, 0] + 1, tabs[:, 1], MAX_POS_DIGITS)
+        coordinates.append((np.array(chrom, dtype=str), pos))
+
+    # Resolve the positions of AD and GQ once per distinct FORMAT string
+    ad_list = []
+    gq_list = []
+    for format_start, format_end in zip((tabs[:, 7] + 1).tolist(), tabs[:, 8].tolist()):
+        format_string = data[format_start:format_end]
+        format_fields = format_cache.get(format_string)
+        if format_fields is None:
+            format_fields = get_format_fields(format_string.decode())
+            format_cache[format_string] = format_fields
+        ad_list.append(-1 if format_fields[0] is None else format_fields[0])
+        gq_list.append(-1 if format_fields[1] is None else format_fields[1])
+    ad_index = np.array(ad_list, dtype=np.int64)
+    gq_index = np.array(gq_list, dtype=np.int64)
+
+    # Windows line endings are not part of the last field
+    line_ends = line_ends - (buf[np.maximum(line_ends - 1, 0)] == CARRIAGE_RETURN)
+    field_ends = np.concatenate([tabs, line_ends[:, None]], axis=1)
+    cell_start = field_ends[:, columns - 1] + 1
+    cell_end = field_ends[:, columns]
+    genotypes = buf
+    if (cell_end - cell_start).sum() < len(buf) // 2:
+        # Only a subset of the individuals is kept, so pack their cells before scanning for colons and commas
+        genotypes, cell_start, cell_end = gather_cells(buf, cell_start, cell_end)
+
+    n_pad = int(max(ad_index.max(initial=0), gq_index.max(initial=0))) + 2
+    colons = np.concatenate([np.flatnonzero(genotypes == COLON), np.full(n_pad, len(genotypes))])
+    first_colon = np.searchsorted(colons, cell_start)
+    ad_start, ad_end, ad_present = subfield_bounds(colons, first_colon, cell_start, cell_end, ad_index)
+    gq_start, gq_end, gq_present = subfield_bounds(colons, first_colon, cell_start, cell_end, gq_index)
+
+    commas = np.concatenate([np.flatnonzero(genotypes == COMMA), np.full(2, len(genotypes))])
+    # A missing AD in the last cell of a block starts past the end, so its comma index is kept on the sentinels
+    first_comma = np.minimum(np.searchsorted(commas, ad_start), len(commas) - 2)
+    ref_end = commas[first_comma]
+    has_comma = ref_end < ad_end
+    ref_counts, ref_valid = parse_uint(genotypes, ad_start, np.minimum(ref_end, ad_end))
+    alt_counts, alt_valid = parse_uint(genotypes, ref_end + 1, np.minimum(commas[first_comma + 1], ad_end))
+    ad_valid = ad_present & has_comma & ref_valid & alt_valid
+    ref_counts = np.where(ad_valid, ref_counts, 0)
+    alt_counts = np.where(ad_valid, alt_counts, 0)
+    genotype_quality, gq_valid = parse_uint(genotypes, gq_start, gq_end)
+    genotype_quality = np.where(ad_present & gq_present, genotype_quality, 0)
+
+    malformed = ad_present & ~ad_valid & ~((ad_end - ad_start == 1) & (genotypes[np.minimum(ad_start, len(genotypes) - 1)] == MISSING))
+    if malformed.any():
+        for row, k in zip(*np.nonzero(malformed)):
+            temp = data[line_starts[row]:tabs[row, 1]].decode().split('\t')
+            label = vcf_map[int(columns[k])] if vcf_map is not None else int(columns[k])
+            print(f'WARNING: Incorrectly formatted VCF fields!\n--> {label} at variant {site_offset + row}\n-->{temp[0]}: {temp[1]}\n')
+
+    values = [np.minimum(value, np.iinfo(dtype).max).astype(dtype) for value, dtype in zip([ref_counts, alt_counts, genotype_quality], COUNT_DTYPES)]
+    out_columns = np.asarray(out_columns, dtype=np.int64)
+    if np.array_equal(out_columns, np.arange(n_tax)):
+        return values
+    arrays = []
+    for value in values:
+        array = np.zeros((n_rows, n_tax), dtype=value.dtype)
+        array[:, out_columns] = value
+        arrays.append(array)
+    return arrays
@@ -0,0 +1,200 @@
+"""
+Typed per-site data returned by get_ind_freqs
+"""
+import os
+import numpy as np
+from estploidy.calculate_frequencies.allele_counts import AlleleCounts
+from estploidy.calculate_frequencies.out_of_core import WORKING_SET_SIZE, BYTES_PER_CELL
+
+SITE_FIELDS = ['allele_balance', 'depth', 'genotype_quality', 'pass_filters']
+SITE_DTYPES = [np.float32, np.uint16, np.uint8, np.bool_]
+# Sites copied at a time when transposing a block of sites into individual-major fields
+TRANSPOSE_TILE_SIZE = 4096
+
+
+class SiteData:
+    """
+    Allele balance, depth, genotype quality, and filter indicators of each individual at each site.
+    Each field is an (n_sites, n_tax) array kept in its own dtype, so nothing is upcast into a single stacked array.
+    Fields built by build_site_data are stored individual-major (Fortran order), so the sites of one individual,
+    field[:, i], are one contiguous range of memory.
+    Indexing with the position of a field, such as site_data[0, :, i], reads from that field as the former stacked array did.
+
+    Parameters:
+        tax_list (list): A list of individual labels, one per column
+        allele_balance (np.array): float32 fraction of reads supporting the alternate allele
+        depth (np.array): uint16 read depth
+        genotype_quality (np.array): uint8 phred-scaled genotype quality
+        pass_filters (np.array): bool indicators of genotypes passing the depth, count, and quality filters
+        coordinates (SiteCoordinates): optional chromosome and position of each site
+        sampled_allele_balance (list): optional allele balance of a sample of the passing sites of each individual, in site order,
+            from a PassingSample kept while the fields were built. The fields and filters hold every site either way
+    """
+    __slots__ = ['tax_list', 'allele_balance', 'depth', 'genotype_quality', 'pass_filters', 'coordinates', 'sampled_allele_balance']
+
+    def __init__(self, tax_list, allele_balance, depth, genotype_quality, pass_filters, coordinates=None, sampled_allele_balance=None):
+        self.tax_list = tax_list
+        self.allele_balance = allele_balance
+        self.depth = depth
+        self.genotype_quality = genotype_quality
+        self.pass_filters = pass_filters
+        self.coordinates = coordinates
+        self.sampled_allele_balance = sampled_allele_balance
+
+    @property
+    def n_sites(self):
+        return self.allele_balance.shape[0]
+
+    @property
+    def n_tax(self):
+        return self.allele_balance.shape[1]
+
+    @property
+    def nbytes(self):
+        return sum(field.nbytes for field in self.fields())
+
+    def fields(self):
+        return [getattr(self, name) for name in SITE_FIELDS]
+
+    def passing_allele_balance(self, i):
+        """
+        Returns the allele balance of the passing sites of the individual in column i.
+        """
+        return self.allele_balance[:, i][self.pass_filters[:, i]]
+
+    def select(self, sites):
+        """
+        Returns the SiteData of the selected sites, given as a slice or an array of rows.
+        Slices, such as those from coordinates.site_range, return views without copying the fields.
+        Samples of passing sites are not carried over, since they were drawn from every site.
+        """
+        coordinates = None if self.coordinates is None else self.coordinates.select(sites)
+        return SiteData(self.tax_list, *[field[sites] for field in self.fields()], coordinates=coordinates)
+
+    def region(self, chrom, beg=0, end=None):
+        """
+        Returns the SiteData of the sites overlapping a 0-based half-open interval of a chromosome.
+        """
+        return self.select(self.coordinates.site_range(chrom, beg, end))
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self.fields()[key[0]][key[1:]]
+        return self.fields()[key]
+
+
+class PassingSample:
+    """
+    A uniform random sample of up to max_sites passing sites of each individual, kept a block of sites at a time.
+    Each passing site of the individual in column i draws a random key from a generator seeded with (seed, i), and the sample holds
+    the sites with the smallest keys. The sample therefore depends only on the seed and the passing sites of the individual,
+    not on the size of the blocks. Only sites with keys below the largest key kept so far are buffered,
+    and the buffer is cut back to max_sites whenever it reaches twice that, so memory stays bounded by max_sites.
+
+    Parameters:
+        n_tax (int): the number of individuals
+        max_sites (int): the most passing sites kept per individual
+        seed (int): the seed of the sample
+    """
+    __slots__ = ['max_sites', 'rngs', 'keys', 'sites', 'values', 'n_buffered', 'thresholds']
+
+    def __init__(self, n_tax, max_sites, seed=0):
+        if max_sites < 1:
+            raise ValueError(f'max_sites must be at least 1, not {max_sites}!')
+        self.max_sites = max_sites
+        self.rngs = [np.random.default_rng([seed, i]) for i in range(n_tax)]
+        self.keys = [[] for i in range(n_tax)]
+        self.sites = [[] for i in range(n_tax)]
+        self.values = [[] for i in range(n_tax)]
+        self.n_buffered = [0] * n_tax
+        self.thresholds = [np.inf] * n_tax
+
+    def extend(self, start, allele_balance, pass_filters):
+        """
+        Adds the passing sites of a block of rows starting at site start, given its (n_sites, n_tax) allele balance and filters.
+        """
+        # Passing cells are found in individual-major order, so the rows of each individual are one slice
+        columns, rows = np.nonzero(pass_filters.T)
+        bounds = np.searchsorted(columns, np.arange(len(self.rngs) + 1))
+        for i, rng in enumerate(self.rngs):
+            ind_rows = rows[bounds[i]:bounds[i + 1]]
+            if len(ind_rows) == 0:
+                continue
+            keys = rng.random(len(ind_rows))
+            kept = keys < self.thresholds[i]
+            self.keys[i].append(keys[kept])
+            self.sites[i].append(ind_rows[kept] + start)
+            self.values[i].append(allele_balance[ind_rows[kept], i])
+            self.n_buffered[i] += int(kept.sum())
+            if self.n_buffered[i] >= 2 * self.max_sites:
+                self._compact(i)
+
+    def _compact(self, i):
+        keys = np.concatenate(self.keys[i]) if len(self.keys[i]) > 0 else np.empty(0)
+        sites = np.concatenate(self.sites[i]) if len(self.sites[i]) > 0 else np.empty(0, dtype=np.intp)
+        values = np.concatenate(self.values[i]) if len(self.values[i]) > 0 else np.empty(0, dtype=np.float32)
+        if len(keys) > self.max_sites:
+            kept = np.argpartition(keys, self.max_sites - 1)[:self.max_sites]
+            keys, sites, values = keys[kept], sites[kept], values[kept]
+            self.thresholds[i] = keys.max()
+        self.keys[i], self.sites[i], self.values[i] = [keys], [sites], [values]
+        self.n_buffered[i] = len(keys)
+
+    def samples(self):
+        """
+        Returns the allele balance of the sampled sites of each individual, in site order.
+        """
+        samples = []
+        for i in range(len(self.rngs)):
+            self._compact(i)
+            samples.append(self.values[i][0][np.argsort(self.sites[i][0], kind='stable')])
+        return samples
+
+
+def build_site_data(counts, min_depth, min_count, min_qual, scratch_dir=None, working_set=WORKING_SET_SIZE, max_sites=None, seed=0):
+    """
+    Returns the allele balance, depth, genotype quality, and filters computed from read counts as SiteData.
+    Fields are filled a block of sites at a time, so temporary arrays are bounded by the working set.
+    Every field is stored individual-major, so reading the sites of one individual reads a contiguous range of memory,
+    or of its file when a scratch directory is given, and each field is then a read-only memory map.
+
+    Parameters:
+        counts (AlleleCounts): the read counts and genotype qualities of each individual at each site
+        min_depth (int): the minimum depth of a site to be considered high-quality
+        min_count (int): the minimum number of reads supporting the minor allele to be considered high-quality
+        min_qual (int): the minimum phred-scaled genotype likelihood to be considered high-quality
+        scratch_dir (string): optional directory holding the memory-mapped fields
+        working_set (int): the approximate bytes of memory to use at a time
+        max_sites (int): optional maximum number of passing sites per individual kept in sampled_allele_balance with a PassingSample.
+            The fields and filters are left unchanged
+        seed (int): the seed of the sample of passing sites
+
+    Returns:
+        site_data (SiteData): the typed fields of each individual at each site
+    """
+    n_sites, n_tax = counts.n_sites, counts.n_tax
+    mapped = (scratch_dir is not None) and (n_sites > 0) and (n_tax > 0)
+    if mapped:
+        paths = [os.path.join(scratch_dir, f'{name}.bin') for name in SITE_FIELDS]
+        fields = [np.memmap(path, dtype=dtype, mode='w+', shape=(n_tax, n_sites)).T for path, dtype in zip(paths, SITE_DTYPES)]
+    else:
+        fields = [np.empty((n_tax, n_sites), dtype=dtype).T for dtype in SITE_DTYPES]
+    block_size = max(1, working_set // (max(n_tax, 1) * BYTES_PER_CELL))
+    sample = None if max_sites is None else PassingSample(n_tax, max_sites, seed)
+    for start in range(0, n_sites, block_size):
+        end = min(start + block_size, n_sites)
+        block = AlleleCounts(counts.tax_list, counts.ref_counts[start:end], counts.alt_counts[start:end], counts.genotype_quality[start:end])
+        values = [block.allele_balance(), block.depth(), block.genotype_quality, block.filter(min_depth, min_count, min_qual)]
+        if sample is not None:
+            sample.extend(start, values[0], values[3])
+        for field, value in zip(fields, values):
+            # Rows are transposed into the individual-major fields a tile at a time to stay in cache
+            for tile_start in range(start, end, TRANSPOSE_TILE_SIZE):
+                tile_end = min(tile_start + TRANSPOSE_TILE_SIZE, end)
+                field[tile_start:tile_end] = value[tile_start - start:tile_end - start]
+    if mapped:
+        for field in fields:
+            field.base.flush()
+        fields = [np.memmap(path, dtype=dtype, mode='r', shape=(n_tax, n_sites)).T for path, dtype in zip(paths, SITE_DTYPES)]
+    sampled_allele_balance = None if sample is None else sample.samples()
+    return SiteData(counts.tax_list, *fields, coordinates=counts.coordinates, sampled_allele_balance=sampled_allele_balance)
@@ -0,0 +1,79 @@
+"""
+Site-level thresholds checked on the fixed columns of a VCF record before its genotypes are parsed
+"""
+
+
+def info_value(info, key):
+    """
+    Returns the value of a key in a semicolon-separated INFO field as bytes, or None if the key is missing or is a flag.
+    """
+    prefix = key + b'='
+    for item in info.split(b';'):
+        if item.startswith(prefix):
+            return item[len(prefix):]
+    return None
+
+
+class SiteFilters:
+    """
+    Optional thresholds on the QUAL, ALT, and INFO/DP columns of a record. Records failing any threshold are dropped
+    along with records failing FILTER, before any genotype column is read. A site with a missing QUAL or INFO/DP
+    fails the corresponding threshold.
+
+    Parameters:
+        min_quality (float): the minimum site QUAL
+        min_depth (int): the minimum combined depth in INFO/DP
+        max_alt_alleles (int): the maximum number of alternate alleles listed in ALT
+    """
+    __slots__ = ['min_quality', 'min_depth', 'max_alt_alleles']
+
+    def __init__(self, min_quality=None, min_depth=None, max_alt_alleles=None):
+        self.min_quality = min_quality
+        self.min_depth = min_depth
+        self.max_alt_alleles = max_alt_alleles
+
+    @property
+    def active(self):
+        return any(value is not None for value in self.settings().values())
+
+    def settings(self):
+        """
+        Returns the thresholds as a dict, used to tell cached arrays parsed with different thresholds apart.
+        """
+        return {'min_quality': self.min_quality, 'min_depth': self.min_depth, 'max_alt_alleles': self.max_alt_alleles}
+
+    def passes(self, alt, qual, info):
+        """
+        Returns True if a record passes every threshold.
+
+        Parameters:
+            alt (bytes): the ALT column
+            qual (bytes): the QUAL column
+            info (bytes): the INFO column
+        """
+        if self.max_alt_alleles is not None:
+            n_alt = 0 if alt == b'.' else alt.count(b',') + 1
+            if n_alt > self.max_alt_alleles:
+                return False
+        if self.min_quality is not None:
+            try:
+                if float(qual) < self.min_quality:
+                    return False
+            except ValueError:
+                return False
+        if self.min_depth is not None:
+            depth = info_value(info, b'DP')
+            try:
+                if (depth is None) or (int(depth) < self.min_depth):
+                    return False
+            except ValueError:
+                return False
+        return True
+
+
+def make_site_filters(min_quality=None, min_depth=None, max_alt_alleles=None):
+    """
+    Returns SiteFilters for the given thresholds, or None if no threshold is set.
+    """
+    site_filters = SiteFilters(min_quality, min_depth, max_alt_alleles)
+    return site_filters if site_filters.active else None
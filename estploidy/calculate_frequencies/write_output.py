@@ -0,0 +1,106 @@
+"""
+Write the per-individual allele balance files with vectorized formatting
+"""
+import numpy as np
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from estploidy.utils import iter_bounded_results
+
+OUTPUT_HEADER = 'allele_balance\tdepth\tgenotype_quality\tpass_filters\n'
+# Sites formatted at a time for each file, which bounds the memory of the formatted bytes
+WRITE_BLOCK_SIZE = 1024 * 1024
+
+
+def _make_table(strings, separator):
+    """
+    Returns formatted values followed by a separator as a zero-padded uint8 table, and a mask of the real bytes of each entry.
+    """
+    strings = np.char.add(np.asarray(strings).astype(np.bytes_), separator.encode())
+    table = strings.view(np.uint8).reshape(len(strings), -1)
+    mask = np.arange(table.shape[1]) < np.char.str_len(strings)[:, None]
+    return table, mask
+
+
+@lru_cache(maxsize=None)
+def _fixed_table(dtype, separator):
+    """
+    Returns the table of every value of a bool or small integer dtype, so a column is formatted by indexing with its values.
+    """
+    values = np.array([False, True]) if dtype == np.bool_ else np.arange(np.iinfo(dtype).max + 1, dtype=dtype)
+    return _make_table(values.astype(str), separator)
+
+
+def _format_column(values, separator):
+    """
+    Returns the table and mask of a column along with the table row of every value.
+    Values are formatted as the f-strings of their numpy scalars, which for floats is the repr of the value as a Python float.
+    """
+    if (values.dtype == np.bool_) or (values.dtype.kind == 'u' and values.dtype.itemsize <= 2):
+        table, mask = _fixed_table(values.dtype.type, separator)
+        return table, mask, values.astype(np.intp)
+    unique_values, codes = np.unique(values, return_inverse=True)
+    if unique_values.dtype.kind == 'f':
+        unique_values = unique_values.astype(np.float64)
+    table, mask = _make_table(unique_values.astype(str), separator)
+    return table, mask, codes.reshape(-1)
+
+
+def format_columns(columns):
+    """
+    Returns the lines of tab-delimited columns as bytes, one line per row.
+    Each distinct value is formatted once, the padded bytes of every field of a line are laid out side by side,
+    and the padding is dropped with a single boolean mask.
+
+    Parameters:
+        columns (list): 1-D arrays of the same length, one per column
+
+    Returns:
+        data (bytes): the formatted lines, each ending with a newline
+    """
+    if len(columns[0]) == 0:
+        return b''
+    fields = []
+    masks = []
+    for k, values in enumerate(columns):
+        table, mask, codes = _format_column(np.asarray(values), '\n' if k == len(columns) - 1 else '\t')
+        fields.append(table[codes])
+        masks.append(mask[codes])
+    return np.concatenate(fields, axis=1)[np.concatenate(masks, axis=1)].tobytes()
+
+
+def write_columns(output_file, columns, block_size=WRITE_BLOCK_SIZE):
+    """
+    Writes the allele balance, depth, genotype quality, and filter indicator columns of one individual to a file.
+
+    Parameters:
+        output_file (string): the path of the file to write
+        columns (list): the 1-D arrays of the individual in the order of OUTPUT_HEADER
+        block_size (int): the number of sites formatted at a time
+    """
+    n_sites = len(columns[0])
+    with open(output_file, 'wb') as outfile:
+        outfile.write(OUTPUT_HEADER.encode())
+        for start in range(0, n_sites, block_size):
+            outfile.write(format_columns([column[start:start + block_size] for column in columns]))
+
+
+def write_individual_files(output_dir, site_data, threads=1):
+    """
+    Writes one file per individual to output_dir. With more than one thread, the files of different individuals
+    are formatted and written concurrently by a pool of worker processes, with a few individuals' columns queued per worker.
+
+    Parameters:
+        output_dir (string): the directory where all results will be written
+        site_data (SiteData): the data returned by get_ind_freqs
+        threads (int): the number of worker processes
+    """
+    output_files = [f'{output_dir}/{tax}.txt' for tax in site_data.tax_list]
+    if threads <= 1:
+        for i, output_file in enumerate(output_files):
+            write_columns(output_file, [field[:, i] for field in site_data.fields()])
+        return
+    # Columns are copied so only the sites of one individual are sent to a worker
+    calls = ((i, write_columns, (output_file, [np.ascontiguousarray(field[:, i]) for field in site_data.fields()])) for i, output_file in enumerate(output_files))
+    with ProcessPoolExecutor(max_workers=threads) as pool:
+        for _ in iter_bounded_results(pool, calls, threads):
+            pass
@@ -2,10 +2,23 @@ import numpy as np
 import sys
 import pandas as pd
 import logging
+from concurrent.futures import ProcessPoolExecutor
+from threadpoolctl import threadpool_limits
+from estploidy.utils import iter_bounded_results
 from estploidy.fit_mixtures.plot_mixtures import plot_gmm_fit_sklearn
 from estploidy.fit_mixtures.gmm import GaussianMixture
 from estploidy.fit_mixtures.gmm import GaussianMixtureFixedMeans
 from estploidy.fit_mixtures.gmm import GaussianMixtureFixedMeansFixedWeights
+from estploidy.fit_mixtures.gmm_1d import GaussianMixture1DFixedMeans, GaussianMixture1DFixedMeansFixedWeights
+from estploidy.fit_mixtures.gmm_1d import pack_samples, fit_fixed_means_batched, bin_samples
+
+# Implementations of the mixtures with fixed means, and with fixed means and weights
+GMM_BACKENDS = {
+    'em1d': (GaussianMixture1DFixedMeans, GaussianMixture1DFixedMeansFixedWeights),
+    'sklearn': (GaussianMixtureFixedMeans, GaussianMixtureFixedMeansFixedWeights)
+}
+# The most samples fitted together in a batch. Batches of about this size stay in cache, and larger individuals are fitted alone
+BATCH_SAMPLES = 1 << 15
 
 def get_fixed_params(n_components):
     means = None
@@ -31,7 +44,21 @@ def get_fixed_params(n_components):
             weights = np.array([1/6,1/6,2/6,1/6,1/6])
     return(means, weights)
 
-def fit_gmm_to_ab(ind_name, dat, ploidy, model_constraints, output_dir):
+def write_gmm_fit(outfile, ploidy, gmm, score, bic):
+    """
+    Write the fitted parameters, likelihood, and BIC of the model for one ploidy to an individual's fit file.
+    """
+    outfile.write(f'Model for ploidy = {ploidy}\n')
+    outfile.write("Fitted GMM parameters:\n")
+    outfile.write(f'Means:\n {gmm.means_}\n')
+    outfile.write(f'Covariances:\n {gmm.covariances_}\n')
+    outfile.write(f'Weights:\n {gmm.weights_}\n')
+    # Print the best likelihood
+    outfile.write(f'Best likelihood: {score}\n')
+    outfile.write(f'BIC: {bic}\n')
+    outfile.write('\n')
+
+def fit_gmm_to_ab(ind_name, dat, ploidy, model_constraints, output_dir, backend='em1d', init_params='means', bin_width=None):
     """
     Fit Gaussian Mixture Model (GMM) to allele balance data.
     
@@ -39,7 +66,21 @@ def fit_gmm_to_ab(ind_name, dat, ploidy, model_constraints, output_dir):
         ind_name (string): The name of the individual
         dat (np.array): Allele balance data.
         n_components (int): Number of components in the GMM.
+        backend (string): 'em1d' fits the constrained mixtures with the closed-form one-dimensional EM in gmm_1d,
+            and 'sklearn' with the scikit-learn based classes. Unconstrained mixtures always use scikit-learn
+        init_params (string): The initialization of the constrained mixtures. 'means' starts from responsibilities of the fixed means
+            and 'kmeans' from a k-means clustering. Unconstrained mixtures always start from k-means
+        bin_width (float): Fit the constrained em1d mixtures to a histogram of the data weighted by counts. 0 merges identical values,
+            which leaves the likelihood unchanged, and a positive width merges values in bins of that width. None fits every site
     """
+    if backend not in GMM_BACKENDS:
+        raise ValueError(f'Unsupported backend {backend}. Use one of {list(GMM_BACKENDS)}.')
+    FixedMeans, FixedMeansFixedWeights = GMM_BACKENDS[backend]
+    counts = None
+    if bin_width is not None:
+        if (backend != 'em1d') or (model_constraints not in (1, 2)):
+            raise ValueError('Binned fits require the em1d backend with fixed means.')
+        bins, counts = bin_samples(dat, bin_width)
     # Fit GMM to allele balance data
     best_n = 1
     best_bic = np.inf
@@ -53,21 +94,18 @@ def fit_gmm_to_ab(ind_name, dat, ploidy, model_constraints, output_dir):
         if model_constraints == 0:
             gmm = GaussianMixture(n_components = n_components)
         if model_constraints == 1:
-            gmm = GaussianMixtureFixedMeans(n_components = n_components, means_init = means)
+            gmm = FixedMeans(n_components = n_components, means_init = means, init_params = init_params)
         if model_constraints == 2:
-            gmm = GaussianMixtureFixedMeansFixedWeights(n_components = n_components, means_init = means, weights_init = weights)
-        gmm.fit(dat)
-        score = gmm.score(dat)
-        bic = gmm.bic(dat)
-        outfile.write(f'Model for ploidy = {ploidy[i]}\n')
-        outfile.write("Fitted GMM parameters:\n")
-        outfile.write(f'Means:\n {gmm.means_}\n')
-        outfile.write(f'Covariances:\n {gmm.covariances_}\n')
-        outfile.write(f'Weights:\n {gmm.weights_}\n')
-        # Print the best likelihood
-        outfile.write(f'Best likelihood: {score}\n')
-        outfile.write(f'BIC: {bic}\n')
-        outfile.write('\n')
+            gmm = FixedMeansFixedWeights(n_components = n_components, means_init = means, weights_init = weights, init_params = init_params)
+        if counts is None:
+            gmm.fit(dat)
+            score = gmm.score(dat)
+            bic = gmm.bic(dat)
+        else:
+            gmm.fit(bins, sample_weight = counts)
+            score = gmm.score(bins, sample_weight = counts)
+            bic = gmm.bic(bins, sample_weight = counts)
+        write_gmm_fit(outfile, ploidy[i], gmm, score, bic)
         # only consider a 3.2 point difference via Kass and Raftery 1995
         if bic < (best_bic - 3.2):
             best_bic = bic
@@ -83,57 +121,220 @@ def fit_gmm_to_ab(ind_name, dat, ploidy, model_constraints, output_dir):
 
     return(best_n)
 
-def est_ploidy(tax_list, ab_dat, method, ploidy_levels, minimum_sites, model_constraints, output_dir):
+def fit_gmm_to_ab_batched(ind_names, dats, ploidy, model_constraints, output_dir, bin_width=None):
+    """
+    Fit the constrained mixtures of fit_gmm_to_ab to many individuals at once. For each ploidy, the allele balance data of every
+    individual are packed together and fitted in one vectorized EM, which gives the same fits as fitting each individual with
+    the em1d backend started from the means. The fit files and plots of each individual are the same as from fit_gmm_to_ab.
+    
+    Parameters:
+        ind_names (list): The names of the individuals
+        dats (list): The allele balance data of each individual
+        ploidy (list): The ploidies to test
+        model_constraints (int): 1 to constrain the means, or 2 to constrain the means and weights
+        output_dir (str): The output directory where all results will be directed
+        bin_width (float): Fit the histogram of each individual's data as in fit_gmm_to_ab. None fits every site
+    
+    Returns:
+        best_ns: The best ploidy of each individual
+    """
+    if model_constraints not in (1, 2):
+        raise ValueError(f'Batched fits require fixed means, but got model_constraints = {model_constraints}.')
+    counts = None
+    if bin_width is None:
+        values, offsets = pack_samples(dats)
+    else:
+        histograms = [bin_samples(dat, bin_width) for dat in dats]
+        values, offsets = pack_samples([histogram[0] for histogram in histograms])
+        counts, _ = pack_samples([histogram[1] for histogram in histograms])
+    fits = []
+    for i in range(0, len(ploidy)):
+        means, weights = get_fixed_params(ploidy[i] - 1)
+        if model_constraints == 1:
+            fits.append(fit_fixed_means_batched(values, offsets, means, sample_weight = counts))
+        else:
+            fits.append(fit_fixed_means_batched(values, offsets, means, weights_init = weights, fixed_weights = True, sample_weight = counts))
+    scores = [fit.score() for fit in fits]
+    bics = [fit.bic() for fit in fits]
+    best_ns = []
+    for j, ind_name in enumerate(ind_names):
+        best_n = 1
+        best_bic = np.inf
+        best_gmm = None
+        with open(f'{output_dir}/{ind_name}.fit.txt', 'w') as outfile:
+            for i in range(0, len(ploidy)):
+                gmm = fits[i].model(j)
+                write_gmm_fit(outfile, ploidy[i], gmm, scores[i][j], bics[i][j])
+                # only consider a 3.2 point difference via Kass and Raftery 1995
+                if bics[i][j] < (best_bic - 3.2):
+                    best_bic = bics[i][j]
+                    best_n = ploidy[i]
+                    best_gmm = gmm
+        plot_gmm_fit_sklearn(dats[j], best_gmm, output_dir, plot_name=f'{ind_name}.fit', title=f'GMM Fit to Allele Balance Data ({ind_name})')
+        best_ns.append(best_n)
+    return(best_ns)
+
+def get_ind_ab(ab_dat, i):
+    """
+    Returns the allele balance of the passing sites of individual i as a column, leaving out values within 0.05 of 0 or 1.
+    When ab_dat holds a sample of passing sites from get_ind_freqs with max_sites, the sample is used instead of every passing site.
+    
+    Parameters:
+        ab_dat (SiteData): Allele balance data returned from get_ind_freqs
+        i (int): The column of the individual
+    """
+    if ab_dat.sampled_allele_balance is not None:
+        ind_dat_filtered = ab_dat.sampled_allele_balance[i]
+    else:
+        # The sites of an individual are contiguous, so masking does not touch other individuals' memory
+        ind_dat_filtered = ab_dat.passing_allele_balance(i)
+    ind_dat_buffer = (ind_dat_filtered > 0.05) & (ind_dat_filtered < 0.95)
+    return ind_dat_filtered[ind_dat_buffer].reshape(-1, 1)
+
+def limit_worker_threads():
+    """
+    Limit the BLAS and OpenMP thread pools of a worker process to one thread, so parallel fits do not oversubscribe the cores.
+    """
+    threadpool_limits(limits=1)
+
+def load_ploidy_task(tax_list, ab_dat, columns, minimum_sites):
+    """
+    Read the allele balance of the individuals of one task of est_ploidy, leaving out those with fewer than minimum_sites sites
+    once values near 0 and 1 are trimmed.
+    
+    Returns:
+        ind_names: The names of the individuals to be fitted
+        dats: The allele balance of each of them from get_ind_ab
+    """
+    ind_names = []
+    dats = []
+    for i in columns:
+        dat = get_ind_ab(ab_dat, i)
+        if len(dat) >= minimum_sites:
+            logging.info(f"Individual {tax_list[i]}: {len(dat)} sites")
+            ind_names.append(tax_list[i])
+            dats.append(dat)
+        else:
+            logging.warning(f'Individual {tax_list[i]}: Sample skipped due to low site count passing filters.\n')
+    return(ind_names, dats)
+
+def fit_ploidy_task(ind_names, dats, ploidy, model_constraints, output_dir, backend, init_params, batched, bin_width):
+    """
+    Fit one task of est_ploidy, either a batch of individuals together or a single individual, and return the best ploidy of each.
+    """
+    if batched:
+        return(fit_gmm_to_ab_batched(ind_names, dats, ploidy, model_constraints, output_dir, bin_width))
+    return([fit_gmm_to_ab(ind_names[0], dats[0], ploidy, model_constraints, output_dir, backend, init_params, bin_width)])
+
+def plan_ploidy_tasks(n_sites, batched, jobs):
+    """
+    Group the individuals to be fitted into the tasks of est_ploidy.
+    
+    Parameters:
+        n_sites (dict): The number of passing sites of each individual to be fitted, keyed by column in sample order
+        batched (bool): Group individuals with fewer than BATCH_SAMPLES sites, in sample order, into batches of up to BATCH_SAMPLES sites.
+            Every other individual is a task of its own
+        jobs (int): The number of worker processes. With more than one, tasks are ordered from the most to the fewest sites,
+            so the longest fits start first and the pool finishes together
+    
+    Returns:
+        tasks: A list of (columns, batched) tuples
+    """
+    tasks = []
+    batch = []
+    batch_samples = 0
+    for i, ind_sites in n_sites.items():
+        if batched and (ind_sites < BATCH_SAMPLES):
+            if batch_samples + ind_sites > BATCH_SAMPLES:
+                tasks.append((batch, True))
+                batch, batch_samples = [], 0
+            batch.append(i)
+            batch_samples += ind_sites
+        else:
+            tasks.append(([i], False))
+    if len(batch) > 0:
+        tasks.append((batch, True))
+    if jobs > 1:
+        tasks.sort(key=lambda task: sum(n_sites[i] for i in task[0]), reverse=True)
+    return(tasks)
+
+def est_ploidy(tax_list, ab_dat, method, ploidy_levels, minimum_sites, model_constraints, output_dir, backend='em1d', init_params='means', batched=False, jobs=1, bin_width=None):
     """
     Estimate ploidy from allele balance data using the specified method.
     
     Parameters:
         tax_list (list): A list of individual names corresponding to the individual order of ab_dat
-        ab_dat (np.array): Allele balance data returned from get_ind_freqs.
+        ab_dat (SiteData): Allele balance data returned from get_ind_freqs. Fields may be read-only memory maps, in which case only
+            the sites of the individuals being fitted are read into memory at a time. When get_ind_freqs was given max_sites,
+            individuals are fitted to their sample of passing sites and the fields are not read at all
         method (str): Method for estimating ploidy ('gmm' or 'other').
         ploidy_levels (str): The ploidies to test passed as a comma-separated list.
         minimum_sites (int): The minimum number of sites to be considered for analysis
         model_constraints (int): The parameters to contrain where 0 is none, 1 is means, and 2 is means and weights
         output_dir (str): The output directory where all results will be directed
+        backend (str): The implementation of the constrained mixtures, 'em1d' or 'sklearn'
+        init_params (str): The initialization of the constrained mixtures, 'means' or 'kmeans'
+        batched (bool): Fit individuals with fewer than BATCH_SAMPLES sites together with fit_gmm_to_ab_batched. Applies to
+            the em1d backend started from the means with fixed means, and gives the same estimates as fitting one at a time
+        jobs (int): The number of worker processes fitting individuals in parallel. Each worker uses one BLAS thread,
+            and the estimates are written in sample order regardless of the order in which fits finish
+        bin_width (float): Fit the constrained em1d mixtures to a histogram of each individual's data. 0 merges identical values,
+            and a positive width merges values in bins of that width. None fits every site
     
     Returns:
         ploidy_df: DataFrame containing estimated ploidy for each individual.
     """
     if method == 'gmm':
         output_file = f'{output_dir}/ploidy.txt'
-        outfile = open(output_file, 'w')
         ploidy_dict = {}
         ploidy_level_list = ploidy_levels.split(',')
         ploidy = [int(p) for p in ploidy_level_list]
         logging.info(f'Testing for ploidy with the following values:\n{ploidy}\n')
-        for i in range(len(ab_dat[0,0,:])):
-            ind_name = tax_list[i]
-            ind_dat = ab_dat[0,:,i]
-            ind_mask = ab_dat[3,:,i] == 1
-            ind_dat_filtered = ind_dat[ind_mask]
-            ind_dat_buffer = (ind_dat_filtered > 0.05) & (ind_dat_filtered < 0.95)
-            ind_dat_filtered_truncated = ind_dat_filtered[ind_dat_buffer]
-            dat = ind_dat_filtered_truncated
-            if len(ind_dat_filtered_truncated.shape) == 1:
-                dat = ind_dat_filtered_truncated.reshape(-1, 1)
-            # Fit GMM to allele balance data
-            #print(f'min sites: {minimum_sites}\n')
-            #print(f'{len(dat[:])}\t{dat.shape}\n')
-            n_sites = len(dat[:])
-            if n_sites >= minimum_sites:
-                logging.info(f"Individual {ind_name}: {n_sites} sites")
-                best_n = fit_gmm_to_ab(ind_name, dat, ploidy, model_constraints, output_dir)
-                #print(f'{best_n}')
-                outfile.write(f'{ind_name}\t{best_n}\n')
-                ploidy_dict[ind_name] = best_n
+        if batched and ((backend != 'em1d') or (init_params != 'means') or (model_constraints not in (1, 2))):
+            logging.warning('Batched fits require the em1d backend started from the means with fixed means. Fitting individuals one at a time.')
+            batched = False
+        if (bin_width is not None) and ((backend != 'em1d') or (model_constraints not in (1, 2))):
+            logging.info('Binned fits require the em1d backend with fixed means. Fitting every site.')
+            bin_width = None
+        # Tasks are planned from the counts of passing or sampled sites, so the allele balance of each individual is read once, when it is fitted.
+        # The count bounds the sites left after trimming values near 0 and 1, so individuals below the minimum are skipped here
+        if ab_dat.sampled_allele_balance is not None:
+            n_passing = np.array([len(sample) for sample in ab_dat.sampled_allele_balance])
+        else:
+            n_passing = np.asarray(ab_dat.pass_filters.sum(axis=0))
+        n_sites = {}
+        for i in range(ab_dat.n_tax):
+            # Every individual holds its place in the sample order, and those skipped keep None
+            ploidy_dict[tax_list[i]] = None
+            if n_passing[i] >= minimum_sites:
+                n_sites[i] = int(n_passing[i])
             else:
-                logging.warning(f'Individual {ind_name}: Sample skipped due to low site count passing filters.\n')
-                ploidy_dict[ind_name] = None
-        outfile.close()
+                logging.warning(f'Individual {tax_list[i]}: Sample skipped due to low site count passing filters.\n')
+        tasks = plan_ploidy_tasks(n_sites, batched, jobs)
+        if jobs <= 1:
+            for columns, task_batched in tasks:
+                ind_names, dats = load_ploidy_task(tax_list, ab_dat, columns, minimum_sites)
+                if len(ind_names) > 0:
+                    ploidy_dict.update(zip(ind_names, fit_ploidy_task(ind_names, dats, ploidy, model_constraints, output_dir, backend, init_params, task_batched, bin_width)))
+        else:
+            logging.info(f'Fitting up to {len(n_sites)} individuals in {len(tasks)} tasks with {jobs} processes')
+            def calls():
+                for columns, task_batched in tasks:
+                    ind_names, dats = load_ploidy_task(tax_list, ab_dat, columns, minimum_sites)
+                    if len(ind_names) > 0:
+                        yield ind_names, fit_ploidy_task, (ind_names, dats, ploidy, model_constraints, output_dir, backend, init_params, task_batched, bin_width)
+            with ProcessPoolExecutor(max_workers=jobs, initializer=limit_worker_threads) as pool:
+                for ind_names, best_ns in iter_bounded_results(pool, calls(), jobs):
+                    ploidy_dict.update(zip(ind_names, best_ns))
+        # Individuals are written in sample order, leaving out those skipped for low site counts
+        with open(output_file, 'w') as outfile:
+            for ind_name, best_n in ploidy_dict.items():
+                if best_n is not None:
+                    outfile.write(f'{ind_name}\t{best_n}\n')
         ploidy_df = pd.DataFrame.from_dict(ploidy_dict, orient = 'index')
         ploidy_df.reset_index(inplace=True)
         ploidy_df.columns = ['Individual','Ploidy']
         return(ploidy_df)
     else:
         logging.error('Terminated due to unavailable estimation method!\n')
-        raise ValueError("Unsupported method. Use 'gmm'.")
\ No newline at end of file
+        raise ValueError("Unsupported method. Use 'gmm'.")
@@ -0,0 +1,427 @@
+"""
+Closed-form EM for one-dimensional Gaussian mixtures with fixed means, and optionally fixed weights
+"""
+import logging
+import numpy as np
+from sklearn.cluster import KMeans
+from sklearn.utils import check_random_state
+
+LOG_2PI = np.log(2 * np.pi)
+
+
+def _as_column(X):
+    """
+    Returns allele balance data given as an (n_samples,) or (n_samples, 1) array as a float64 vector.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    if (X.ndim == 2) and (X.shape[1] == 1):
+        return X[:, 0]
+    if X.ndim != 1:
+        raise ValueError(f'Expected one-dimensional data, got an array of shape {X.shape}')
+    return X
+
+
+def _weighted_mean(values, sample_weight):
+    if sample_weight is None:
+        return values.mean()
+    return (values @ sample_weight) / sample_weight.sum()
+
+
+def bin_samples(X, bin_width=0):
+    """
+    Collapses one-dimensional samples onto a weighted histogram, so EM over the bins costs time in the number of bins rather than samples.
+
+    Parameters:
+        X (np.array): samples of shape (n_samples,) or (n_samples, 1)
+        bin_width (float): 0 to merge identical values only, which leaves the likelihood unchanged, or the width of bins
+            starting from 0, in which case each bin is represented by the mean of its samples
+
+    Returns:
+        values (np.array): the distinct values or bin means in increasing order
+        counts (np.array): the number of samples of each value or bin as float64
+    """
+    x = _as_column(X)
+    if bin_width < 0:
+        raise ValueError(f'Expected a non-negative bin width but got {bin_width}')
+    if bin_width == 0:
+        values, counts = np.unique(x, return_counts=True)
+        return values, counts.astype(np.float64)
+    bins = np.floor(x / bin_width).astype(np.int64)
+    bins -= bins.min(initial=0)
+    counts = np.bincount(bins).astype(np.float64)
+    sums = np.bincount(bins, weights=x)
+    occupied = counts > 0
+    return sums[occupied] / counts[occupied], counts[occupied]
+
+
+class GaussianMixture1DFixedMeans:
+    """
+    A one-dimensional Gaussian mixture fitted by EM with the means held at their initial values.
+    The squared distances to the fixed means are computed once, after which each iteration is a fused E-step
+    (log densities, log-sum-exp, and responsibilities) and a closed-form M-step for the weights and variances.
+    Arrays are laid out component-major, (n_components, n_samples), so every reduction runs over contiguous rows. The fitted attributes, likelihoods, and BIC
+    follow GaussianMixtureFixedMeans with full covariances, so this is a drop-in replacement for one-dimensional data.
+    Samples may carry weights, such as the counts of bin_samples, in which case each acts as that many repeated samples.
+
+    Parameters:
+        n_components (int): the number of mixture components
+        means_init (np.array): the fixed means, of shape (n_components,) or (n_components, 1)
+        weights_init (np.array): optional initial weights. The weights are estimated from the data if None
+        tol (float): the convergence threshold on the change of the mean log-likelihood
+        reg_covar (float): the non-negative regularization added to each variance
+        max_iter (int): the maximum number of EM iterations
+        init_params (string): 'kmeans' to start from a k-means clustering of the data as scikit-learn does,
+            or 'means' to assign samples softly to the fixed means under a common variance without clustering
+        random_state (int): the seed of the k-means initialization
+    """
+    fixed_weights = False
+
+    def __init__(self, n_components=1, means_init=None, weights_init=None, tol=1e-3, reg_covar=1e-6, max_iter=100, init_params='kmeans', random_state=None):
+        if means_init is None:
+            raise ValueError('means_init is required when the means are fixed.')
+        self.n_components = n_components
+        self.means_init = np.asarray(means_init, dtype=np.float64).reshape(n_components)
+        self.weights_init = None if weights_init is None else np.asarray(weights_init, dtype=np.float64).reshape(n_components)
+        if self.fixed_weights and (self.weights_init is None):
+            raise ValueError('weights_init is required when the weights are fixed.')
+        self.tol = tol
+        self.reg_covar = reg_covar
+        self.max_iter = max_iter
+        self.init_params = init_params
+        self.random_state = random_state
+
+    def _initial_resp(self, x, squared_distance, sample_weight=None):
+        """
+        Returns the initial responsibilities of each sample, of shape (n_components, n_samples).
+        With 'means', the common variance is the mean squared distance of the samples to their nearest fixed mean,
+        so components without a nearest sample still start with some responsibility.
+        """
+        if self.init_params == 'means':
+            self.variances_ = np.full(self.n_components, _weighted_mean(squared_distance.min(axis=0), sample_weight) + self.reg_covar)
+            self.weights_ = np.full(self.n_components, 1 / self.n_components)
+            _, resp = self._e_step(squared_distance)
+            return resp
+        if self.init_params == 'kmeans':
+            random_state = check_random_state(self.random_state)
+            labels = KMeans(n_clusters=self.n_components, n_init=1, random_state=random_state).fit(x.reshape(-1, 1), sample_weight=sample_weight).labels_
+        else:
+            raise ValueError(f'Unsupported init_params {self.init_params}.')
+        resp = np.zeros((self.n_components, len(x)))
+        resp[labels, np.arange(len(x))] = 1
+        return resp
+
+    def _m_step(self, squared_distance, resp, sample_weight=None):
+        """
+        Sets the weights and variances from the responsibilities in closed form. Weighted responsibilities are scaled in place.
+        """
+        if sample_weight is not None:
+            resp *= sample_weight
+        nk = resp.sum(axis=1) + 10 * np.finfo(resp.dtype).eps
+        self.variances_ = np.einsum('kn,kn->k', resp, squared_distance) / nk + self.reg_covar
+        if not self.fixed_weights:
+            self.weights_ = nk / nk.sum()
+
+    def _e_step(self, squared_distance):
+        """
+        Returns the log-likelihood of each sample and the responsibilities under the current parameters.
+        """
+        precisions = (1 / self.variances_)[:, None]
+        log_norms = (np.log(self.weights_) - 0.5 * (LOG_2PI + np.log(self.variances_)))[:, None]
+        resp = squared_distance * (-0.5 * precisions) + log_norms
+        max_log_prob = resp.max(axis=0)
+        resp -= max_log_prob
+        np.exp(resp, out=resp)
+        norm = resp.sum(axis=0)
+        resp /= norm
+        return np.log(norm) + max_log_prob, resp
+
+    def fit(self, X, sample_weight=None):
+        """
+        Estimates the weights and variances with EM.
+
+        Parameters:
+            X (np.array): allele balance data of shape (n_samples,) or (n_samples, 1)
+            sample_weight (np.array): optional non-negative weight of each sample, such as bin counts
+        """
+        x = _as_column(X)
+        if sample_weight is not None:
+            sample_weight = np.asarray(sample_weight, dtype=np.float64).reshape(len(x))
+        n_samples = len(x) if sample_weight is None else sample_weight.sum()
+        if n_samples < self.n_components:
+            raise ValueError(f'Expected n_samples >= n_components but got n_components = {self.n_components}, n_samples = {n_samples}')
+        squared_distance = (x - self.means_init[:, None]) ** 2
+        resp = self._initial_resp(x, squared_distance, sample_weight)
+        self._m_step(squared_distance, resp, sample_weight)
+        if self.weights_init is not None:
+            self.weights_ = self.weights_init
+        lower_bound = -np.inf
+        self.converged_ = False
+        for n_iter in range(1, self.max_iter + 1):
+            previous_lower_bound = lower_bound
+            log_prob_norm, resp = self._e_step(squared_distance)
+            self._m_step(squared_distance, resp, sample_weight)
+            lower_bound = _weighted_mean(log_prob_norm, sample_weight)
+            if abs(lower_bound - previous_lower_bound) < self.tol:
+                self.converged_ = True
+                break
+        if not self.converged_:
+            logging.warning(f'EM did not converge in {self.max_iter} iterations. Try a larger max_iter or tol.')
+        self.n_iter_ = n_iter
+        self.lower_bound_ = lower_bound
+        return self
+
+    @property
+    def means_(self):
+        return self.means_init.reshape(-1, 1)
+
+    @property
+    def covariances_(self):
+        return self.variances_.reshape(-1, 1, 1)
+
+    @property
+    def precisions_(self):
+        return (1 / self.variances_).reshape(-1, 1, 1)
+
+    def score_samples(self, X):
+        """
+        Returns the log-likelihood of each sample under the fitted mixture.
+        """
+        x = _as_column(X)
+        log_prob_norm, _ = self._e_step((x - self.means_init[:, None]) ** 2)
+        return log_prob_norm
+
+    def score(self, X, sample_weight=None):
+        """
+        Returns the mean log-likelihood of the samples under the fitted mixture, weighted by sample_weight if given.
+        """
+        return _weighted_mean(self.score_samples(X), sample_weight)
+
+    def predict_proba(self, X):
+        x = _as_column(X)
+        _, resp = self._e_step((x - self.means_init[:, None]) ** 2)
+        return resp.T
+
+    def predict(self, X):
+        return self.predict_proba(X).argmax(axis=1)
+
+    def _n_parameters(self):
+        """
+        Returns the number of free parameters counted for a full-covariance mixture in one dimension,
+        as GaussianMixtureFixedMeans does, so BIC values are comparable with it.
+        """
+        return 3 * self.n_components - 1
+
+    def bic(self, X, sample_weight=None):
+        n_samples = len(_as_column(X)) if sample_weight is None else np.sum(sample_weight)
+        return -2 * self.score(X, sample_weight) * n_samples + self._n_parameters() * np.log(n_samples)
+
+    def aic(self, X, sample_weight=None):
+        n_samples = len(_as_column(X)) if sample_weight is None else np.sum(sample_weight)
+        return -2 * self.score(X, sample_weight) * n_samples + 2 * self._n_parameters()
+
+
+class GaussianMixture1DFixedMeansFixedWeights(GaussianMixture1DFixedMeans):
+    """
+    A one-dimensional Gaussian mixture fitted by EM with the means and weights held at their initial values,
+    so only the variances are estimated. Follows GaussianMixtureFixedMeansFixedWeights with full covariances.
+    """
+    fixed_weights = True
+
+
+def pack_samples(samples):
+    """
+    Packs ragged one-dimensional arrays into a single vector, so the samples of array i are values[offsets[i]:offsets[i + 1]].
+
+    Parameters:
+        samples (list): arrays of shape (n_samples,) or (n_samples, 1)
+
+    Returns:
+        values (np.array): the concatenated samples as float64
+        offsets (np.array): the start of each array in values, followed by the total number of samples
+    """
+    samples = [_as_column(x) for x in samples]
+    offsets = np.zeros(len(samples) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in samples], out=offsets[1:])
+    values = np.empty(offsets[-1], dtype=np.float64)
+    for i, x in enumerate(samples):
+        values[offsets[i]:offsets[i + 1]] = x
+    return values, offsets
+
+
+def _segment_starts(lengths):
+    starts = np.zeros(len(lengths), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    return starts
+
+
+def _batched_e_step(squared_distance, weights, variances, lengths):
+    """
+    The E-step of GaussianMixture1DFixedMeans for many individuals at once. Parameters of shape (n_components, n_individuals)
+    are repeated over the samples of each individual, so the rest is the same fused log-sum-exp over all samples.
+    """
+    precisions = np.repeat(-0.5 / variances, lengths, axis=1)
+    log_norms = np.repeat(np.log(weights) - 0.5 * (LOG_2PI + np.log(variances)), lengths, axis=1)
+    resp = squared_distance * precisions
+    resp += log_norms
+    max_log_prob = resp.max(axis=0)
+    resp -= max_log_prob
+    np.exp(resp, out=resp)
+    norm = resp.sum(axis=0)
+    resp /= norm
+    return np.log(norm) + max_log_prob, resp
+
+
+def _segment_sum(values, starts, sample_weight=None):
+    if sample_weight is not None:
+        values = values * sample_weight
+    return np.add.reduceat(values, starts, axis=-1)
+
+
+def _batched_m_step(squared_distance, resp, starts, reg_covar, sample_weight=None):
+    """
+    The closed-form M-step for many individuals at once, summing over the samples of each individual with segment reductions.
+    Returns the effective counts and variances of shape (n_components, n_individuals).
+    """
+    if sample_weight is not None:
+        resp *= sample_weight
+    nk = np.add.reduceat(resp, starts, axis=1) + 10 * np.finfo(resp.dtype).eps
+    resp *= squared_distance
+    variances = np.add.reduceat(resp, starts, axis=1) / nk + reg_covar
+    return nk, variances
+
+
+class BatchedFixedMeansFit:
+    """
+    The fitted weights, variances, and log-likelihoods of a fixed-means mixture for each of many individuals.
+
+    Parameters:
+        means (np.array): the fixed means, of shape (n_components,)
+        weights (np.array): the weights of each individual, of shape (n_individuals, n_components)
+        variances (np.array): the variances of each individual, of shape (n_individuals, n_components)
+        fixed_weights (bool): whether the weights were held at their initial values
+        n_samples (np.array): the number of samples of each individual
+        log_likelihood (np.array): the total log-likelihood of the samples of each individual
+        n_iter (np.array): the number of EM iterations of each individual
+        converged (np.array): whether EM converged for each individual
+    """
+    __slots__ = ['means', 'weights', 'variances', 'fixed_weights', 'n_samples', 'log_likelihood', 'n_iter', 'converged']
+
+    def __init__(self, means, weights, variances, fixed_weights, n_samples, log_likelihood, n_iter, converged):
+        self.means = means
+        self.weights = weights
+        self.variances = variances
+        self.fixed_weights = fixed_weights
+        self.n_samples = n_samples
+        self.log_likelihood = log_likelihood
+        self.n_iter = n_iter
+        self.converged = converged
+
+    @property
+    def n_components(self):
+        return len(self.means)
+
+    def score(self):
+        """
+        Returns the mean log-likelihood of the samples of each individual, as GaussianMixture1DFixedMeans.score.
+        """
+        return self.log_likelihood / self.n_samples
+
+    def bic(self):
+        return -2 * self.log_likelihood + (3 * self.n_components - 1) * np.log(self.n_samples)
+
+    def aic(self):
+        return -2 * self.log_likelihood + 2 * (3 * self.n_components - 1)
+
+    def model(self, i):
+        """
+        Returns the fitted mixture of individual i as a GaussianMixture1DFixedMeans, e.g. for plotting.
+        """
+        if self.fixed_weights:
+            gmm = GaussianMixture1DFixedMeansFixedWeights(n_components=self.n_components, means_init=self.means, weights_init=self.weights[i], init_params='means')
+        else:
+            gmm = GaussianMixture1DFixedMeans(n_components=self.n_components, means_init=self.means, init_params='means')
+        gmm.weights_ = self.weights[i]
+        gmm.variances_ = self.variances[i]
+        gmm.n_iter_ = self.n_iter[i]
+        gmm.converged_ = self.converged[i]
+        gmm.lower_bound_ = self.score()[i]
+        return gmm
+
+
+def fit_fixed_means_batched(values, offsets, means_init, weights_init=None, fixed_weights=False, tol=1e-3, reg_covar=1e-6, max_iter=100, sample_weight=None):
+    """
+    Fits a fixed-means mixture to each of many individuals in one vectorized EM. Each individual follows
+    GaussianMixture1DFixedMeans with init_params='means', including its own convergence test, and individuals
+    that have converged are dropped from later iterations.
+
+    Parameters:
+        values (np.array): the packed samples of every individual from pack_samples
+        offsets (np.array): the start of each individual in values, followed by the total number of samples
+        means_init (np.array): the fixed means, of shape (n_components,) or (n_components, 1)
+        weights_init (np.array): optional initial weights shared by every individual
+        fixed_weights (bool): hold the weights at weights_init
+        tol (float): the convergence threshold on the change of the mean log-likelihood
+        reg_covar (float): the non-negative regularization added to each variance
+        max_iter (int): the maximum number of EM iterations
+        sample_weight (np.array): optional weights packed like values, such as the bin counts of bin_samples
+
+    Returns:
+        BatchedFixedMeansFit
+    """
+    means = np.asarray(means_init, dtype=np.float64).reshape(-1)
+    n_components = len(means)
+    if fixed_weights and (weights_init is None):
+        raise ValueError('weights_init is required when the weights are fixed.')
+    if sample_weight is not None:
+        sample_weight = np.asarray(sample_weight, dtype=np.float64)
+    lengths = np.diff(np.asarray(offsets, dtype=np.int64))
+    n_ind = len(lengths)
+    starts = _segment_starts(lengths)
+    # The number of samples of each individual, which are the summed weights of weighted samples
+    n_samples = lengths if sample_weight is None else _segment_sum(sample_weight, starts)
+    if np.any(n_samples < n_components):
+        raise ValueError(f'Expected n_samples >= n_components for every individual but got n_components = {n_components}, min n_samples = {n_samples.min()}')
+    full_squared_distance = (np.asarray(values, dtype=np.float64) - means[:, None]) ** 2
+    # Start every individual from the fixed means under its own common variance
+    variances = np.tile(_segment_sum(full_squared_distance.min(axis=0), starts, sample_weight) / n_samples + reg_covar, (n_components, 1))
+    weights = np.full((n_components, n_ind), 1 / n_components)
+    _, resp = _batched_e_step(full_squared_distance, weights, variances, lengths)
+    nk, variances = _batched_m_step(full_squared_distance, resp, starts, reg_covar, sample_weight)
+    if not fixed_weights:
+        weights = nk / nk.sum(axis=0)
+    if weights_init is not None:
+        weights = np.tile(np.asarray(weights_init, dtype=np.float64).reshape(n_components, 1), (1, n_ind))
+    lower_bound = np.full(n_ind, -np.inf)
+    n_iter = np.zeros(n_ind, dtype=np.int64)
+    converged = np.zeros(n_ind, dtype=bool)
+    # The individuals still iterating, their samples, and segment bounds
+    active = np.arange(n_ind)
+    squared_distance = full_squared_distance
+    active_weight = sample_weight
+    active_lengths = lengths
+    for iteration in range(1, max_iter + 1):
+        log_prob_norm, resp = _batched_e_step(squared_distance, weights[:, active], variances[:, active], active_lengths)
+        nk, variances[:, active] = _batched_m_step(squared_distance, resp, starts, reg_covar, active_weight)
+        if not fixed_weights:
+            weights[:, active] = nk / nk.sum(axis=0)
+        active_lower_bound = _segment_sum(log_prob_norm, starts, active_weight) / n_samples[active]
+        done = np.abs(active_lower_bound - lower_bound[active]) < tol
+        lower_bound[active] = active_lower_bound
+        n_iter[active] = iteration
+        if done.any():
+            converged[active[done]] = True
+            keep = ~done
+            if not keep.any():
+                break
+            keep_samples = np.repeat(keep, active_lengths)
+            squared_distance = squared_distance[:, keep_samples]
+            if active_weight is not None:
+                active_weight = active_weight[keep_samples]
+            active = active[keep]
+            active_lengths = active_lengths[keep]
+            starts = _segment_starts(active_lengths)
+    if not converged.all():
+        logging.warning(f'EM did not converge in {max_iter} iterations for {np.count_nonzero(~converged)} of {n_ind} individuals. Try a larger max_iter or tol.')
+    log_prob_norm, _ = _batched_e_step(full_squared_distance, weights, variances, lengths)
+    log_likelihood = _segment_sum(log_prob_norm, _segment_starts(lengths), sample_weight)
+    return BatchedFixedMeansFit(means, weights.T.copy(), variances.T.copy(), fixed_weights, n_samples, log_likelihood, n_iter, converged)
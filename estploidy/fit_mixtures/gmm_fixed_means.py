@@ -288,6 +288,38 @@ def _estimate_gaussian_covariances_spherical(resp, X, nk, means, reg_covar):
     return _estimate_gaussian_covariances_diag(resp, X, nk, means, reg_covar).mean(1)
 
 
+def _fixed_means_resp(X, means, reg_covar):
+    """Responsibilities of the fixed means under a common spherical variance.
+
+    The variance is the mean squared distance of the samples to their
+    nearest mean, so no component starts without responsibility.
+
+    Parameters
+    ----------
+    X : array-like of shape (n_samples, n_features)
+
+    means : array-like of shape (n_components, n_features)
+
+    reg_covar : float
+
+    Returns
+    -------
+    resp : array, shape (n_samples, n_components)
+    """
+    squared_distance = (
+        row_norms(X, squared=True)[:, np.newaxis]
+        - 2 * X @ means.T
+        + row_norms(means, squared=True)[np.newaxis, :]
+    )
+    np.maximum(squared_distance, 0, out=squared_distance)
+    variance = squared_distance.min(axis=1).mean() + reg_covar
+    log_resp = -0.5 * squared_distance / variance
+    log_resp -= log_resp.max(axis=1, keepdims=True)
+    resp = np.exp(log_resp)
+    resp /= resp.sum(axis=1, keepdims=True)
+    return resp
+
+
 def _estimate_gaussian_parameters(X, resp, reg_covar, covariance_type, fixed_means):
     """Estimate the Gaussian distribution parameters.
 
@@ -587,7 +619,7 @@ class GaussianMixtureFixedMeans(BaseMixture):
     n_init : int, default=1
         The number of initializations to perform. The best results are kept.
 
-    init_params : {'kmeans', 'k-means++', 'random', 'random_from_data'}, \
+    init_params : {'kmeans', 'k-means++', 'random', 'random_from_data', 'means'}, \
     default='kmeans'
         The method used to initialize the weights, the means and the
         precisions.
@@ -597,6 +629,8 @@ class GaussianMixtureFixedMeans(BaseMixture):
         - 'k-means++' : use the k-means++ method to initialize.
         - 'random' : responsibilities are initialized randomly.
         - 'random_from_data' : initial means are randomly selected data points.
+        - 'means' : responsibilities are computed from the fixed `means_init`
+          under a common variance, skipping k-means.
 
         .. versionchanged:: v1.1
             `init_params` now accepts 'random_from_data' and 'k-means++' as
@@ -741,6 +775,9 @@ class GaussianMixtureFixedMeans(BaseMixture):
     _parameter_constraints: dict = {
         **BaseMixture._parameter_constraints,
         "covariance_type": [StrOptions({"full", "tied", "diag", "spherical"})],
+        "init_params": [
+            StrOptions({"kmeans", "random", "random_from_data", "k-means++", "means"})
+        ],
         "weights_init": ["array-like", None],
         "means_init": ["array-like", None],
         "precisions_init": ["array-like", None],
@@ -810,7 +847,9 @@ class GaussianMixtureFixedMeans(BaseMixture):
             or self.means_init is None
             or self.precisions_init is None
         )
-        if compute_resp:
+        if compute_resp and self.init_params == "means":
+            self._initialize(X, _fixed_means_resp(X, self.means_init, self.reg_covar))
+        elif compute_resp:
             super()._initialize_parameters(X, random_state)
         else:
             self._initialize(X, None)
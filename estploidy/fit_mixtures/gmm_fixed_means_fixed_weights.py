@@ -42,6 +42,7 @@ from sklearn.utils import check_array
 from sklearn.utils._param_validation import StrOptions
 from sklearn.utils.extmath import row_norms
 from sklearn.mixture._base import BaseMixture, _check_shape
+from .gmm_fixed_means import _fixed_means_resp
 
 
 ###############################################################################
@@ -593,7 +594,7 @@ class GaussianMixtureFixedMeansFixedWeights(BaseMixture):
     n_init : int, default=1
         The number of initializations to perform. The best results are kept.
 
-    init_params : {'kmeans', 'k-means++', 'random', 'random_from_data'}, \
+    init_params : {'kmeans', 'k-means++', 'random', 'random_from_data', 'means'}, \
     default='kmeans'
         The method used to initialize the weights, the means and the
         precisions.
@@ -603,6 +604,8 @@ class GaussianMixtureFixedMeansFixedWeights(BaseMixture):
         - 'k-means++' : use the k-means++ method to initialize.
         - 'random' : responsibilities are initialized randomly.
         - 'random_from_data' : initial means are randomly selected data points.
+        - 'means' : responsibilities are computed from the fixed `means_init`
+          under a common variance, skipping k-means.
 
         .. versionchanged:: v1.1
             `init_params` now accepts 'random_from_data' and 'k-means++' as
@@ -747,6 +750,9 @@ class GaussianMixtureFixedMeansFixedWeights(BaseMixture):
     _parameter_constraints: dict = {
         **BaseMixture._parameter_constraints,
         "covariance_type": [StrOptions({"full", "tied", "diag", "spherical"})],
+        "init_params": [
+            StrOptions({"kmeans", "random", "random_from_data", "k-means++", "means"})
+        ],
         "weights_init": ["array-like", None],
         "means_init": ["array-like", None],
         "precisions_init": ["array-like", None],
@@ -816,7 +822,9 @@ class GaussianMixtureFixedMeansFixedWeights(BaseMixture):
             or self.means_init is None
             or self.precisions_init is None
         )
-        if compute_resp:
+        if compute_resp and self.init_params == "means":
+            self._initialize(X, _fixed_means_resp(X, self.means_init, self.reg_covar))
+        elif compute_resp:
             super()._initialize_parameters(X, random_state)
         else:
             self._initialize(X, None)
@@ -0,0 +1,161 @@
+"""
+Split the body of a VCF into shards of whole lines that can be parsed independently
+"""
+import os
+from contextlib import closing
+from estploidy.bgzf import BgzfReader, get_compression, make_virtual_offset, read_block_size
+
+# Bytes read at a time when streaming the lines of an uncompressed shard
+SHARD_READ_SIZE = 16 * 1024 * 1024
+
+
+def find_body_offset(vcf_file, compression):
+    """
+    Returns the offset of the first record after the #CHROM header line.
+    The offset is in bytes for an uncompressed vcf and a virtual offset for a bgzip compressed vcf.
+    """
+    if compression == 'none':
+        pos = 0
+        with open(vcf_file, 'rb') as fh:
+            for line in fh:
+                pos = pos + len(line)
+                if line.startswith(b'#CHROM'):
+                    return pos
+        raise ValueError(f'{vcf_file} is missing the #CHROM header line.')
+    header = bytearray()
+    chrom_pos = -1
+    header_end = None
+    reader = BgzfReader(vcf_file)
+    try:
+        for block_offset, data in reader.blocks(0):
+            if header_end is not None:
+                return make_virtual_offset(block_offset, 0)
+            block_start = len(header)
+            header.extend(data)
+            if chrom_pos < 0:
+                chrom_pos = 0 if header.startswith(b'#CHROM') else header.find(b'\n#CHROM', max(0, block_start - 6))
+            if chrom_pos >= 0:
+                line_end = header.find(b'\n', max(chrom_pos + 1, block_start))
+                if line_end >= 0:
+                    header_end = line_end + 1 - block_start
+                    if header_end < len(data):
+                        return make_virtual_offset(block_offset, header_end)
+    finally:
+        reader.close()
+    if header_end is None:
+        raise ValueError(f'{vcf_file} is missing the #CHROM header line.')
+    return make_virtual_offset(os.path.getsize(vcf_file), 0)
+
+
+def _align_text(fh, pos, body_start):
+    """
+    Returns the start of the first line at or after pos in an uncompressed file.
+    """
+    if pos <= body_start:
+        return body_start
+    fh.seek(pos - 1)
+    line = fh.readline()
+    return pos - 1 + len(line)
+
+
+def _align_bgzf(reader, block_offset, previous_ends_line):
+    """
+    Returns the virtual offset of the first line starting in or after the block at block_offset, or None if there is none.
+    """
+    if previous_ends_line:
+        return make_virtual_offset(block_offset, 0)
+    with closing(reader.blocks(block_offset)) as blocks:
+        for this_offset, data in blocks:
+            newline = data.find(b'\n')
+            if newline >= 0:
+                return make_virtual_offset(this_offset, newline + 1)
+    return None
+
+
+def plan_shards(vcf_file, n_shards):
+    """
+    Returns up to n_shards ranges covering the records of an uncompressed or bgzip compressed vcf.
+    Ranges are split evenly by file size and moved to the next line boundary so every record belongs to exactly one shard.
+
+    Parameters:
+        vcf_file (string): a multisample vcf file uncompressed or bgzip compressed
+        n_shards (int): the number of shards to create
+
+    Returns:
+        shards (list): (compression, start, end) tuples in file order. Offsets are virtual offsets for bgzip and end is None for the last shard
+    """
+    compression = get_compression(vcf_file)
+    if compression == 'gzip':
+        raise ValueError(f'{vcf_file} is gzip but not bgzip compressed and cannot be split into shards.')
+    body_start = find_body_offset(vcf_file, compression)
+    file_size = os.path.getsize(vcf_file)
+    starts = [body_start]
+    if compression == 'none':
+        with open(vcf_file, 'rb') as fh:
+            for i in range(1, n_shards):
+                target = body_start + (file_size - body_start) * i // n_shards
+                starts.append(_align_text(fh, target, body_start))
+    else:
+        body_block = body_start >> 16
+        targets = [body_block + (file_size - body_block) * i // n_shards for i in range(1, n_shards)]
+        reader = BgzfReader(vcf_file)
+        try:
+            # Walk the block headers to find the first block at or after each target
+            block_offsets = []
+            previous_offset = None
+            reader.fh.seek(body_block)
+            offset = body_block
+            while len(targets) > 0:
+                block_size = read_block_size(reader.fh)
+                if block_size == 0:
+                    break
+                while (len(targets) > 0) and (offset >= targets[0]):
+                    block_offsets.append((offset, previous_offset))
+                    targets.pop(0)
+                previous_offset = offset
+                offset = offset + block_size
+                reader.fh.seek(offset)
+            for block_offset, previous_offset in block_offsets:
+                previous_ends_line = False
+                if previous_offset is not None:
+                    with closing(reader.blocks(previous_offset)) as blocks:
+                        previous_ends_line = next(blocks)[1].endswith(b'\n')
+                start = _align_bgzf(reader, block_offset, previous_ends_line)
+                if start is not None:
+                    starts.append(max(body_start, start))
+        finally:
+            reader.close()
+    starts = sorted(set(starts))
+    shards = []
+    for i in range(len(starts)):
+        end = starts[i + 1] if i + 1 < len(starts) else (file_size if compression == 'none' else None)
+        shards.append((compression, starts[i], end))
+    return shards
+
+
+def iter_shard_lines(vcf_file, shard):
+    """
+    Yields the lines of a shard returned by plan_shards as bytes.
+    """
+    compression, start, end = shard
+    if compression == 'bgzf':
+        reader = BgzfReader(vcf_file)
+        try:
+            yield from reader.iter_lines(start, end)
+        finally:
+            reader.close()
+        return
+    remaining = end - start
+    remainder = b''
+    with open(vcf_file, 'rb') as fh:
+        fh.seek(start)
+        while remaining > 0:
+            data = fh.read(min(SHARD_READ_SIZE, remaining))
+            if len(data) == 0:
+                break
+            remaining = remaining - len(data)
+            lines = (remainder + data).split(b'\n')
+            remainder = lines.pop()
+            yield from lines
+    if remainder != b'':
+        yield remainder
@@ -0,0 +1,293 @@
+"""
+Region queries on bgzip compressed VCFs through tabix (.tbi) or CSI (.csi) indexes
+"""
+import os
+import gzip
+import struct
+import logging
+from bisect import bisect_right
+from estploidy.bgzf import BgzfReader, get_compression
+from estploidy.utils import is_stream
+
+# Tabix indexes use a fixed binning scheme with 16kb leaf bins and a depth of five levels
+TBI_MIN_SHIFT = 14
+TBI_DEPTH = 5
+
+
+def parse_regions(regions=None, regions_file=None):
+    """
+    Returns the genomic regions to analyze as a dict of merged, sorted intervals for each chromosome.
+
+    Parameters:
+        regions (string): comma-separated regions as chr, chr:pos, or chr:beg-end with 1-based inclusive coordinates
+        regions_file (string): a tab-delimited file of regions. Files ending in .bed are read as 0-based half-open chr, beg, end.
+            Other files are read as 1-based inclusive chr, pos or chr, beg, end
+
+    Returns:
+        region_map (dict): keys are chromosome names and values are lists of 0-based half-open (beg, end) tuples
+    """
+    intervals = []
+    if regions is not None:
+        for region in regions.split(','):
+            region = region.strip()
+            if region == '':
+                continue
+            if ':' in region:
+                chrom, coords = region.rsplit(':', 1)
+                if '-' in coords:
+                    beg, end = coords.split('-', 1)
+                    beg = int(beg) - 1
+                    end = int(end) if end != '' else 2**31 - 1
+                else:
+                    beg = int(coords) - 1
+                    end = int(coords)
+            else:
+                chrom = region
+                beg = 0
+                end = 2**31 - 1
+            intervals.append((chrom, beg, end))
+    if regions_file is not None:
+        is_bed = regions_file.endswith('.bed') or regions_file.endswith('.bed.gz')
+        opener = gzip.open if regions_file.endswith('.gz') else open
+        with opener(regions_file, 'rt') as fh:
+            for line in fh:
+                if line.startswith('#') or line.startswith('track') or line.strip() == '':
+                    continue
+                temp = line.split('\t')
+                chrom = temp[0].strip()
+                if is_bed:
+                    beg = int(temp[1])
+                    end = int(temp[2])
+                elif len(temp) >= 3:
+                    beg = int(temp[1]) - 1
+                    end = int(temp[2])
+                else:
+                    beg = int(temp[1]) - 1
+                    end = int(temp[1])
+                intervals.append((chrom, beg, end))
+    region_map = {}
+    for chrom, beg, end in sorted(intervals):
+        if beg >= end:
+            raise ValueError(f'Region {chrom}:{beg + 1}-{end} has a start after its end!')
+        merged = region_map.setdefault(chrom, [])
+        if (len(merged) > 0) and (beg <= merged[-1][1]):
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((beg, end))
+    return region_map
+
+
+def in_regions(region_map, chrom, beg, end):
+    """
+    Returns True if the 0-based half-open interval [beg, end) on chrom overlaps any region.
+    """
+    intervals = region_map.get(chrom)
+    if intervals is None:
+        return False
+    # Merged intervals do not overlap, so only the last interval starting before end can reach beg
+    i = bisect_right(intervals, (end,)) - 1
+    return (i >= 0) and (intervals[i][1] > beg)
+
+
+def record_overlaps(region_map, line):
+    """
+    Returns True if a VCF record given as bytes overlaps any region, using POS and the length of REF.
+    """
+    temp = line.split(b'\t', 4)
+    beg = int(temp[1]) - 1
+    return in_regions(region_map, temp[0].decode(), beg, beg + max(len(temp[3]), 1))
+
+
+def find_index(vcf_file):
+    """
+    Returns the path to the .tbi or .csi index of a bgzip compressed vcf, or None if there is no index.
+    """
+    for suffix in ['.tbi', '.csi']:
+        if os.path.exists(vcf_file + suffix):
+            return vcf_file + suffix
+    return None
+
+
+def reg2bins(beg, end, min_shift, depth):
+    """
+    Returns the bins that may hold records overlapping the 0-based half-open interval [beg, end).
+    """
+    bins = []
+    end = end - 1
+    shift = min_shift + depth * 3
+    offset = 0
+    for level in range(depth + 1):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+        shift = shift - 3
+        offset = offset + (1 << (level * 3))
+    return bins
+
+
+def bin_parent(bin_id):
+    return (bin_id - 1) >> 3
+
+
+def _parse_names(data, pos, l_nm):
+    names = data[pos:pos + l_nm].split(b'\x00')
+    return [name.decode() for name in names if name != b'']
+
+
+class RegionIndex:
+    """
+    The bins and offsets of a tabix or CSI index.
+
+    Parameters:
+        index_file (string): the path to a .tbi or .csi index
+    """
+    def __init__(self, index_file):
+        with gzip.open(index_file, 'rb') as fh:
+            data = fh.read()
+        magic = data[:4]
+        self.names = []
+        self.bins = []
+        self.loffsets = []
+        self.linear = []
+        if magic == b'TBI\x01':
+            self.min_shift = TBI_MIN_SHIFT
+            self.depth = TBI_DEPTH
+            n_ref = struct.unpack_from('<i', data, 4)[0]
+            l_nm = struct.unpack_from('<i', data, 32)[0]
+            self.names = _parse_names(data, 36, l_nm)
+            pos = 36 + l_nm
+            for _ in range(n_ref):
+                pos = self._read_bins(data, pos, has_loffset=False)
+                n_intv = struct.unpack_from('<i', data, pos)[0]
+                pos = pos + 4
+                self.linear.append(list(struct.unpack_from(f'<{n_intv}Q', data, pos)))
+                pos = pos + 8 * n_intv
+        elif magic == b'CSI\x01':
+            self.min_shift, self.depth, l_aux = struct.unpack_from('<iii', data, 4)
+            if l_aux >= 28:
+                l_nm = struct.unpack_from('<i', data, 16 + 24)[0]
+                self.names = _parse_names(data, 16 + 28, l_nm)
+            pos = 16 + l_aux
+            n_ref = struct.unpack_from('<i', data, pos)[0]
+            pos = pos + 4
+            for _ in range(n_ref):
+                pos = self._read_bins(data, pos, has_loffset=True)
+                self.linear.append([])
+        else:
+            raise ValueError(f'{index_file} is not a tabix or CSI index!')
+        self.pseudo_bin = ((1 << (3 * (self.depth + 1))) - 1) // 7 + 1
+        self.tid = {name: i for i, name in enumerate(self.names)}
+
+    def _read_bins(self, data, pos, has_loffset):
+        bins = {}
+        loffsets = {}
+        n_bin = struct.unpack_from('<i', data, pos)[0]
+        pos = pos + 4
+        for _ in range(n_bin):
+            bin_id = struct.unpack_from('<I', data, pos)[0]
+            pos = pos + 4
+            if has_loffset:
+                loffsets[bin_id] = struct.unpack_from('<Q', data, pos)[0]
+                pos = pos + 8
+            n_chunk = struct.unpack_from('<i', data, pos)[0]
+            pos = pos + 4
+            chunks = struct.unpack_from(f'<{2 * n_chunk}Q', data, pos)
+            pos = pos + 16 * n_chunk
+            bins[bin_id] = list(zip(chunks[0::2], chunks[1::2]))
+        self.bins.append(bins)
+        self.loffsets.append(loffsets)
+        return pos
+
+    def min_offset(self, tid, beg):
+        """
+        Returns the smallest virtual offset of a record that can overlap a position, from the linear index or bin offsets.
+        """
+        linear = self.linear[tid]
+        if len(linear) > 0:
+            return linear[min(beg >> self.min_shift, len(linear) - 1)]
+        loffsets = self.loffsets[tid]
+        bin_id = reg2bins(beg, beg + 1, self.min_shift, self.depth)[-1]
+        while bin_id > 0:
+            if bin_id in loffsets:
+                return loffsets[bin_id]
+            bin_id = bin_parent(bin_id)
+        return loffsets.get(0, 0)
+
+    def query(self, chrom, intervals):
+        """
+        Returns merged (start, end) virtual offset chunks holding records that may overlap the intervals on chrom.
+        """
+        tid = self.tid.get(chrom)
+        if tid is None:
+            return []
+        chunks = []
+        max_end = 1 << (self.min_shift + self.depth * 3)
+        for beg, end in intervals:
+            beg = min(beg, max_end - 1)
+            end = min(end, max_end)
+            min_offset = self.min_offset(tid, beg)
+            for bin_id in reg2bins(beg, end, self.min_shift, self.depth):
+                if bin_id == self.pseudo_bin:
+                    continue
+                for chunk_beg, chunk_end in self.bins[tid].get(bin_id, []):
+                    if chunk_end > min_offset:
+                        chunks.append((max(chunk_beg, min_offset), chunk_end))
+        chunks.sort()
+        merged = []
+        for chunk_beg, chunk_end in chunks:
+            if (len(merged) > 0) and (chunk_beg <= merged[-1][1]):
+                merged[-1] = (merged[-1][0], max(merged[-1][1], chunk_end))
+            else:
+                merged.append((chunk_beg, chunk_end))
+        return merged
+
+
+def iter_region_records(fh, vcf_file, region_map, threads=1):
+    """
+    Yields the VCF records overlapping the regions. Indexed bgzip compressed VCFs are queried through their index,
+    otherwise the remaining lines of the open file handle are scanned and filtered.
+
+    Parameters:
+        fh: a binary file handle of the vcf positioned after the header
+        vcf_file (string): a multisample vcf file
+        region_map (dict): the regions returned by parse_regions
+        threads (int): the number of threads used to decompress bgzip blocks
+    """
+    if (not is_stream(vcf_file)) and (get_compression(vcf_file) == 'bgzf') and (find_index(vcf_file) is not None):
+        logging.info(f'Reading regions from {vcf_file} through {find_index(vcf_file)}')
+        yield from iter_region_lines(vcf_file, region_map, threads)
+    else:
+        logging.warning(f'{vcf_file} is not bgzip compressed with a .tbi or .csi index. Scanning the full VCF for regions.')
+        for line in fh:
+            if (line.strip() != b'') and record_overlaps(region_map, line):
+                yield line
+
+
+def iter_region_lines(vcf_file, region_map, threads=1):
+    """
+    Yields the VCF records overlapping the regions by seeking to the indexed bgzip blocks of each chromosome.
+    Chromosomes are visited in the order of the index, which is their order in the VCF, so records keep the order of the file.
+
+    Parameters:
+        vcf_file (string): a bgzip compressed vcf with a .tbi or .csi index
+        region_map (dict): the regions returned by parse_regions
+        threads (int): the number of threads used to decompress bgzip blocks
+
+    Returns:
+        lines: a generator of VCF records as bytes without trailing newlines
+    """
+    index = RegionIndex(find_index(vcf_file))
+    if len(index.names) == 0:
+        raise ValueError(f'The index of {vcf_file} does not store chromosome names!')
+    reader = BgzfReader(vcf_file, threads)
+    try:
+        # Visit chromosomes in file order so sites keep the order of the VCF
+        chroms = sorted(region_map.keys(), key=lambda chrom: index.tid.get(chrom, -1))
+        for chrom in chroms:
+            if chrom not in index.tid:
+                logging.warning(f'Chromosome {chrom} from regions not found in the index of {vcf_file}')
+                continue
+            for chunk_beg, chunk_end in index.query(chrom, region_map[chrom]):
+                for line in reader.iter_lines(chunk_beg, chunk_end):
+                    if record_overlaps(region_map, line):
+                        yield line
+    finally:
+        reader.close()
@@ -1,7 +1,22 @@
 import pandas as pd
 import os
+import io
+import gzip
 import logging
 import sys
+import stat
+import difflib
+import tempfile
+import contextlib
+from collections import deque
+from estploidy.bgzf import GZIP_MAGIC, BgzfReader, get_compression
+
+# Size of the read buffer placed over decompressed BGZF streams
+READ_BUFFER_SIZE = 1024 * 1024
+# The vcf_file that reads the vcf from standard input
+STDIN_FILE = '-'
+# Tasks waiting in a process pool per worker process
+QUEUED_PER_WORKER = 2
 
 def check_dir(my_dir):
     if os.path.exists(my_dir):
@@ -10,8 +25,99 @@ def check_dir(my_dir):
         os.makedirs(my_dir)
         print(f'Output files will be written to: {my_dir}\n')
 
-def decompress_vcf(vcf_file):
-    print(f'{vcf_file}\n')
+def make_scratch_dir(scratch_dir):
+    """
+    Returns a context manager holding a new temporary directory inside scratch_dir that is removed on exit,
+    or holding None if scratch_dir is None.
+    """
+    if scratch_dir is None:
+        return contextlib.nullcontext()
+    check_dir(scratch_dir)
+    return tempfile.TemporaryDirectory(prefix='estploidy.', dir=scratch_dir)
+
+def iter_bounded_results(pool, calls, workers):
+    """
+    Submits calls to a pool with at most QUEUED_PER_WORKER tasks per worker waiting at a time, and yields their results in submission order.
+    calls is read lazily, so the inputs of a call are only built once there is room for it in the queue.
+
+    Parameters:
+        pool (Executor): the pool the calls are submitted to
+        calls (iterable): (key, function, args) tuples
+        workers (int): the number of workers of the pool
+
+    Returns:
+        results: an iterator of (key, result) tuples
+    """
+    pending = deque()
+    for key, function, args in calls:
+        if len(pending) >= workers * QUEUED_PER_WORKER:
+            done_key, future = pending.popleft()
+            yield done_key, future.result()
+        pending.append((key, pool.submit(function, *args)))
+    while len(pending) > 0:
+        done_key, future = pending.popleft()
+        yield done_key, future.result()
+
+class StreamGzipFile(gzip.GzipFile):
+    """
+    A GzipFile that also closes the stream it decompresses.
+    """
+    def close(self):
+        fileobj = self.fileobj
+        try:
+            super().close()
+        finally:
+            if fileobj is not None:
+                fileobj.close()
+
+def is_stream(vcf_file):
+    """
+    Returns True if vcf_file is standard input ('-') or a path that is not a regular file, such as a named pipe
+    or a process substitution. Streams can only be read once from start to end.
+    """
+    if vcf_file == STDIN_FILE:
+        return True
+    return os.path.exists(vcf_file) and not stat.S_ISREG(os.stat(vcf_file).st_mode)
+
+def open_stream(vcf_file, binary=False):
+    """
+    Returns a text or binary file handle for an uncompressed or gzip compressed vcf read from standard input or a named pipe.
+    Compression is detected from the first bytes in the read buffer, so nothing is read twice.
+    bgzip compressed streams are decompressed serially as gzip, since their blocks cannot be read ahead.
+    """
+    if vcf_file == STDIN_FILE:
+        raw = open(sys.stdin.fileno(), 'rb', buffering=0, closefd=False)
+    else:
+        raw = open(vcf_file, 'rb', buffering=0)
+    fh = io.BufferedReader(raw, buffer_size=READ_BUFFER_SIZE)
+    if fh.peek(2)[:2] == GZIP_MAGIC:
+        fh = StreamGzipFile(fileobj=fh, mode='rb')
+    return fh if binary else io.TextIOWrapper(fh)
+
+def open_vcf(vcf_file, threads=1, binary=False):
+    """
+    Returns a text or binary file handle for an uncompressed, gzip, or bgzip compressed vcf.
+
+    Parameters:
+        vcf_file (string): a multisample vcf file
+        threads (int): the number of threads used to decompress bgzip blocks ahead of parsing
+        binary (bool): return a binary file handle that reads bytes instead of text
+
+    Returns:
+        fh: a file handle that iterates over the lines of the vcf
+    """
+    if is_stream(vcf_file):
+        return open_stream(vcf_file, binary)
+    compression = get_compression(vcf_file)
+    if compression == 'bgzf':
+        fh = io.BufferedReader(BgzfReader(vcf_file, threads), buffer_size=READ_BUFFER_SIZE)
+        return fh if binary else io.TextIOWrapper(fh)
+    elif compression == 'gzip':
+        # Plain gzip has no independent blocks, so it can only be decompressed serially
+        if threads > 1:
+            logging.info(f'{vcf_file} is gzip but not bgzip compressed. Decompressing with a single thread.')
+        return gzip.open(vcf_file, 'rb' if binary else 'rt')
+    return open(vcf_file, 'rb' if binary else 'r')
 
 def map_individuals(sample_sheet):
     '''
@@ -31,48 +137,56 @@ def map_individuals(sample_sheet):
     #print(ind_map)
     return(ind_map)
 
-def get_vcf_dimensions(vcf_file, pate_flag, ind_map):
+def check_individuals(ind_map, tax_list):
     """
-    Get the number of individuals and number of sites from the vcf in order to get dimensions for allocation of numpy arrays.
-    Perform an additional check to ensure that all individuals specified in the ind_map are present in the vcf.
+    Confirm that all individuals specified in the ind_map are present in the list of individuals from the vcf.
+    Lists the mismatches, with the closest individuals in the vcf, and stops if any individual is missing.
     """
-    n_tax = 0
-    n_sites = 0
-    skip_header = 1
-    tax_list = []
-    with open(vcf_file,'r') as fh:
-        for line in fh:
-            line = line.strip()
-            if '#CHROM' in line:
-                temp = line.split()
-                #print(line)
-                for i in range(9, len(temp)):
-                    this_tax = ''
-                    if '/' in temp[i]:
-                        if pate_flag == False:
-                            tax_path = temp[i].split('/')
-                            this_tax = tax_path[-1]
-                        elif pate_flag == True:
-                            tax_path = temp[i].split('/')
-                            this_tax = tax_path[-2]
-                    else:
-                        this_tax = temp[i]
-                    #print(this_tax)
-                    tax_list.append(this_tax)
-                    if this_tax in ind_map.keys():
-                        n_tax = n_tax + 1
-                skip_header = 0
-            else:
-                if skip_header == 0:
-                    temp = line.split()
-                    if (temp[6] == 'PASS' or ((pate_flag == True) and temp[6] == '.')):
-                        n_sites = n_sites + 1
-    if n_tax < len(ind_map.keys()):
+    tax_set = set(tax_list)
+    missing = [i for i in ind_map.keys() if i not in tax_set]
+    if len(missing) > 0:
         logging.warning('Not all indivuals in mapping file are present in VCF. Checking for mismatches...')
-        for i in ind_map.keys():
-            if i not in tax_list:
-                logging.warning(f'{i} found in mapping file but not VCF!')
+        unmatched = [str(i) for i in tax_list if i not in ind_map]
+        for i in missing:
+            close_matches = difflib.get_close_matches(str(i), unmatched, n=3)
+            suggestion = f' Closest individuals in VCF: {", ".join(close_matches)}' if len(close_matches) > 0 else ''
+            logging.warning(f'{i} found in mapping file but not VCF!{suggestion}')
         logging.error('Stopping to make corrections to mapping file!')
-        sys.exit()
-    logging.info(f'Found {n_sites} sites and {n_tax} individuals')
-    return n_sites,n_tax
+        sys.exit(f'ERROR: {len(missing)} individuals in the mapping file are not in the VCF: {", ".join(str(i) for i in missing)}')
+
+def resolve_individual(column, pate_flag):
+    """
+    Returns the individual label of a sample column of the #CHROM line. Paths are resolved to their file name,
+    or to their parent directory for VCFs from the PATE pipeline.
+    """
+    if '/' in column:
+        tax_path = column.split('/')
+        return tax_path[-2] if pate_flag == True else tax_path[-1]
+    return column
+
+def read_vcf_individuals(vcf_file, pate_flag):
+    """
+    Returns the individual labels of the sample columns of a vcf, reading only up to the #CHROM header line.
+    """
+    with open_vcf(vcf_file, binary=True) as fh:
+        for line in fh:
+            if line.startswith(b'#CHROM'):
+                return [resolve_individual(column, pate_flag) for column in line.decode().strip().split()[9:]]
+            if not line.startswith(b'#'):
+                break
+    raise ValueError(f'{vcf_file} is missing the #CHROM header line.')
+
+def validate_individuals(ind_map, vcf_file, pate_flag):
+    """
+    Confirm that all individuals in the ind_map are in the vcf from its header alone, before any records are read.
+    Streams can only be read once, so their header is checked when they are parsed instead.
+
+    Returns:
+        tax_list (list): the individual labels of the vcf in column order, or None for a stream
+    """
+    if is_stream(vcf_file):
+        return None
+    tax_list = read_vcf_individuals(vcf_file, pate_flag)
+    check_individuals(ind_map, tax_list)
+    logging.info(f'Found all {len(ind_map)} individuals of the mapping file among the {len(tax_list)} individuals in {vcf_file}')
+    return tax_list
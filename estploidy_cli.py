@@ -48,7 +48,7 @@ def cli():
 @cli.command(context_settings={'help_option_names': ['-h','--help']})
 @click.argument('sample_sheet',type=str)
 @click.option('-v', '--vcf_file', type=str, default='dummy.vcf', required=True,
-              help = 'name of the input vcf file. should not be compressed.'
+              help = 'name of the input vcf file. may be uncompressed, gzip, or bgzip compressed. use - to read from standard input, e.g. piped from bcftools view. named pipes are also read as streams.'
 )
 @click.option('-i', '--imputation_method', type=str, default='drop', required=False,
               help = 'decide how to impute missing data if at all. options are: drop, mean, and popmean'
@@ -68,25 +68,66 @@ def cli():
 @click.option('-o', '--output_dir', type=str, default='dummy', required=False,
               help = 'name of the directory where . will be a matrix of allele frequencies'
 )
+@click.option('-t', '--threads', type=int, default=1, required=False,
+              help = 'The number of processes used to parse an uncompressed or bgzip compressed VCF in parallel shards, of threads used to decompress a bgzip compressed VCF that is read serially, such as for region queries, and of processes used to write the individual frequency files'
+)
+@click.option('-r', '--regions', type=str, default=None, required=False,
+              help = 'Comma-separated regions to analyze as chr, chr:pos, or chr:beg-end. Uses the .tbi or .csi index of a bgzip compressed VCF when available'
+)
+@click.option('-R', '--regions_file', type=str, default=None, required=False,
+              help = 'A tab-delimited file of regions to analyze. Files ending in .bed are 0-based, otherwise chr, pos or chr, beg, end are 1-based'
+)
+@click.option('-C', '--cache_dir', type=str, default=None, required=False,
+              help = 'A directory for parsed allele balance arrays. Later runs with the same VCF, sample sheet, and filters reuse them instead of parsing the VCF again'
+)
+@click.option('-S', '--scratch_dir', type=str, default=None, required=False,
+              help = 'A directory for temporary memory-mapped arrays. Processes cohorts larger than memory by keeping the parsed VCF on disk'
+)
+@click.option('-w', '--working_set', type=int, default=1024, required=False,
+              help = 'The approximate memory in MB used at a time to compute allele balance arrays from the read counts, in memory or memory-mapped with --scratch_dir, and to write the table of --export_dir'
+)
+@click.option('-x', '--export_dir', type=str, default=None, required=False,
+              help = 'A directory for a long-format table of read counts, genotype qualities, and filters with chromosome and position. Written as parquet when pyarrow is installed, otherwise as compressed npz archives'
+)
+@click.option('-P', '--export_partition', type=str, default='individual', required=False,
+              help = 'Partition the exported table by individual or chrom'
+)
+@click.option('-Q', '--min_site_quality', type=float, default=None, required=False,
+              help = 'The minimum site QUAL. Sites below it are skipped before their genotypes are read'
+)
+@click.option('-D', '--min_site_depth', type=int, default=None, required=False,
+              help = 'The minimum combined depth in INFO/DP. Sites below it are skipped before their genotypes are read'
+)
+@click.option('-A', '--max_alt_alleles', type=int, default=None, required=False,
+              help = 'The maximum number of alternate alleles. Sites with more are skipped before their genotypes are read'
+)
 
-def individual_frequencies(sample_sheet, vcf_file, minimum_depth, minimum_count, minimum_quality, imputation_method, pate_flag, output_dir):
+def individual_frequencies(sample_sheet, vcf_file, minimum_depth, minimum_count, minimum_quality, imputation_method, pate_flag, output_dir, threads, regions, regions_file, cache_dir, scratch_dir, working_set, export_dir, export_partition, min_site_quality, min_site_depth, max_alt_alleles):
     from estploidy.utils import map_individuals
+    from estploidy.utils import validate_individuals
     from estploidy.utils import check_dir
-    from estploidy.utils import get_vcf_dimensions
+    from estploidy.utils import make_scratch_dir
     from estploidy.calculate_frequencies.calculate_frequencies import get_ind_freqs
+    from estploidy.tabix import parse_regions
+    from estploidy.calculate_frequencies.site_filters import make_site_filters
 
     start_time = time.process_time()
     logging.info(f'Begin at {start_time}')
     logging.info(f'Checking all individuals in {sample_sheet} are present in {vcf_file}')
     ind_map = map_individuals(sample_sheet)
-    logging.info(f'Checking dimensions of VCF')
-    n_sites, n_tax = get_vcf_dimensions(vcf_file, pate_flag, ind_map)
+    validate_individuals(ind_map, vcf_file, pate_flag)
+    region_map = None
+    if (regions is not None) or (regions_file is not None):
+        region_map = parse_regions(regions, regions_file)
+        logging.info(f'Restricting analysis to regions on {len(region_map)} chromosomes')
+    site_filters = make_site_filters(min_site_quality, min_site_depth, max_alt_alleles)
     logging.info(f'Calculating individual allele frequencies from {vcf_file}')
     if (imputation_method == 'drop'):
         if (output_dir != 'dummy'):
             check_dir(output_dir)
             logging.info(f'Matrix of allele frequencies for each individual will be written to: {output_dir}')
-        get_ind_freqs(n_sites, n_tax, ind_map, vcf_file, minimum_depth, minimum_count, minimum_quality, pate_flag, output_dir)
+        with make_scratch_dir(scratch_dir) as scratch:
+            get_ind_freqs(ind_map, vcf_file, minimum_depth, minimum_count, minimum_quality, pate_flag, output_dir, threads, region_map, cache_dir, scratch, working_set * 1024 * 1024, export_dir, export_partition, site_filters)
         
     else:
         click.echo(f'Warning: Imputation method {imputation_method} is not supported. Skipping allele frequencies.')
@@ -100,7 +141,7 @@ def individual_frequencies(sample_sheet, vcf_file, minimum_depth, minimum_count,
 @cli.command(context_settings={'help_option_names': ['-h','--help']})
 @click.argument('sample_sheet',type=str)
 @click.option('-v', '--vcf_file', type=str, default='dummy.vcf', required=True,
-              help = 'name of the input vcf file. should not be compressed.'
+              help = 'name of the input vcf file. may be uncompressed, gzip, or bgzip compressed. use - to read from standard input, e.g. piped from bcftools view. named pipes are also read as streams.'
 )
 @click.option('-i', '--imputation_method', type=str, default='drop', required=False,
               help = 'decide how to impute missing data if at all. options are: drop, mean, and popmean'
@@ -132,26 +173,85 @@ def individual_frequencies(sample_sheet, vcf_file, minimum_depth, minimum_count,
 @click.option('-e', '--model_contraints', type=int, default=2, required=False,
               help = 'What parameters should be contrained in the model. 0 is none, 1 is means, and 2 is means and weights.'
 )
-def estimate_ploidy(sample_sheet, vcf_file, minimum_depth, minimum_count, minimum_quality, imputation_method, estimation_method, ploidy_levels, pate_flag, minimum_sites, model_contraints, output_dir):
+@click.option('-t', '--threads', type=int, default=1, required=False,
+              help = 'The number of processes used to parse an uncompressed or bgzip compressed VCF in parallel shards, of threads used to decompress a bgzip compressed VCF that is read serially, such as for region queries, and of processes used to write the individual frequency files'
+)
+@click.option('-r', '--regions', type=str, default=None, required=False,
+              help = 'Comma-separated regions to analyze as chr, chr:pos, or chr:beg-end. Uses the .tbi or .csi index of a bgzip compressed VCF when available'
+)
+@click.option('-R', '--regions_file', type=str, default=None, required=False,
+              help = 'A tab-delimited file of regions to analyze. Files ending in .bed are 0-based, otherwise chr, pos or chr, beg, end are 1-based'
+)
+@click.option('-C', '--cache_dir', type=str, default=None, required=False,
+              help = 'A directory for parsed allele balance arrays. Later runs with the same VCF, sample sheet, and filters reuse them instead of parsing the VCF again'
+)
+@click.option('-S', '--scratch_dir', type=str, default=None, required=False,
+              help = 'A directory for temporary memory-mapped arrays. Processes cohorts larger than memory by keeping the parsed VCF on disk'
+)
+@click.option('-w', '--working_set', type=int, default=1024, required=False,
+              help = 'The approximate memory in MB used at a time to compute allele balance arrays from the read counts, in memory or memory-mapped with --scratch_dir'
+)
+@click.option('-Q', '--min_site_quality', type=float, default=None, required=False,
+              help = 'The minimum site QUAL. Sites below it are skipped before their genotypes are read'
+)
+@click.option('-D', '--min_site_depth', type=int, default=None, required=False,
+              help = 'The minimum combined depth in INFO/DP. Sites below it are skipped before their genotypes are read'
+)
+@click.option('-A', '--max_alt_alleles', type=int, default=None, required=False,
+              help = 'The maximum number of alternate alleles. Sites with more are skipped before their genotypes are read'
+)
+@click.option('-M', '--max_sites_per_individual', type=int, default=None, required=False,
+              help = 'The maximum number of passing sites per individual used to fit mixtures. A uniform random sample of the passing sites of each individual is kept while allele balance is computed, which bounds the memory and time of the fits. The full matrix is still built and written to the individual files, so it does not bound the memory used to parse the VCF'
+)
+@click.option('-z', '--seed', type=int, default=0, required=False,
+              help = 'The random seed used to sample sites with --max_sites_per_individual'
+)
+@click.option('-b', '--gmm_backend', type=str, default='em1d', required=False,
+              help = 'The implementation of mixtures with fixed means or weights: em1d for closed-form one-dimensional EM, or sklearn'
+)
+@click.option('-I', '--gmm_init', type=str, default='means', required=False,
+              help = 'The initialization of mixtures with fixed means: means to start from the fixed means, or kmeans to start from a k-means clustering'
+)
+@click.option('-B', '--batched', type=bool, default=False, required=False,
+              help = 'Fit individuals with few sites together in one vectorized EM. Applies to the em1d backend started from the means with fixed means'
+)
+@click.option('-j', '--jobs', type=int, default=1, required=False,
+              help = 'The number of processes fitting individuals in parallel, each limited to one BLAS thread'
+)
+@click.option('-W', '--bin_width', type=float, default=0, required=False,
+              help = 'Fit mixtures with fixed means to a histogram of allele balance weighted by counts. 0 merges identical values without changing the likelihood, and a positive value merges values within bins of that width'
+)
+@click.option('-E', '--per_site', type=bool, default=False, required=False,
+              help = 'Fit mixtures to every site instead of a histogram, ignoring --bin_width'
+)
+def estimate_ploidy(sample_sheet, vcf_file, minimum_depth, minimum_count, minimum_quality, imputation_method, estimation_method, ploidy_levels, pate_flag, minimum_sites, model_contraints, output_dir, threads, regions, regions_file, cache_dir, scratch_dir, working_set, min_site_quality, min_site_depth, max_alt_alleles, max_sites_per_individual, seed, gmm_backend, gmm_init, batched, jobs, bin_width, per_site):
     from estploidy.utils import map_individuals
+    from estploidy.utils import validate_individuals
     from estploidy.utils import check_dir
-    from estploidy.utils import get_vcf_dimensions
+    from estploidy.utils import make_scratch_dir
     from estploidy.calculate_frequencies.calculate_frequencies import get_ind_freqs
+    from estploidy.tabix import parse_regions
+    from estploidy.calculate_frequencies.site_filters import make_site_filters
     from estploidy.fit_mixtures.fit_mixtures import est_ploidy
 
     start_time = time.process_time()
     logging.info(f'Begin at {start_time}')
     logging.info(f'Checking all individuals in {sample_sheet} are present in {vcf_file}')
     ind_map = map_individuals(sample_sheet)
-    logging.info(f'Checking dimensions of VCF')
-    n_sites, n_tax = get_vcf_dimensions(vcf_file, pate_flag, ind_map)
+    validate_individuals(ind_map, vcf_file, pate_flag)
+    region_map = None
+    if (regions is not None) or (regions_file is not None):
+        region_map = parse_regions(regions, regions_file)
+        logging.info(f'Restricting analysis to regions on {len(region_map)} chromosomes')
+    site_filters = make_site_filters(min_site_quality, min_site_depth, max_alt_alleles)
     logging.info(f'Calculating individual allele frequencies from {vcf_file}')
     if (imputation_method == 'drop'):
         if (output_dir != 'dummy'):
             check_dir(output_dir)
             logging.info(f'Matrix of allele frequencies for each individual will be written to: {output_dir}')
-            tax_list, ab_mat = get_ind_freqs(n_sites, n_tax, ind_map, vcf_file, minimum_depth, minimum_count, minimum_quality, pate_flag, output_dir)
-            ploidy_df = est_ploidy(tax_list, ab_mat, estimation_method, ploidy_levels, minimum_sites, model_contraints, output_dir)
+            with make_scratch_dir(scratch_dir) as scratch:
+                tax_list, ab_mat = get_ind_freqs(ind_map, vcf_file, minimum_depth, minimum_count, minimum_quality, pate_flag, output_dir, threads, region_map, cache_dir, scratch, working_set * 1024 * 1024, site_filters=site_filters, max_sites=max_sites_per_individual, seed=seed)
+                ploidy_df = est_ploidy(tax_list, ab_mat, estimation_method, ploidy_levels, minimum_sites, model_contraints, output_dir, gmm_backend, gmm_init, batched, jobs, None if per_site else bin_width)
             logging.info('Ploidy estimates returned based on Gaussian mixture models')
             logging.info(ploidy_df.head())
     else:
@@ -17,7 +17,8 @@ setup(
         'pandas>=2.2.2',
         'scikit-learn>=1.5.1',
         'click>=8.1.7',
-        'matplotlib>=3.10.5'
+        'matplotlib>=3.10.5',
+        'threadpoolctl>=3.1.0'
     ],
     entry_points = '''
         [console_scripts]
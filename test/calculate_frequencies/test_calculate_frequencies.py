@@ -0,0 +1,639 @@
+import numpy as np
+import pytest
+import tempfile
+import gzip
+import io
+import struct
+import zlib
+import os
+import threading
+from estploidy.calculate_frequencies.calculate_frequencies import get_ind_freqs, iter_site_batches, load_allele_counts
+from estploidy.calculate_frequencies.calculate_frequencies import SiteBlocks
+from estploidy.calculate_frequencies.allele_counts import AlleleCounts
+from estploidy.calculate_frequencies.write_output import write_individual_files
+from estploidy.calculate_frequencies.export import export_long_table
+from estploidy.calculate_frequencies.coordinates import SiteCoordinates
+from estploidy.calculate_frequencies.site_filters import SiteFilters
+from estploidy.calculate_frequencies.calculate_frequencies import parse_records, parse_record_lines
+from estploidy.tabix import parse_regions, in_regions, RegionIndex
+from estploidy.shards import plan_shards, iter_shard_lines
+from estploidy.utils import validate_individuals
+
+def write_test_vcf(vcf_file, tax_names, n_sites, seed=1, pos_step=1):
+    """
+    Write a small multisample vcf with GT:AD:DP:GQ:PL genotype fields and a mix of PASS and filtered sites
+    """
+    rng = np.random.default_rng(seed)
+    expected = []
+    with open(vcf_file, 'w') as fh:
+        fh.write('##fileformat=VCFv4.2\n')
+        fh.write('##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">\n')
+        fh.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t' + '\t'.join(tax_names) + '\n')
+        for j in range(n_sites):
+            chrom = f'chr{1 + (j * 3) // n_sites}'
+            filter_value = 'PASS' if rng.random() < 0.8 else 'LowQual'
+            cells = []
+            site = []
+            for i in range(len(tax_names)):
+                ref_counts = int(rng.integers(0, 40))
+                alt_counts = int(rng.integers(0, 40))
+                genotype_quality = int(rng.integers(0, 99))
+                if rng.random() < 0.05:
+                    cells.append('./.:.:.:.:.')
+                    site.append(None)
+                else:
+                    cells.append(f'0/1:{ref_counts},{alt_counts}:{ref_counts + alt_counts}:{genotype_quality}:0,0,0')
+                    site.append((ref_counts, alt_counts, genotype_quality))
+            fh.write(f'{chrom}\t{j * pos_step + 1}\t.\tA\tT\t50\t{filter_value}\t.\tGT:AD:DP:GQ:PL\t' + '\t'.join(cells) + '\n')
+            if filter_value == 'PASS':
+                expected.append(site)
+    return expected
+
+def assert_site_data_equal(site_data, expected):
+    """
+    Check that every field of two SiteData objects holds the same values and dtype
+    """
+    assert site_data.tax_list == expected.tax_list
+    for field, expected_field in zip(site_data.fields(), expected.fields()):
+        assert field.dtype == expected_field.dtype
+        assert np.array_equal(field, expected_field)
+
+def write_bgzf(file_name, data, block_size=4096):
+    """
+    Compress data into BGZF blocks of at most block_size uncompressed bytes, followed by the empty EOF block.
+    Returns the compressed offset of each block.
+    """
+    block_offsets = []
+    with open(file_name, 'wb') as fh:
+        for i in list(range(0, len(data), block_size)) + [len(data)]:
+            block_offsets.append(fh.tell())
+            chunk = data[i:i + block_size]
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            cdata = compressor.compress(chunk) + compressor.flush()
+            fh.write(b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00')
+            fh.write(struct.pack('<H', len(cdata) + 25))
+            fh.write(cdata)
+            fh.write(struct.pack('<II', zlib.crc32(chunk), len(chunk)))
+    return block_offsets
+
+def write_tbi(index_file, data, block_offsets, block_size=4096):
+    """
+    Write a tabix index with leaf bins and a linear index for the records of an uncompressed vcf
+    """
+    def virtual_offset(p):
+        return (block_offsets[p // block_size] << 16) | (p % block_size)
+    names = []
+    refs = {}
+    p = 0
+    for line in data.split(b'\n')[:-1]:
+        line_end = p + len(line) + 1
+        if not line.startswith(b'#'):
+            temp = line.split(b'\t')
+            chrom = temp[0].decode()
+            beg = int(temp[1]) - 1
+            if chrom not in refs:
+                names.append(chrom)
+                refs[chrom] = ({}, [])
+            bins, linear = refs[chrom]
+            chunks = bins.setdefault(4681 + (beg >> 14), [])
+            if (len(chunks) > 0) and (chunks[-1][1] == virtual_offset(p)):
+                chunks[-1][1] = virtual_offset(line_end)
+            else:
+                chunks.append([virtual_offset(p), virtual_offset(line_end)])
+            while len(linear) <= (beg >> 14):
+                linear.append(virtual_offset(p))
+        p = line_end
+    names_data = b''.join(name.encode() + b'\x00' for name in names)
+    index = b'TBI\x01' + struct.pack('<8i', len(names), 2, 1, 2, 0, ord('#'), 0, len(names_data)) + names_data
+    for chrom in names:
+        bins, linear = refs[chrom]
+        index = index + struct.pack('<i', len(bins))
+        for bin_id, chunks in bins.items():
+            index = index + struct.pack('<Ii', bin_id, len(chunks))
+            for chunk_beg, chunk_end in chunks:
+                index = index + struct.pack('<QQ', chunk_beg, chunk_end)
+        index = index + struct.pack('<i', len(linear)) + struct.pack(f'<{len(linear)}Q', *linear)
+    with gzip.open(index_file, 'wb') as fh:
+        fh.write(index)
+
+def write_csi(index_file, data, block_offsets, block_size=4096, min_shift=12, depth=6):
+    """
+    Write a CSI index with leaf bins and their smallest offsets for the records of an uncompressed vcf
+    """
+    def virtual_offset(p):
+        return (block_offsets[p // block_size] << 16) | (p % block_size)
+    leaf_offset = ((1 << (3 * depth)) - 1) // 7
+    names = []
+    refs = {}
+    p = 0
+    for line in data.split(b'\n')[:-1]:
+        line_end = p + len(line) + 1
+        if not line.startswith(b'#'):
+            temp = line.split(b'\t')
+            chrom = temp[0].decode()
+            beg = int(temp[1]) - 1
+            if chrom not in refs:
+                names.append(chrom)
+                refs[chrom] = {}
+            chunks = refs[chrom].setdefault(leaf_offset + (beg >> min_shift), [])
+            if (len(chunks) > 0) and (chunks[-1][1] == virtual_offset(p)):
+                chunks[-1][1] = virtual_offset(line_end)
+            else:
+                chunks.append([virtual_offset(p), virtual_offset(line_end)])
+        p = line_end
+    names_data = b''.join(name.encode() + b'\x00' for name in names)
+    aux = struct.pack('<7i', 2, 1, 2, 0, ord('#'), 0, len(names_data)) + names_data
+    index = b'CSI\x01' + struct.pack('<3i', min_shift, depth, len(aux)) + aux + struct.pack('<i', len(names))
+    for chrom in names:
+        bins = refs[chrom]
+        index = index + struct.pack('<i', len(bins))
+        for bin_id, chunks in bins.items():
+            index = index + struct.pack('<IQi', bin_id, chunks[0][0], len(chunks))
+            for chunk_beg, chunk_end in chunks:
+                index = index + struct.pack('<QQ', chunk_beg, chunk_end)
+    with gzip.open(index_file, 'wb') as fh:
+        fh.write(index)
+
+def test_get_ind_freqs():
+    """
+    Test that allele balance, depth, quality, and filters are recovered from a vcf in a single pass
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tax_names = ['ind1', 'ind2', 'ind3']
+        vcf_file = f'{temp_dir}/test.vcf'
+        expected = write_test_vcf(vcf_file, tax_names, 500)
+        ind_map = {'ind3': {'population': 'pop1'}, 'ind1': {'population': 'pop1'}}
+        tax_list, ab_dat = get_ind_freqs(ind_map, vcf_file, 10, 3, 20, False, 'dummy')
+        assert tax_list == ['ind1', 'ind3']
+        assert (ab_dat.n_sites, ab_dat.n_tax) == (len(expected), 2)
+        assert [field.dtype for field in ab_dat.fields()] == [np.float32, np.uint16, np.uint8, np.bool_]
+        assert all(field[:, k].flags['C_CONTIGUOUS'] for field in ab_dat.fields() for k in range(ab_dat.n_tax))
+        assert np.array_equal(ab_dat.passing_allele_balance(1), ab_dat.allele_balance[:, 1][ab_dat.pass_filters[:, 1]])
+        for j in range(len(expected)):
+            for k, i in enumerate([0, 2]):
+                if expected[j][i] is None:
+                    assert ab_dat[1, j, k] == 0 and ab_dat[3, j, k] == 0
+                    continue
+                ref_counts, alt_counts, genotype_quality = expected[j][i]
+                total_count = ref_counts + alt_counts
+                allele_balance = alt_counts / total_count if total_count > 0 else 0
+                indicator = (total_count >= 10) and (ref_counts >= 1) and (alt_counts >= 3) and (genotype_quality >= 20)
+                assert np.isclose(ab_dat[0, j, k], allele_balance)
+                assert ab_dat[1, j, k] == total_count
+                assert ab_dat[2, j, k] == genotype_quality
+                assert ab_dat[3, j, k] == indicator
+
+def test_get_ind_freqs_compressed():
+    """
+    Test that gzip and bgzip compressed vcfs give the same result as the uncompressed vcf
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tax_names = ['ind1', 'ind2', 'ind3']
+        vcf_file = f'{temp_dir}/test.vcf'
+        write_test_vcf(vcf_file, tax_names, 300)
+        with open(vcf_file, 'rb') as fh:
+            data = fh.read()
+        with gzip.open(f'{vcf_file}.gz', 'wb') as fh:
+            fh.write(data)
+        write_bgzf(f'{vcf_file}.bgz', data)
+        ind_map = {i: {'population': 'pop1'} for i in tax_names}
+        tax_list, ab_dat = get_ind_freqs(ind_map, vcf_file, 10, 3, 20, False, 'dummy')
+        for compressed_file, threads in [(f'{vcf_file}.gz', 1), (f'{vcf_file}.bgz', 1), (f'{vcf_file}.bgz', 4)]:
+            compressed_tax_list, compressed_ab_dat = get_ind_freqs(ind_map, compressed_file, 10, 3, 20, False, 'dummy', threads)
+            assert compressed_tax_list == tax_list
+            assert_site_data_equal(compressed_ab_dat, ab_dat)
+
+def test_get_ind_freqs_regions():
+    """
+    Test that region queries through a tabix or CSI index match a full scan of the vcf restricted to the same regions
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tax_names = ['ind1', 'ind2', 'ind3']
+        vcf_file = f'{temp_dir}/test.vcf'
+        write_test_vcf(vcf_file, tax_names, 600, pos_step=1000)
+        with open(vcf_file, 'rb') as fh:
+            data = fh.read()
+        block_offsets = write_bgzf(f'{vcf_file}.gz', data)
+        write_tbi(f'{vcf_file}.gz.tbi', data, block_offsets)
+        ind_map = {i: {'population': 'pop1'} for i in tax_names}
+        region_map = parse_regions('chr1:20001-50000,chr3,chr2:150001', None)
+        n_expected = 0
+        for line in data.decode().split('\n'):
+            temp = line.split('\t')
+            if (len(temp) > 6) and (not line.startswith('#')) and (temp[6] == 'PASS'):
+                if in_regions(region_map, temp[0], int(temp[1]) - 1, int(temp[1])):
+                    n_expected = n_expected + 1
+        tax_list, ab_dat = get_ind_freqs(ind_map, vcf_file, 10, 3, 20, False, 'dummy', region_map=region_map)
+        assert (ab_dat.n_sites, ab_dat.n_tax) == (n_expected, 3)
+        for threads in [1, 3]:
+            indexed_tax_list, indexed_ab_dat = get_ind_freqs(ind_map, f'{vcf_file}.gz', 10, 3, 20, False, 'dummy', threads, region_map)
+            assert_site_data_equal(indexed_ab_dat, ab_dat)
+        # The same regions through a CSI index, which has no linear index and finds the first record from bin offsets
+        block_offsets = write_bgzf(f'{vcf_file}.bgz', data)
+        write_csi(f'{vcf_file}.bgz.csi', data, block_offsets)
+        assert RegionIndex(f'{vcf_file}.bgz.csi').names == ['chr1', 'chr2', 'chr3']
+        for threads in [1, 3]:
+            indexed_tax_list, indexed_ab_dat = get_ind_freqs(ind_map, f'{vcf_file}.bgz', 10, 3, 20, False, 'dummy', threads, region_map)
+            assert_site_data_equal(indexed_ab_dat, ab_dat)
+
+def test_plan_shards():
+    """
+    Test that shards of uncompressed and bgzip compressed vcfs cover every record exactly once and in order
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        vcf_file = f'{temp_dir}/test.vcf'
+        write_test_vcf(vcf_file, ['ind1', 'ind2', 'ind3'], 200)
+        with open(vcf_file, 'rb') as fh:
+            data = fh.read()
+        records = [line for line in data.split(b'\n') if (line != b'') and (not line.startswith(b'#'))]
+        # Small blocks make records span several bgzip blocks
+        write_bgzf(f'{vcf_file}.gz', data, block_size=50)
+        for test_file in [vcf_file, f'{vcf_file}.gz']:
+            for n_shards in [1, 2, 7, 64]:
+                shards = plan_shards(test_file, n_shards)
+                assert len(shards) <= n_shards
+                shard_records = []
+                for shard in shards:
+                    shard_records.extend(iter_shard_lines(test_file, shard))
+                assert shard_records == records
+
+def test_get_ind_freqs_threads():
+    """
+    Test that parsing shards in parallel processes gives the same result as a single process
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tax_names = ['ind1', 'ind2', 'ind3']
+        vcf_file = f'{temp_dir}/test.vcf'
+        write_test_vcf(vcf_file, tax_names, 400)
+        with open(vcf_file, 'rb') as fh:
+            write_bgzf(f'{vcf_file}.gz', fh.read(), block_size=1000)
+        ind_map = {i: {'population': 'pop1'} for i in tax_names}
+        tax_list, ab_dat = get_ind_freqs(ind_map, vcf_file, 10, 3, 20, False, 'dummy')
+        for test_file in [vcf_file, f'{vcf_file}.gz']:
+            sharded_tax_list, sharded_ab_dat = get_ind_freqs(ind_map, test_file, 10, 3, 20, False, 'dummy', 3)
+            assert sharded_tax_list == tax_list
+            assert_site_data_equal(sharded_ab_dat, ab_dat)
+
+def test_get_ind_freqs_format_order():
+    """
+    Test that AD and GQ are found from the FORMAT column when fields are reordered on some lines
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tax_names = ['ind1', 'ind2', 'ind3']
+        vcf_file = f'{temp_dir}/test.vcf'
+        write_test_vcf(vcf_file, tax_names, 300)
+        ind_map = {i: {'population': 'pop1'} for i in tax_names}
+        tax_list, ab_dat = get_ind_freqs(ind_map, vcf_file, 10, 3, 20, False, 'dummy')
+        reordered_file = f'{temp_dir}/reordered.vcf'
+        with open(vcf_file, 'r') as fh, open(reordered_file, 'w') as outfile:
+            for j, line in enumerate(fh):
+                temp = line.rstrip('\n').split('\t')
+                if line.startswith('#') or (j % 2 == 0):
+                    outfile.write(line)
+                    continue
+                # GT:AD:DP:GQ:PL -> GT:DP:GQ:AD with missing cells truncated to GT
+                temp[8] = 'GT:DP:GQ:AD'
+                for i in range(9, len(temp)):
+                    fields = temp[i].split(':')
+                    temp[i] = fields[0] if fields[1] == '.' else ':'.join([fields[0], fields[2], fields[3], fields[1]])
+                outfile.write('\t'.join(temp) + '\n')
+        reordered_tax_list, reordered_ab_dat = get_ind_freqs(ind_map, reordered_file, 10, 3, 20, False, 'dummy')
+        assert_site_data_equal(reordered_ab_dat, ab_dat)
+
+def test_parse_records_vectorized():
+    """
+    Test that the vectorized block parser matches the line by line parser on mixed, missing, and malformed genotype fields
+    """
+    vcf_map = {9: 'ind1', 10: 'ind2', 12: 'ind4'}
+    vcf_index = {'ind1': 0, 'ind2': 1, 'ind4': 2}
+    records = [
+        'chr1\t1\t.\tA\tT\t50\tPASS\t.\tGT:AD:DP:GQ:PL\t0/1:10,5:15:30:0,0,0\t0/1:3,20:23:99:0,0,0\t./.:.:.:.:.\t0/1:0,12:12:45:0,0,0',
+        'chr1\t2\t.\tA\tT\t50\t.\t.\tGT:DP:GQ:AD\t0/1:15:30:10,5\t./.\t0/1:3:2:1,2\t0/1:12:.:7,5,3',
+        'chr1\t3\t.\tA\tT\t50\tLowQual\t.\tGT:AD:GQ\t0/1:10,5:30\t0/1:10,5:30\t0/1:10,5:30\t0/1:10,5:30',
+        'chr2\t4\t.\tA\tT\t50\tPASS\t.\tGT:AD:GQ\t0/1:12:30\t0/1:x,5:30\t0/1:10,5:30\t0/1:100000,5:300',
+        'chr2\t5\t.\tA\tT\t50\tPASS\t.\tGT:GQ\t0/1:30\t0/1:30\t0/1:30\t0/1:30\r',
+        'chr2\t6\t.\tA\tT\t50\tPASS\t.\tGT:AD:GQ\t0/1:8,9:41\t0/1:,5:30\t0/1:10,5:30\t0/1:6,4:55\r',
+    ]
+    for pate_flag in [False, True]:
+        expected = parse_record_lines(records, vcf_map, vcf_index, pate_flag)
+        for test_records in [records, ('\n'.join(records) + '\n').encode()]:
+            arrays, coordinates = parse_records(test_records if isinstance(test_records, list) else io.BytesIO(test_records), vcf_map, vcf_index, pate_flag)
+            assert len(arrays[0]) == (5 if pate_flag else 4)
+            assert coordinates.pos.dtype == np.uint32
+            assert list(coordinates.pos) == ([1, 2, 4, 5, 6] if pate_flag else [1, 4, 5, 6])
+            assert list(coordinates.chromosomes()) == (['chr1', 'chr1', 'chr2', 'chr2', 'chr2'] if pate_flag else ['chr1', 'chr2', 'chr2', 'chr2'])
+            for array, expected_array in zip(arrays, expected):
+                assert array.dtype == expected_array.dtype
+                assert np.array_equal(array, expected_array)
+
+def test_parse_records_truncated_last_cell():
+    """
+    Test that a block whose last cell is a missing call without an AD subfield parses to zero counts
+    """
+    vcf_map = {9: 'ind1', 10: 'ind2'}
+    vcf_index = {'ind1': 0, 'ind2': 1}
+    records = [
+        'chr1\t1\t.\tA\tT\t50\tPASS\t.\tGT:AD:DP:GQ\t0/1:10,5:15:30\t0/1:3,2:5:30',
+        'chr1\t2\t.\tA\tT\t50\tPASS\t.\tGT:AD:DP:GQ\t0/1:10,5:15:30\t./.',
+    ]
+    expected = parse_record_lines(records, vcf_map, vcf_index, False)
+    for ending in ['\n', '\r\n']:
+        for subset_map, subset_index in [(vcf_map, vcf_index), ({10: 'ind2'}, {'ind2': 0})]:
+            arrays, coordinates = parse_records(io.BytesIO((ending.join(records) + ending).encode()), subset_map, subset_index, False)
+            for array, expected_array in zip(arrays, expected):
+                assert np.array_equal(array, expected_array[:, -len(subset_index):])
+    assert list(expected[0][1]) == [10, 0]
+
+def test_parse_records_missing_genotype_columns():
+    """
+    Test that a passing record with only the 8 fixed columns raises a descriptive error instead of an IndexError
+    """
+    vcf_map = {9: 'ind1'}
+    vcf_index = {'ind1': 0}
+    records = [
+        'chr1\t1\t.\tA\tT\t50\tPASS\t.\tGT:AD:DP:GQ\t0/1:10,5:15:30',
+        'chr1\t2\t.\tA\tT\t50\tPASS\t.',
+    ]
+    with pytest.raises(ValueError, match='chr1:2'):
+        parse_record_lines(records, vcf_map, vcf_index, False)
+    with pytest.raises(ValueError, match='chr1:2'):
+        parse_records(io.BytesIO(('\n'.join(records) + '\n').encode()), vcf_map, vcf_index, False)
+
+def test_parse_records_site_filters():
+    """
+    Test that sites are rejected on FILTER, QUAL, INFO/DP, and the number of ALT alleles by both parsers,
+    including fixed columns longer than the first window scanned for tabs
+    """
+    vcf_map = {9: 'ind1', 10: 'ind2'}
+    vcf_index = {'ind1': 0, 'ind2': 1}
+    long_info = 'DP=40;' + ';'.join(f'KEY{k}=1' for k in range(100))
+    sites = [
+        ('T', '50', 'PASS', 'DP=40;AF=0.5', [1, 2, 3]),
+        ('T', '5', 'PASS', 'DP=40', [2]),
+        ('T,G', '50', 'PASS', 'DP=40', [2, 3]),
+        ('T', '50', 'PASS', 'AF=0.5;DP=4', [1]),
+        ('T', '.', 'PASS', 'DP=40', [2]),
+        ('T', '50', 'PASS', 'ADP=40', [1]),
+        ('T', '50', 'LowQual', 'DP=40', []),
+        ('T', '50', 'PASS', long_info, [1, 2, 3]),
+        ('T,G,C', '99', 'PASS', long_info, [2]),
+    ]
+    records = []
+    for j, (alt, qual, filter_value, info, _) in enumerate(sites):
+        records.append(f'chr1\t{j + 1}\t.\tA\t{alt}\t{qual}\t{filter_value}\t{info}\tGT:AD:GQ\t0/1:{j},5:30\t0/1:4,{j}:40')
+    site_filters = [SiteFilters(), SiteFilters(min_quality=20, max_alt_alleles=1), SiteFilters(min_depth=10), SiteFilters(min_quality=10, min_depth=10, max_alt_alleles=2)]
+    for k, this_filter in enumerate(site_filters):
+        expected = [j + 1 for j, site in enumerate(sites) if (site[2] == 'PASS') and ((k == 0) or (k in site[4]))]
+        arrays, coordinates = parse_records(io.BytesIO(('\n'.join(records) + '\n').encode()), vcf_map, vcf_index, False, site_filters=this_filter)
+        assert list(coordinates.pos) == expected
+        assert list(arrays[0][:, 0]) == [j - 1 for j in expected]
+        line_coordinates = []
+        line_arrays = parse_record_lines(records, vcf_map, vcf_index, False, coordinates=line_coordinates, site_filters=this_filter)
+        assert list(line_coordinates[0][1]) == expected
+        for array, line_array in zip(arrays, line_arrays):
+            assert np.array_equal(array, line_array)
+
+def test_get_ind_freqs_subset():
+    """
+    Test that processing a few individuals from a wide vcf gives the same columns as processing every individual
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tax_names = [f'ind{i}' for i in range(12)]
+        vcf_file = f'{temp_dir}/test.vcf'
+        write_test_vcf(vcf_file, tax_names, 200)
+        tax_list, ab_dat = get_ind_freqs({i: {} for i in tax_names}, vcf_file, 10, 3, 20, False, 'dummy')
+        subset_tax_list, subset_ab_dat = get_ind_freqs({'ind7': {}, 'ind2': {}}, vcf_file, 10, 3, 20, False, 'dummy')
+        assert subset_tax_list == ['ind2', 'ind7']
+        for subset_field, field in zip(subset_ab_dat.fields(), ab_dat.fields()):
+            assert np.array_equal(subset_field, field[:, [2, 7]])
+
+def test_iter_site_batches():
+    """
+    Test that streamed batches have the requested size and together match the arrays of get_ind_freqs
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tax_names = ['ind1', 'ind2', 'ind3']
+        vcf_file = f'{temp_dir}/test.vcf'
+        write_test_vcf(vcf_file, tax_names, 300, pos_step=7)
+        ind_map = {i: {} for i in tax_names}
+        tax_list, ab_dat = get_ind_freqs(ind_map, vcf_file, 10, 3, 20, False, 'dummy')
+        with open(vcf_file) as fh:
+            passing = [line.split('\t')[:2] for line in fh if not line.startswith('#') and line.split('\t')[6] == 'PASS']
+        batches = list(iter_site_batches(vcf_file, ind_map, batch_size=37))
+        assert all(len(batch['pos']) == 37 for batch in batches[:-1])
+        assert 0 < len(batches[-1]['pos']) <= 37
+        assert batches[0]['tax_list'] == tax_list
+        assert batches[0]['depth'].dtype == np.uint16
+        assert list(np.concatenate([batch['chrom'] for batch in batches])) == [site[0] for site in passing]
+        assert np.array_equal(np.concatenate([batch['pos'] for batch in batches]), [int(site[1]) for site in passing])
+        keys = ['allele_balance', 'depth', 'genotype_quality', 'pass_filters']
+        for k, key in enumerate(keys):
+            assert np.array_equal(np.concatenate([batch[key] for batch in batches]), ab_dat[k])
+
+def test_get_ind_freqs_cache():
+    """
+    Test that cached read counts are reused for the same VCF whatever the filters, and not after the VCF changes
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tax_names = ['ind1', 'ind2', 'ind3']
+        vcf_file = f'{temp_dir}/test.vcf'
+        cache_dir = f'{temp_dir}/cache'
+        write_test_vcf(vcf_file, tax_names, 100)
+        ind_map = {i: {} for i in tax_names}
+        tax_list, ab_dat = get_ind_freqs(ind_map, vcf_file, 10, 3, 20, False, 'dummy')
+        for _ in range(2):
+            cached_tax_list, cached_ab_dat = get_ind_freqs(ind_map, vcf_file, 10, 3, 20, False, 'dummy', cache_dir=cache_dir)
+            assert cached_tax_list == tax_list
+            assert_site_data_equal(cached_ab_dat, ab_dat)
+            assert len(os.listdir(cache_dir)) == 1
+        _, strict_ab_dat = get_ind_freqs(ind_map, vcf_file, 20, 5, 40, False, 'dummy')
+        _, cached_strict_ab_dat = get_ind_freqs(ind_map, vcf_file, 20, 5, 40, False, 'dummy', cache_dir=cache_dir)
+        assert_site_data_equal(cached_strict_ab_dat, strict_ab_dat)
+        assert len(os.listdir(cache_dir)) == 1
+        write_test_vcf(vcf_file, tax_names, 100, seed=2)
+        _, new_ab_dat = get_ind_freqs(ind_map, vcf_file, 10, 3, 20, False, 'dummy', cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir)) == 2
+        assert not np.array_equal(new_ab_dat.allele_balance, ab_dat.allele_balance)
+
+def test_get_ind_freqs_out_of_core():
+    """
+    Test that memory-mapped processing in a scratch directory gives the same arrays and output files as processing in memory
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tax_names = ['ind1', 'ind2', 'ind3', 'ind4']
+        vcf_file = f'{temp_dir}/test.vcf'
+        write_test_vcf(vcf_file, tax_names, 500)
+        ind_map = {i: {} for i in tax_names}
+        os.makedirs(f'{temp_dir}/memory')
+        tax_list, ab_dat = get_ind_freqs(ind_map, vcf_file, 10, 3, 20, False, f'{temp_dir}/memory')
+        for threads in [1, 3]:
+            scratch_dir = f'{temp_dir}/scratch{threads}'
+            output_dir = f'{temp_dir}/mapped{threads}'
+            os.makedirs(scratch_dir)
+            os.makedirs(output_dir)
+            mapped_tax_list, mapped_ab_dat = get_ind_freqs(ind_map, vcf_file, 10, 3, 20, False, output_dir, threads, scratch_dir=scratch_dir, working_set=1000)
+            assert mapped_tax_list == tax_list
+            assert all(isinstance(field.base, np.memmap) for field in mapped_ab_dat.fields())
+            assert_site_data_equal(mapped_ab_dat, ab_dat)
+            for name in tax_names:
+                with open(f'{temp_dir}/memory/{name}.txt') as fh, open(f'{output_dir}/{name}.txt') as mapped_fh:
+                    assert fh.read() == mapped_fh.read()
+
+def test_write_individual_files():
+    """
+    Test that the vectorized writer gives the same files as formatting each site with an f-string, serially and in a worker pool
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tax_names = ['ind1', 'ind2', 'ind3']
+        vcf_file = f'{temp_dir}/test.vcf'
+        write_test_vcf(vcf_file, tax_names, 300)
+        tax_list, ab_dat = get_ind_freqs({i: {} for i in tax_names}, vcf_file, 10, 3, 20, False, 'dummy')
+        ab_dat.allele_balance[0, 0] = np.float32(1 / 65535)
+        for threads in [1, 2]:
+            output_dir = f'{temp_dir}/out{threads}'
+            os.makedirs(output_dir)
+            write_individual_files(output_dir, ab_dat, threads)
+            for i, name in enumerate(tax_list):
+                expected = 'allele_balance\tdepth\tgenotype_quality\tpass_filters\n'
+                for j in range(ab_dat.n_sites):
+                    expected = expected + f'{ab_dat.allele_balance[j, i]}\t{ab_dat.depth[j, i]}\t{ab_dat.genotype_quality[j, i]}\t{ab_dat.pass_filters[j, i]}\n'
+                with open(f'{output_dir}/{name}.txt') as fh:
+                    assert fh.read() == expected
+
+def test_export_long_table():
+    """
+    Test that the long table holds one row per genotype with reads, with its chromosome and position, under either partition
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tax_names = ['ind1', 'ind2', 'ind3']
+        vcf_file = f'{temp_dir}/test.vcf'
+        expected = write_test_vcf(vcf_file, tax_names, 200, pos_step=7)
+        export_dir = f'{temp_dir}/by_individual'
+        tax_list, ab_dat = get_ind_freqs({i: {} for i in tax_names}, vcf_file, 10, 3, 20, False, 'dummy', export_dir=export_dir, working_set=200)
+        chrom = ab_dat.coordinates.chromosomes()
+        pos = ab_dat.coordinates.pos
+        rows = set()
+        for j, site in enumerate(expected):
+            for i, values in enumerate(site):
+                if (values is not None) and (values[0] + values[1] > 0):
+                    rows.add((tax_list[i], chrom[j], int(pos[j]), values[0], values[1], values[2], bool(ab_dat.pass_filters[j, i])))
+        assert len(pos) == len(expected)
+        assert np.all(np.diff(pos) > 0)
+        counts = load_allele_counts({i: {} for i in tax_names}, vcf_file, False)
+        export_long_table(counts, 10, 3, 20, f'{temp_dir}/by_chrom', 'chrom', working_set=200)
+        for partition, names in [('by_individual', tax_names), ('by_chrom', ['chr1', 'chr2', 'chr3'])]:
+            exported = set()
+            assert sorted(os.listdir(f'{temp_dir}/{partition}')) == [f'{partition[3:]}={name}' for name in names]
+            for name in os.listdir(f'{temp_dir}/{partition}'):
+                parts = sorted(os.listdir(f'{temp_dir}/{partition}/{name}'))
+                assert len(parts) > 1
+                for part in parts:
+                    with np.load(f'{temp_dir}/{partition}/{name}/{part}') as table:
+                        for row in zip(table['individual_names'][table['individual']], table['chrom_names'][table['chrom']], table['pos'], table['ref_count'], table['alt_count'], table['genotype_quality'], table['pass_filters']):
+                            exported.add((str(row[0]), str(row[1]), int(row[2]), int(row[3]), int(row[4]), int(row[5]), bool(row[6])))
+            assert exported == rows
+
+def test_coordinate_index():
+    """
+    Test that interval lookups in the coordinate index find the same sites as a scan, and match parsing with regions
+    """
+    coordinates = SiteCoordinates(['chr2', 'chr1'], np.array([0, 0, 0, 1, 1], dtype=np.int32), np.array([5, 9, 9, 1, 20], dtype=np.uint32))
+    for chrom, beg, end in [('chr2', 0, None), ('chr2', 4, 9), ('chr2', 5, 8), ('chr1', 0, 1), ('chr1', 1, 19), ('chr3', 0, 10)]:
+        sites = coordinates.site_range(chrom, beg, end)
+        expected = [j for j in range(5) if coordinates.chromosomes()[j] == chrom and beg < coordinates.pos[j] and (end is None or coordinates.pos[j] <= end)]
+        assert list(range(5)[sites]) == expected
+    assert list(coordinates.region_sites({'chr1': [(0, 5)], 'chr2': [(8, 9), (0, 6)]})) == [0, 1, 2, 3]
+    for chrom, pos in [([0, 1, 0], [1, 2, 3]), ([0, 0, 1], [2, 1, 3])]:
+        try:
+            SiteCoordinates(['chr1', 'chr2'], np.array(chrom, dtype=np.int32), np.array(pos, dtype=np.uint32)).site_range('chr1')
+            assert False
+        except ValueError:
+            pass
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tax_names = ['ind1', 'ind2']
+        vcf_file = f'{temp_dir}/test.vcf'
+        write_test_vcf(vcf_file, tax_names, 300, pos_step=3)
+        ind_map = {i: {} for i in tax_names}
+        region_map = parse_regions('chr1:10-100,chr3:700-750,chr2')
+        _, ab_dat = get_ind_freqs(ind_map, vcf_file, 10, 3, 20, False, 'dummy')
+        _, region_ab_dat = get_ind_freqs(ind_map, vcf_file, 10, 3, 20, False, 'dummy', region_map=region_map)
+        assert_site_data_equal(ab_dat.select(ab_dat.coordinates.region_sites(region_map)), region_ab_dat)
+        chr1 = ab_dat.region('chr1', 9, 100)
+        assert_site_data_equal(chr1, region_ab_dat.select(slice(0, chr1.n_sites)))
+        assert np.array_equal(chr1.coordinates.pos, region_ab_dat.coordinates.pos[:chr1.n_sites])
+
+def test_get_ind_freqs_stream():
+    """
+    Test that uncompressed and gzip compressed VCFs read once from a named pipe give the same arrays as the file,
+    with sharding, the cache, and index lookups bypassed
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        tax_names = ['ind1', 'ind2', 'ind3']
+        vcf_file = f'{temp_dir}/test.vcf'
+        write_test_vcf(vcf_file, tax_names, 300)
+        with open(vcf_file, 'rb') as fh:
+            data = fh.read()
+        ind_map = {i: {} for i in tax_names}
+        region_map = parse_regions('chr2')
+        for compress in [False, True]:
+            for kwargs in [{}, {'threads': 2, 'cache_dir': f'{temp_dir}/cache'}, {'region_map': region_map}]:
+                pipe_file = f'{temp_dir}/test.pipe'
+                os.mkfifo(pipe_file)
+                def write_pipe():
+                    with open(pipe_file, 'wb') as fh:
+                        fh.write(gzip.compress(data) if compress else data)
+                writer = threading.Thread(target=write_pipe)
+                writer.start()
+                try:
+                    _, ab_dat = get_ind_freqs(ind_map, pipe_file, 10, 3, 20, False, 'dummy', **kwargs)
+                finally:
+                    writer.join()
+                    os.remove(pipe_file)
+                _, expected = get_ind_freqs(ind_map, vcf_file, 10, 3, 20, False, 'dummy', region_map=kwargs.get('region_map'))
+                assert_site_data_equal(ab_dat, expected)
+        assert not os.path.exists(f'{temp_dir}/cache')
+
+def test_validate_individuals():
+    """
+    Test that individuals are validated from the header alone, with PATE paths resolved, and that mismatches are listed
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        vcf_file = f'{temp_dir}/test.vcf.gz'
+        with gzip.open(vcf_file, 'wt') as fh:
+            fh.write('##fileformat=VCFv4.2\n')
+            fh.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tpate/ind1/ind1.bam\tpate/ind2/ind2.bam\n')
+            fh.write('not a record\n')
+        assert validate_individuals({'ind1': {}, 'ind2': {}}, vcf_file, True) == ['ind1', 'ind2']
+        assert validate_individuals({'ind1.bam': {}}, vcf_file, False) == ['ind1.bam', 'ind2.bam']
+        try:
+            validate_individuals({'ind1': {}, 'indd2': {}, 'ind3': {}}, vcf_file, True)
+            assert False
+        except SystemExit as e:
+            assert 'indd2, ind3' in str(e)
+
+def test_allele_counts_filter():
+    """
+    Test that allele balance, depth, and the filter mask are computed from raw counts, including counts past the uint16 range of depth
+    """
+    ref_counts = np.array([[10, 0], [1, 40000]], dtype=np.uint16)
+    alt_counts = np.array([[5, 12], [3, 40000]], dtype=np.uint16)
+    genotype_quality = np.array([[30, 45], [99, 10]], dtype=np.uint8)
+    counts = AlleleCounts(['ind1', 'ind2'], ref_counts, alt_counts, genotype_quality)
+    assert np.allclose(counts.allele_balance(), [[1 / 3, 1.0], [0.75, 0.5]])
+    assert np.array_equal(counts.depth(), [[15, 12], [4, 65535]])
+    assert np.array_equal(counts.filter(10, 3, 20), [[True, False], [False, False]])
+    assert np.array_equal(counts.filter(4, 3, 0), [[True, False], [True, True]])
+
+def test_site_blocks():
+    """
+    Test that rows written across several blocks are concatenated in order
+    """
+    site_blocks = SiteBlocks(2, [np.uint16, np.bool_], block_size=4)
+    for j in range(10):
+        row = site_blocks.next_row()
+        site_blocks.current[0][row, :] = j
+        site_blocks.current[1][row, :] = j % 2
+    values, flags = site_blocks.finalize()
+    assert values.shape == (10, 2)
+    assert np.array_equal(values[:, 1], np.arange(10))
+    assert np.array_equal(flags[:, 0], np.arange(10) % 2 == 1)
@@ -26,4 +26,186 @@ def test_fit_gmm_to_ab():
             ind_dat_filtered = ind_dat[ind_mask].reshape(-1, 1)
             best_n = fit_gmm_to_ab(ind_name = f'{i}', dat = ind_dat_filtered, ploidy = [2,3,4,5,6], model_constraints = 1, output_dir = temp_dir)
             ploidy_results.append(best_n)
-        assert ploidy_results == [4,4,4,4]
\ No newline at end of file
+        assert ploidy_results == [4,4,4,4]
+
+def test_gmm_1d_matches_sklearn():
+    """
+    Test that the closed-form one-dimensional EM reaches the same fit and BIC as the scikit-learn based mixtures
+    """
+    from estploidy.fit_mixtures.gmm import GaussianMixtureFixedMeans, GaussianMixtureFixedMeansFixedWeights
+    from estploidy.fit_mixtures.gmm_1d import GaussianMixture1DFixedMeans, GaussianMixture1DFixedMeansFixedWeights
+    rng = np.random.default_rng(1)
+    dat = np.concatenate([rng.normal(0.33, 0.05, 600), rng.normal(0.67, 0.05, 400)]).reshape(-1, 1)
+    means = np.array([1 / 3, 2 / 3]).reshape(-1, 1)
+    weights = np.array([0.5, 0.5])
+    pairs = [
+        (GaussianMixtureFixedMeans(n_components=2, means_init=means, random_state=0), GaussianMixture1DFixedMeans(n_components=2, means_init=means, random_state=0)),
+        (GaussianMixtureFixedMeansFixedWeights(n_components=2, means_init=means, weights_init=weights, random_state=0), GaussianMixture1DFixedMeansFixedWeights(n_components=2, means_init=means, weights_init=weights, random_state=0))
+    ]
+    for reference, gmm in pairs:
+        reference.fit(dat)
+        gmm.fit(dat)
+        assert np.allclose(gmm.weights_, reference.weights_)
+        assert np.allclose(gmm.covariances_, reference.covariances_)
+        assert np.isclose(gmm.bic(dat), reference.bic(dat))
+
+
+def test_fixed_means_init():
+    """
+    Test that initializing from the fixed means gives the same fit in both backends, and a fit close to the k-means initialization
+    """
+    from estploidy.fit_mixtures.gmm import GaussianMixtureFixedMeans
+    from estploidy.fit_mixtures.gmm_1d import GaussianMixture1DFixedMeans
+    rng = np.random.default_rng(2)
+    dat = np.concatenate([rng.normal(0.25, 0.05, 300), rng.normal(0.5, 0.05, 600), rng.normal(0.75, 0.05, 300)]).reshape(-1, 1)
+    means = np.array([0.2, 0.4, 0.6, 0.8]).reshape(-1, 1)
+    reference = GaussianMixtureFixedMeans(n_components=4, means_init=means, init_params='means').fit(dat)
+    gmm = GaussianMixture1DFixedMeans(n_components=4, means_init=means, init_params='means').fit(dat)
+    kmeans = GaussianMixture1DFixedMeans(n_components=4, means_init=means, random_state=0).fit(dat)
+    assert np.allclose(gmm.weights_, reference.weights_)
+    assert np.isclose(gmm.bic(dat), reference.bic(dat))
+    assert np.isclose(gmm.score(dat), kmeans.score(dat), atol=1e-2)
+
+
+def test_fit_fixed_means_batched():
+    """
+    Test that the batched EM over packed individuals gives the same fits as fitting each individual on its own
+    """
+    from estploidy.fit_mixtures.gmm_1d import GaussianMixture1DFixedMeans, GaussianMixture1DFixedMeansFixedWeights
+    from estploidy.fit_mixtures.gmm_1d import pack_samples, fit_fixed_means_batched
+    rng = np.random.default_rng(3)
+    dats = [rng.normal(rng.choice(centers, n), 0.05) for centers, n in [((0.5,), 150), ((1 / 3, 2 / 3), 400), ((0.25, 0.5, 0.75), 90), ((0.5,), 1200)]]
+    values, offsets = pack_samples(dats)
+    assert list(offsets) == [0, 150, 550, 640, 1840]
+    means = np.array([0.25, 0.5, 0.75])
+    weights = np.array([0.25, 0.5, 0.25])
+    for fixed_weights in [False, True]:
+        fit = fit_fixed_means_batched(values, offsets, means, weights_init = weights if fixed_weights else None, fixed_weights = fixed_weights)
+        for i, dat in enumerate(dats):
+            if fixed_weights:
+                gmm = GaussianMixture1DFixedMeansFixedWeights(n_components=3, means_init=means, weights_init=weights, init_params='means').fit(dat)
+            else:
+                gmm = GaussianMixture1DFixedMeans(n_components=3, means_init=means, init_params='means').fit(dat)
+            assert fit.n_iter[i] == gmm.n_iter_
+            assert np.allclose(fit.weights[i], gmm.weights_)
+            assert np.allclose(fit.variances[i], gmm.variances_)
+            assert np.isclose(fit.bic()[i], gmm.bic(dat))
+
+
+def test_fit_gmm_to_ab_batched():
+    """
+    Test that fitting individuals together selects the same ploidy as fitting them one at a time
+    """
+    from estploidy.fit_mixtures.fit_mixtures import fit_gmm_to_ab_batched
+    rng = np.random.default_rng(4)
+    dats = [rng.normal(rng.choice(centers, 600), 0.04).reshape(-1, 1) for centers in [(0.5,), (0.25, 0.5, 0.75), (1 / 3, 2 / 3)]]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        single = [fit_gmm_to_ab(ind_name = f'{i}', dat = dat, ploidy = [2, 3, 4], model_constraints = 2, output_dir = temp_dir) for i, dat in enumerate(dats)]
+        with open(f'{temp_dir}/1.fit.txt') as infile:
+            single_fit = infile.read()
+        batched = fit_gmm_to_ab_batched(['0', '1', '2'], dats, ploidy = [2, 3, 4], model_constraints = 2, output_dir = temp_dir)
+        with open(f'{temp_dir}/1.fit.txt') as infile:
+            batched_fit = infile.read()
+    assert batched == single == [2, 4, 3]
+    assert batched_fit.split('Best likelihood')[0] == single_fit.split('Best likelihood')[0]
+
+
+def test_est_ploidy_jobs():
+    """
+    Test that fitting individuals in a process pool, alone or in batches, writes the same estimates in sample order as fitting them one after another
+    """
+    from estploidy.fit_mixtures.fit_mixtures import est_ploidy
+    from estploidy.calculate_frequencies.site_data import SiteData
+    rng = np.random.default_rng(5)
+    centers = [(0.5,), (1 / 3, 2 / 3), (0.25, 0.5, 0.75), (0.5,), (1 / 3, 2 / 3)]
+    n_sites = 800
+    allele_balance = np.stack([rng.normal(rng.choice(c, n_sites), 0.04) for c in centers], axis=1)
+    pass_filters = rng.random((n_sites, len(centers))) < np.array([0.9, 0.5, 0.7, 0.05, 0.3])
+    tax_list = [f'ind{i}' for i in range(len(centers))]
+    site_data = SiteData(tax_list, allele_balance, np.zeros_like(allele_balance), np.zeros_like(allele_balance), pass_filters)
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for jobs, batched in [(1, False), (2, False), (2, True)]:
+            ploidy_df = est_ploidy(tax_list, site_data, 'gmm', '2,3,4', 100, 2, temp_dir, batched = batched, jobs = jobs)
+            with open(f'{temp_dir}/ploidy.txt') as infile:
+                results.append(infile.read())
+            assert list(ploidy_df['Individual']) == tax_list
+    assert results[0] == results[1] == results[2] == 'ind0\t2\nind1\t3\nind2\t4\nind4\t3\n'
+
+    class CountingSiteData(SiteData):
+        __slots__ = ['reads']
+
+        def passing_allele_balance(self, i):
+            self.reads.append(i)
+            return SiteData.passing_allele_balance(self, i)
+
+    counting = CountingSiteData(tax_list, *site_data.fields())
+    counting.reads = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        est_ploidy(tax_list, counting, 'gmm', '2,3,4', 100, 2, temp_dir, batched = True)
+    # Each individual above the minimum is read once, when it is fitted
+    assert sorted(counting.reads) == [0, 1, 2, 4]
+
+
+def test_binned_fit():
+    """
+    Test that fitting counts of distinct allele balance values gives the same fit as fitting every site, alone and in batches
+    """
+    from estploidy.fit_mixtures.gmm_1d import GaussianMixture1DFixedMeans, bin_samples, pack_samples, fit_fixed_means_batched
+    rng = np.random.default_rng(6)
+    depth = rng.poisson(20, 5000) + 10
+    dat = rng.binomial(depth, rng.choice([1 / 3, 2 / 3], 5000)) / depth
+    values, counts = bin_samples(dat)
+    assert len(values) < 1000 and counts.sum() == 5000
+    binned_values, binned_counts = bin_samples(dat, 0.01)
+    assert np.all(np.diff(binned_values) > 0) and binned_counts.sum() == 5000
+    means = np.array([1 / 3, 2 / 3])
+    gmm = GaussianMixture1DFixedMeans(n_components=2, means_init=means, init_params='means').fit(dat)
+    binned = GaussianMixture1DFixedMeans(n_components=2, means_init=means, init_params='means').fit(values, sample_weight=counts)
+    assert binned.n_iter_ == gmm.n_iter_
+    assert np.allclose(binned.variances_, gmm.variances_)
+    assert np.isclose(binned.bic(values, sample_weight=counts), gmm.bic(dat))
+    packed_values, offsets = pack_samples([values, values[:50]])
+    packed_counts, _ = pack_samples([counts, counts[:50]])
+    fit = fit_fixed_means_batched(packed_values, offsets, means, sample_weight=packed_counts)
+    assert np.isclose(fit.bic()[0], gmm.bic(dat))
+    assert fit.n_samples[1] == counts[:50].sum()
+
+
+def test_get_ind_ab_max_sites():
+    """
+    Test that individuals with more passing sites than max_sites keep a reproducible sample, whatever the block size,
+    that is fitted in place of their passing sites without changing their filters
+    """
+    from estploidy.fit_mixtures.fit_mixtures import get_ind_ab
+    from estploidy.calculate_frequencies.site_data import build_site_data
+    from estploidy.calculate_frequencies.allele_counts import AlleleCounts
+    rng = np.random.default_rng(7)
+    ref_counts = rng.integers(5, 30, (500, 2)).astype(np.uint16)
+    alt_counts = rng.integers(5, 30, (500, 2)).astype(np.uint16)
+    alt_counts[40:, 1] = 0
+    counts = AlleleCounts(['ind1', 'ind2'], ref_counts, alt_counts, np.full((500, 2), 30, dtype=np.uint8))
+    site_data = build_site_data(counts, 10, 3, 20)
+    sampled_data = build_site_data(counts, 10, 3, 20, max_sites=100, seed=3)
+    passing = site_data.passing_allele_balance(0)
+    assert len(passing) > 100
+    sample = sampled_data.sampled_allele_balance[0]
+    assert len(sample) == 100
+    assert np.all(np.isin(sample, passing))
+    # Sampled sites keep their site order, which values increasing with the site show
+    from estploidy.calculate_frequencies.site_data import PassingSample
+    passing_sample = PassingSample(1, 50)
+    for start in range(0, 1000, 64):
+        rows = np.arange(start, min(start + 64, 1000))
+        passing_sample.extend(start, rows.astype(np.float32).reshape(-1, 1), (rows % 3 > 0).reshape(-1, 1))
+    ordered = passing_sample.samples()[0]
+    assert (len(ordered) == 50) and np.all(np.diff(ordered) > 0) and np.all(ordered % 3 > 0)
+    for working_set in [64, 1000, 100000]:
+        assert np.array_equal(build_site_data(counts, 10, 3, 20, working_set=working_set, max_sites=100, seed=3).sampled_allele_balance[0], sample)
+    assert not np.array_equal(build_site_data(counts, 10, 3, 20, max_sites=100, seed=4).sampled_allele_balance[0], sample)
+    assert np.array_equal(sampled_data.sampled_allele_balance[1], site_data.passing_allele_balance(1))
+    for field, sampled_field in zip(site_data.fields(), sampled_data.fields()):
+        assert np.array_equal(field, sampled_field)
+    dat = get_ind_ab(sampled_data, 0)
+    assert np.array_equal(dat[:, 0], sample[(sample > 0.05) & (sample < 0.95)])
+    assert np.array_equal(get_ind_ab(sampled_data, 1), get_ind_ab(site_data, 1))